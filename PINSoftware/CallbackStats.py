@@ -0,0 +1,158 @@
+"""
+This file has the instrumentation of the dash server. `instrument_app` replaces `dash.Dash.callback`
+of an app with a version which times every call of every callback registered afterwards, it also
+adds flask hooks which measure the whole request and the size of the response. All of it is kept
+in a `CallbackStats` in memory, using `PINSoftware.Profiler.Histogram`s so it doesn't grow over time.
+"""
+import functools
+import threading
+import time
+
+import dash
+import flask
+
+from dash.exceptions import PreventUpdate
+
+from PINSoftware.Profiler import Histogram
+from PINSoftware.Metrics import MetricsRegistry
+
+
+class CallbackRecord():
+    """The statistics of a single callback"""
+    def __init__(self, function : str, output : str):
+        """`function` is the name of the callback function and `output` is its (first) output"""
+        self.function = function
+        self.output = output
+        self.reset()
+
+    def reset(self):
+        """Forgets all the recorded values"""
+        self.calls = 0
+        self.prevented = 0
+        self.errors = 0
+        self.latency = Histogram()
+        self.request_latency = Histogram()
+        self.response_bytes = Histogram()
+
+    def summary(self) -> dict:
+        """Returns the statistics as a dict, latencies are in milliseconds"""
+        return {
+            'function': self.function,
+            'output': self.output,
+            'calls': self.calls,
+            'prevented': self.prevented,
+            'errors': self.errors,
+            'latency_ms': self.latency.summary(1e-6),
+            'request_latency_ms': self.request_latency.summary(1e-6),
+            'response_bytes': self.response_bytes.summary(),
+            'total_response_bytes': self.response_bytes.total
+        }
+
+
+class CallbackStats():
+    """
+    A store of `CallbackRecord`s, one for each instrumented callback. The key of a callback is
+    its function name and its first output, because many callbacks (like the ones made by
+    `PINSoftware.DashComponents`) share the same function name.
+    """
+    def __init__(self):
+        self.records = {}
+        self.started = time.time()
+        self.current = threading.local()
+
+    def register(self, function : str, output : str) -> str:
+        """Creates a record for a new callback and returns its key"""
+        key = function + ":" + output
+        if key not in self.records:
+            self.records[key] = CallbackRecord(function, output)
+        return key
+
+    def summary(self) -> dict:
+        """Returns the statistics of all callbacks which were called at least once"""
+        return {
+            'since': self.started,
+            'callbacks': {key: record.summary() for key, record in self.records.items() if record.calls}
+        }
+
+    def reset(self):
+        """Forgets all recorded values but keeps the callbacks"""
+        for record in self.records.values():
+            record.reset()
+        self.started = time.time()
+
+
+def get_first_output(args, kwargs) -> str:
+    """Gets the first output of a callback from the arguments given to `dash.Dash.callback`"""
+    output = args[0] if args else kwargs.get('output')
+    if isinstance(output, (list, tuple)):
+        output = output[0]
+    return str(output)
+
+
+def instrument_app(app : dash.Dash, stats : CallbackStats, metrics : MetricsRegistry = None):
+    """
+    Makes every callback registered through `app.callback` after this is called record its calls,
+    latency, results (prevented updates and exceptions), request latency and response size into `stats`.
+    This has to be called before any callbacks are registered.
+
+    If `metrics` is given, the callback latencies and the latencies of all requests
+    (labeled by the flask endpoint) are also recorded there.
+    """
+    original_callback = app.callback
+    if metrics:
+        callback_histogram = metrics.histogram("dash_callback_duration_seconds", "Duration of dash callbacks",
+                labelnames=['callback'], min_exponent=16, max_exponent=34)
+        request_histogram = metrics.histogram("http_request_duration_seconds", "Duration of http requests",
+                labelnames=['endpoint', 'status'], min_exponent=16, max_exponent=34)
+
+    def callback(*args, **kwargs):
+        decorator = original_callback(*args, **kwargs)
+
+        def wrap(func):
+            key = stats.register(func.__name__, get_first_output(args, kwargs))
+            record = stats.records[key]
+
+            @functools.wraps(func)
+            def timed(*func_args, **func_kwargs):
+                stats.current.key = key
+                start = time.perf_counter_ns()
+                try:
+                    return func(*func_args, **func_kwargs)
+                except PreventUpdate:
+                    record.prevented += 1
+                    raise
+                except Exception:
+                    record.errors += 1
+                    raise
+                finally:
+                    duration = time.perf_counter_ns() - start
+                    record.latency.record(duration)
+                    record.calls += 1
+                    if metrics:
+                        callback_histogram.labels(callback=key).observe_units(duration)
+            return decorator(timed)
+        return wrap
+
+    app.callback = callback
+
+    @app.server.before_request
+    def callback_request_start():
+        stats.current.key = None
+        flask.g.callback_request_start = time.perf_counter_ns()
+
+    @app.server.after_request
+    def callback_request_end(response):
+        start = flask.g.get('callback_request_start')
+        if start is None:
+            # An earlier before_request handler returned a response so `callback_request_start` didn't run
+            return response
+        duration = time.perf_counter_ns() - start
+        if metrics:
+            request_histogram.labels(endpoint=flask.request.endpoint, status=response.status_code).observe_units(duration)
+        key = getattr(stats.current, 'key', None)
+        if key is not None and flask.request.path.endswith('_dash-update-component'):
+            record = stats.records[key]
+            record.request_latency.record(duration)
+            length = response.calculate_content_length()
+            record.response_bytes.record(length if length is not None else 0)
+        return response
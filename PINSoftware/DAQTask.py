@@ -0,0 +1,212 @@
+"""
+This file has the `DAQTaskManager` which keeps the configured `nidaqmx.Task` alive between the runs. Finding the device,
+creating the task, adding the channels and setting the timing takes a while (and looking up the devices sometimes stalls),
+so it is only done for the first run, the next runs just start the same task again. The task is only reconfigured when
+the sampling rate changes and recreated when the number of channels does.
+
+The tasks are made by a backend, `NiDAQmxBackend` makes the real ones and `FakeBackend` makes `FakeTask`s which
+behave like the NI-6002 but generate the data (by `PINSoftware.SyntheticData.PulseGenerator`s), so the
+`PINSoftware.DataUpdater.NiDAQmxDataUpdater` and the task reuse can be run without the device. nidaqmx is only
+needed for the real backend.
+"""
+import threading
+import time
+
+import numpy as np
+
+try:
+    import nidaqmx
+    import nidaqmx.stream_readers
+except ImportError:
+    nidaqmx = None
+
+from PINSoftware.Debugger import Debugger
+from PINSoftware.SyntheticData import PulseGenerator
+
+
+READ_ALL_AVAILABLE = nidaqmx.constants.READ_ALL_AVAILABLE if nidaqmx else -1
+"""The number of samples to read to get all the available ones (`nidaqmx.constants.READ_ALL_AVAILABLE`)"""
+
+
+class NiDAQmxBackend():
+    """Makes the real `nidaqmx.Task`s for the NI-6002"""
+    def create_task(self, channel_count : int, freq : int, debugger : Debugger):
+        """
+        Checks if there is exactly one device and if the device is the NI-6002, if not, an exception is raised.
+        Then it creates a task with the first `channel_count` analog input channels sampled at `freq` continuously.
+        """
+        if nidaqmx is None:
+            debugger.error("The nidaqmx package is not installed, the NI-6002 can't be used.")
+            raise Exception
+        system = nidaqmx.system.System.local()
+        if len(system.devices) != 1:
+            debugger.warning("There should be exactly one device connected, but there is: " + str(len(system.devices)) + ", the program may not work correctly")
+        device = system.devices[0]
+        if device.product_type != 'USB-6002':
+            debugger.error("Incorrect device connected, exiting.")
+            raise Exception
+        if len(device.ai_physical_chans) < channel_count:
+            debugger.error("The device only has " + str(len(device.ai_physical_chans)) + " analog input channels, exiting.")
+            raise Exception
+        task = nidaqmx.Task()
+        for channel in device.ai_physical_chans[:channel_count]:
+            task.ai_channels.add_ai_voltage_chan(channel.name)
+        self.configure_timing(task, freq)
+        return task
+
+    def configure_timing(self, task, freq : int):
+        """Sets `task` (which must not be running) to acquire continuously at `freq`"""
+        task.timing.cfg_samp_clk_timing(freq, sample_mode=nidaqmx.constants.AcquisitionType.CONTINUOUS)
+
+    def create_reader(self, task):
+        """Returns a reader which reads all the channels of `task` into a numpy array"""
+        return nidaqmx.stream_readers.AnalogMultiChannelReader(task.in_stream)
+
+
+class FakeTask():
+    """
+    A stand-in for a `nidaqmx.Task` of the NI-6002, it has the parts of its interface which this program uses.
+    Like the device, the samples become available at the sampling rate by the wall clock once it is started.
+    """
+    def __init__(self, generator_kwargs : dict = {}):
+        """`generator_kwargs` are passed to the `PINSoftware.SyntheticData.PulseGenerator` of every channel (the seed is increased by the channel index)"""
+        self.generator_kwargs = generator_kwargs
+        self.channel_names = []
+        self.rate = None
+        self.running = False
+        self.closed = False
+        # The task, its channels, timing and stream are all parts of the same object in nidaqmx
+        self.ai_channels = self
+        self.timing = self
+        self.in_stream = self
+
+    def add_ai_voltage_chan(self, physical_channel : str):
+        self.channel_names.append(physical_channel)
+
+    def cfg_samp_clk_timing(self, rate : int, sample_mode=None):
+        if self.running:
+            raise Exception("The timing of a running task can't be changed")
+        self.rate = rate
+
+    def start(self):
+        seed = self.generator_kwargs.get('seed', 0)
+        self.generators = [PulseGenerator(freq=self.rate, **dict(self.generator_kwargs, seed=seed + i))
+            for i in range(len(self.channel_names))]
+        self.start_time = time.monotonic()
+        self.acquired = 0
+        self.running = True
+
+    def stop(self):
+        self.running = False
+
+    def close(self):
+        self.running = False
+        self.closed = True
+
+    @property
+    def avail_samp_per_chan(self) -> int:
+        if not self.running:
+            return 0
+        return int((time.monotonic() - self.start_time) * self.rate) - self.acquired
+
+    def read_samples(self, count : int) -> np.ndarray:
+        """Returns the next `count` samples as a (channels, count) numpy array"""
+        self.acquired += count
+        return np.stack([generator.next(count) for generator in self.generators])
+
+    def read(self, number_of_samples_per_channel : int = 1):
+        count = self.avail_samp_per_chan if number_of_samples_per_channel == READ_ALL_AVAILABLE else number_of_samples_per_channel
+        samples = self.read_samples(count)
+        return samples[0].tolist() if len(samples) == 1 else samples.tolist()
+
+
+class FakeMultiChannelReader():
+    """A stand-in for `nidaqmx.stream_readers.AnalogMultiChannelReader` reading from a `FakeTask`"""
+    def __init__(self, task : FakeTask):
+        self.task = task
+
+    def read_many_sample(self, data : np.ndarray, number_of_samples_per_channel : int = READ_ALL_AVAILABLE, timeout : float = 10.0) -> int:
+        count = self.task.avail_samp_per_chan if number_of_samples_per_channel == READ_ALL_AVAILABLE else number_of_samples_per_channel
+        data[:, :count] = self.task.read_samples(count)
+        return count
+
+
+class FakeBackend():
+    """Makes `FakeTask`s, it is for running and testing the device code without the device"""
+    def __init__(self, generator_kwargs : dict = {}):
+        """`generator_kwargs` are passed to the `FakeTask`s"""
+        self.generator_kwargs = generator_kwargs
+
+    def create_task(self, channel_count : int, freq : int, debugger : Debugger) -> FakeTask:
+        """."""
+        task = FakeTask(self.generator_kwargs)
+        for i in range(channel_count):
+            task.ai_channels.add_ai_voltage_chan("Dev1/ai" + str(i))
+        self.configure_timing(task, freq)
+        return task
+
+    def configure_timing(self, task : FakeTask, freq : int):
+        """."""
+        task.timing.cfg_samp_clk_timing(freq)
+
+    def create_reader(self, task : FakeTask) -> FakeMultiChannelReader:
+        """."""
+        return FakeMultiChannelReader(task)
+
+
+class DAQTaskManager():
+    """
+    Keeps one configured task (and its multi channel reader) between the runs, see `DAQTaskManager.get`.
+    The runs start and stop the task, the manager closes it only in `DAQTaskManager.release`.
+    """
+    def __init__(self, backend=None, debugger : Debugger = Debugger()):
+        """
+        `backend` makes the tasks, it is a `NiDAQmxBackend` (the default) or a `FakeBackend`.
+
+        `debugger` is the `PINSoftware.Debugger.Debugger` to use for printouts.
+        """
+        self.backend = backend or NiDAQmxBackend()
+        self.debugger = debugger
+        self.lock = threading.Lock()
+        self.task = None
+        self.reader = None
+        self.channel_count = None
+        self.freq = None
+        self.created = 0
+        self.reconfigured = 0
+        self.reused = 0
+
+    def get(self, channel_count : int, freq : int) -> tuple:
+        """
+        Returns the (stopped) task for `channel_count` channels sampled at `freq` and its multi channel reader as a tuple.
+        The kept task is reused if it fits, its timing is changed if only `freq` is different and a new task is
+        created if the number of channels is different.
+        """
+        with self.lock:
+            if self.task is not None and self.channel_count != channel_count:
+                self.close_task()
+            if self.task is None:
+                self.task = self.backend.create_task(channel_count, freq, self.debugger)
+                self.reader = self.backend.create_reader(self.task)
+                self.created += 1
+            elif self.freq != freq:
+                self.backend.configure_timing(self.task, freq)
+                self.reconfigured += 1
+            else:
+                self.reused += 1
+            self.channel_count = channel_count
+            self.freq = freq
+            return self.task, self.reader
+
+    def close_task(self):
+        """Closes the kept task"""
+        self.task.close()
+        self.task = None
+        self.reader = None
+        self.debugger.info("DAQTaskManager: Closed the task")
+
+    def release(self):
+        """Closes the kept task if there is one, the next `DAQTaskManager.get` creates a new one"""
+        with self.lock:
+            if self.task is not None:
+                self.close_task()
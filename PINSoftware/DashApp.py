@@ -1,14 +1,28 @@
 import base64
+import bisect
+import collections
 import datetime
+import functools
+import itertools
+import json
 import os
+import threading
 import uuid
 import urllib
 
 from PINSoftware.MachineState import MachineState
+from PINSoftware.DataAnalyser import linear_correct_func, get_config_string
 from PINSoftware.DashComponents import FullRedrawGraph, ExtendableGraph, SingleSwitch
 from PINSoftware.DataSaver import Filetype
+from PINSoftware.DataExporter import export, export_formats, ExportException
+from PINSoftware.OverviewPyramid import OverviewPyramid
+from PINSoftware.RunSummary import RunSummaryCache, summaries_to_csv
+from PINSoftware.CallbackStats import CallbackStats, instrument_app
+from PINSoftware.Debugger import log_queue
+from PINSoftware.MemoryStats import analyser_sizes, saver_sizes, profiler_sizes
 
 import flask
+import numpy as np
 import dash
 import dash_core_components as dcc
 import dash_html_components as html
@@ -18,9 +32,148 @@ from dash.dependencies import Input, Output, State
 from dash.exceptions import PreventUpdate
 
 
-def linear_correct_func(cor_a, cor_b):
-    """Get a linear function with `a` and `b` as its coefficients"""
-    return lambda x: cor_a * x + cor_b
+def timestamp_to_datetime(ms : MachineState, x : int) -> datetime.datetime:
+    """
+    Converts the timestamps sotred in `PINSoftware.DataAnalyser.DataAnalyser` of `ms.data` to a `datetime.datetime` object,
+    using its time anchors (see `PINSoftware.DataAnalyser.DataAnalyser.sample_to_time`).
+    """
+    return datetime.datetime.fromtimestamp(ms.data.sample_to_time(x))
+
+
+def get_channels(ms : MachineState) -> list:
+    """Returns the `PINSoftware.DataAnalyser.DataAnalyser`s of all the channels of `ms.data`, the first is the main one"""
+    return getattr(ms.data, 'channels', [ms.data])
+
+
+def get_trace_name(ms : MachineState, name : str, channel_index : int) -> str:
+    """Returns the name of a graph trace of the channel with `channel_index`, the main channel's traces keep their plain names"""
+    return name if channel_index == 0 else name + " (" + ms.channel_names[channel_index] + ")"
+
+
+def full_graph_extend(ms : MachineState, n, graph_indices):
+    """
+    Full graph extend function, it is a module level function so that it can be benchmarked.
+    The graph has two traces for every channel, the indices of the channels after the first have the channel index appended.
+    """
+    to_datetime = functools.partial(timestamp_to_datetime, ms)
+    xs = []
+    ys = []
+    for channel_index, channel in enumerate(get_channels(ms)):
+        suffix = "_" + str(channel_index) if channel_index else ""
+        for key, values, timestamps in [('pro_index', channel.processed_ys, channel.processed_timestamps),
+                ('avg_index', channel.averaged_processed_ys, channel.averaged_processed_timestamps)]:
+            index = min(graph_indices.get(key + suffix, 0), len(values))
+            # All the channels are converted to time from the first peak of the main channel
+            top_index = min(index + 30000, len(values)) if ms.data.first_processed_timestamp is not None else index
+            xs.append(list(map(to_datetime, timestamps[index:top_index])))
+            ys.append(values[index:top_index])
+            graph_indices[key + suffix] = top_index
+    return [[{'x': xs, 'y': ys}], graph_indices]
+
+
+def get_live_trace(ms : MachineState, timestamps : list, values : list, show_from : int, name : str) -> dict:
+    """Returns the live graph trace of `values` since `show_from` or None if there are none"""
+    if not values or timestamps[-1] < show_from or ms.data.first_processed_timestamp is None:
+        return None
+    # The last value before the interval is shown too, like the values in it
+    index = max(bisect.bisect_right(timestamps, show_from) - 1, 0)
+    return {
+        'x': list(map(functools.partial(timestamp_to_datetime, ms), timestamps[index:])),
+        'y': values[index:],
+        'type': 'scatter',
+        'name': name
+    }
+
+
+def get_watchdog_warning(ms : MachineState, seconds : float = 60) -> str:
+    """Returns a warning listing the problems found by the `PINSoftware.Watchdog.Watchdog` of the run in the last `seconds`"""
+    watchdog = getattr(ms, 'watchdog', None)
+    if not watchdog:
+        return ""
+    events = watchdog.recent_events(seconds)
+    if not events:
+        return ""
+    return "Acquisition problems in the last minute: " + "; ".join(
+        datetime.datetime.fromtimestamp(wall).strftime("%H:%M:%S") + " " + message for wall, count, kind, message in events[-3:])
+
+
+def live_graph_func(ms : MachineState, n, T):
+    """
+    Live graph figure function, it is a module level function so that it can be benchmarked.
+    The shown part of the lists is found by bisection and the average and the peak rate are read from
+    the live window of `PINSoftware.DataAnalyser.DataAnalyser.stats` for `T` (see
+    `PINSoftware.RollingStats.RollingStats.get_live_window`). The recent problems found by the watchdog are shown below it.
+    """
+    now = len(ms.data.ys)
+    show_from = now - T * ms.data.freq
+    data = []
+    for channel_index, channel in enumerate(get_channels(ms)):
+        for timestamps, values, name in [(channel.processed_timestamps, channel.processed_ys, 'Live averaged peak voltage'),
+                (channel.averaged_processed_timestamps, channel.averaged_processed_ys, 'Live peak voltage')]:
+            trace = get_live_trace(ms, timestamps, values, show_from, get_trace_name(ms, name, channel_index))
+            if trace:
+                data.append(trace)
+    current_avg = None
+    current_count = None
+    if ms.data.stats and T:
+        live_stats = ms.data.stats.window_summary(ms.data.stats.get_live_window(T), now)
+        current_avg = live_stats['mean']
+        current_count = live_stats['peaks_per_s']
+    return [{'data': data},
+            "The average value is: " + str(current_avg) if current_avg else "",
+            "Current peak voltages per second are: " + str(current_count) if current_avg else "",
+            get_watchdog_warning(ms)
+            ]
+
+
+def histogram_graph_func(ms : MachineState, n, which):
+    """
+    Peak voltage distribution figure function, it draws the bin counts kept by `PINSoftware.DataAnalyser.DataAnalyser.histogram`
+    of every channel. `which` is "window" for the current window or "total" for the whole run. The histograms are shared by
+    all the clients, so this only reads them, only the controller can change how often the window restarts.
+    """
+    if not ms.data.histogram:
+        raise PreventUpdate()
+    data = []
+    infos = []
+    for channel_index, channel in enumerate(get_channels(ms)):
+        histogram = channel.histogram
+        counts, edges = histogram.get(total=(which == 'total'))
+        info = str(int(counts.sum())) + " peak voltages"
+        if histogram.underflow or histogram.overflow:
+            info += ", " + str(histogram.underflow) + " below and " + str(histogram.overflow) + " above the range"
+        infos.append(get_trace_name(ms, info, channel_index))
+        data.append({
+            'x': ((edges[:-1] + edges[1:]) / 2).tolist(),
+            'y': counts.tolist(),
+            'width': np.diff(edges).tolist(),
+            'type': 'bar',
+            'opacity': 0.6 if channel_index else 1,
+            'name': get_trace_name(ms, 'Peak voltages', channel_index)
+        })
+    reset_interval = ms.data.histogram.reset_interval
+    infos.append("the window restarts " + ("every " + format(reset_interval, 'g') + " s" if reset_interval else "never"))
+    return [{
+            'data': data,
+            'layout': {'bargap': 0, 'barmode': 'overlay', 'xaxis': {'title': 'Peak voltage [V]'}, 'yaxis': {'title': 'Count'}}
+        }, ", ".join(infos)]
+
+
+def spectrum_graph_func(ms : MachineState, n):
+    """Spectrum figure function, it draws the current and the whole run spectra of `ms.spectrum` (`PINSoftware.Spectrum.SpectrumAnalyser`)"""
+    if not ms.spectrum:
+        raise PreventUpdate()
+    data = []
+    for name, total in [("Current", False), ("Whole run average", True)]:
+        frequencies, psd = ms.spectrum.get(total=total)
+        if psd is not None:
+            data.append({'x': frequencies.tolist(), 'y': psd.tolist(), 'type': 'scatter', 'name': name})
+    info = (str(ms.spectrum.segments) + " segments analysed, " + str(ms.spectrum.skipped_segments) + " skipped, the last update took " +
+        "{:.1f} ms".format(ms.spectrum.update_duration * 1000))
+    return [{
+            'data': data,
+            'layout': {'xaxis': {'title': 'Frequency [Hz]'}, 'yaxis': {'title': 'Power spectral density [V²/Hz]', 'type': 'log'}}
+        }, info]
 
 
 def get_app(ms : MachineState) -> dash.Dash:
@@ -33,87 +186,20 @@ def get_app(ms : MachineState) -> dash.Dash:
     app.config.suppress_callback_exceptions = False
     app.logger.disabled = False
 
-    def timestamp_to_datetime(x : int) -> datetime.datetime:
-        """Converts the timestamps sotred in `PINSoftware.DataAnalyser.DataAnalyser` to a `datetime.datetime` object"""
-        return datetime.datetime.fromtimestamp(ms.data.first_processed_timestamp + x * ms.data.period)
+    callback_stats = CallbackStats()
+    instrument_app(app, callback_stats, ms.metrics)
 
     full_graph_base_fig = {'data': [
             {
                 'x': [],
                 'y': [],
                 'type': 'scatter',
-                'name': 'Live peak voltage'
-            },
-            {
-                'x': [],
-                'y': [],
-                'type': 'scatter',
-                'name': 'Live averaged peak voltage'
+                'name': get_trace_name(ms, name, channel_index)
             }
+            for channel_index in range(ms.channels) for name in ['Live peak voltage', 'Live averaged peak voltage']
         ]
     }
 
-    def full_graph_extend(n, graph_indices):
-        """Full graph extend function"""
-        pro_index = min(graph_indices['pro_index'], len(ms.data.processed_ys))
-        avg_index = min(graph_indices['avg_index'], len(ms.data.averaged_processed_ys))
-        pro_top_index = min(pro_index + 30000, len(ms.data.processed_ys))
-        avg_top_index = min(avg_index + 30000, len(ms.data.averaged_processed_ys))
-        result = [
-                {
-                    'x': [
-                        list(map(timestamp_to_datetime, ms.data.processed_timestamps[pro_index:pro_top_index])),
-                        list(map(timestamp_to_datetime, ms.data.averaged_processed_timestamps[avg_index:avg_top_index]))
-                    ],
-                    'y': [
-                        ms.data.processed_ys[pro_index:pro_top_index],
-                        ms.data.averaged_processed_ys[avg_index:avg_top_index]
-                        ]
-                }
-            ]
-        graph_indices['pro_index'] = pro_top_index
-        graph_indices['avg_index'] = avg_top_index
-        return [result, graph_indices]
-
-    def live_graph_func(n, T):
-        """Live graph figure function"""
-        show_from = len(ms.data.ys) - T * 50000
-        data = []
-        current_avg = None
-        current_count = None
-        if ms.data.processed_ys and ms.data.processed_timestamps[-1] >= show_from:
-            pro_index = -1
-            max_pro_index = -len(ms.data.processed_timestamps)
-            while ms.data.processed_timestamps[pro_index] > show_from and pro_index > max_pro_index:
-                pro_index -= 1
-            data.append(
-                {
-                    'x': list(map(timestamp_to_datetime, ms.data.processed_timestamps[pro_index:])),
-                    'y': ms.data.processed_ys[pro_index:],
-                    'type': 'scatter',
-                    'name': 'Live averaged peak voltage'
-                }
-            )
-            current_count = -pro_index / T
-        if ms.data.averaged_processed_ys and ms.data.averaged_processed_timestamps[-1] >= show_from:
-            avg_index = -1
-            max_avg_index = -len(ms.data.averaged_processed_timestamps)
-            while ms.data.averaged_processed_timestamps[avg_index] > show_from and avg_index > max_avg_index:
-                avg_index -= 1
-            data.append(
-                {
-                    'x': list(map(timestamp_to_datetime, ms.data.averaged_processed_timestamps[avg_index:])),
-                    'y': ms.data.averaged_processed_ys[avg_index:],
-                    'type': 'scatter',
-                    'name': 'Live peak voltage'
-                }
-            )
-            current_avg = sum(ms.data.averaged_processed_ys[avg_index:]) / -avg_index
-        return [{'data': data},
-                "The average value is: " + str(current_avg) if current_avg else "",
-                "Current peak voltages per second are: " + str(current_count) if current_avg else ""
-                ]
-
     app.layout = lambda: dbc.Container([
         html.H1("xPIN, Sample and Hold, NI-DAQmx system software", style={'textAlign': 'center'}),
         dbc.Modal([
@@ -152,6 +238,53 @@ def get_app(ms : MachineState) -> dash.Dash:
                         ),
                         justify='center',
                         className='mt-3 mb-2'
+                    ),
+                    dbc.Row(
+                        dbc.Col(
+                            dbc.ButtonGroup([
+                                dbc.Button("Show callback statistics", id='ad-callback-stats-show', color='info'),
+                                dbc.Button("Reset callback statistics", id='ad-callback-stats-reset', color='secondary'),
+                                html.A(
+                                    dbc.Button("As JSON", color='light'),
+                                    href='/stats/callbacks'
+                                )
+                            ]),
+                            width='auto'
+                        ),
+                        justify='center',
+                        className='mt-3 mb-2'
+                    ),
+                    dbc.Row(
+                        dbc.Col(
+                            id='ad-callback-stats',
+                            width='auto'
+                        ),
+                        justify='center',
+                        className='mt-1 mb-2'
+                    ),
+                    dbc.Row([
+                        dbc.Col(
+                            dbc.InputGroup([
+                                dbc.InputGroupAddon("Profile all threads for", addon_type='prepend'),
+                                dbc.Input(id='ad-sampling-profiler-duration', type='number', min=1, max=600, value=10, step=1),
+                                dbc.InputGroupAddon("s", addon_type='append'),
+                            ]),
+                            width=4
+                        ),
+                        dbc.Col(
+                            dbc.Button("Start sampling profiler", id='ad-sampling-profiler-start', color='info'),
+                            width='auto'
+                        )],
+                        justify='center',
+                        className='mt-3 mb-1'
+                    ),
+                    dbc.Row(
+                        dbc.Col(
+                            id='ad-sampling-profiler-info',
+                            width='auto'
+                        ),
+                        justify='center',
+                        className='mt-1 mb-2'
                     )],
                     className='mt-3 mb-3'
                 ), label="Administration", tab_id='administration-tab'),
@@ -207,6 +340,7 @@ def get_app(ms : MachineState) -> dash.Dash:
                                             id='cp-save-items',
                                             options=[
                                                 {'label': "Save raw data", 'value': 'ys'},
+                                                {'label': "Save raw data around the pulses", 'value': 'triggered_ys'},
                                                 {'label': "Save peak voltages", 'value': 'processed_ys'},
                                                 {'label': "Save averaged peak voltages", 'value': 'averaged_processed_ys'},
                                                 {'label': "Save debug markers", 'value': 'markers'}
@@ -310,6 +444,17 @@ def get_app(ms : MachineState) -> dash.Dash:
                                         ],
                                         row=True
                                     ))),
+                                    dbc.Row([
+                                        dbc.Col(
+                                            dbc.Button("Apply to the running acquisition", id='cp-da-apply', color='primary'),
+                                            width='auto'
+                                        ),
+                                        dbc.Col(
+                                            id='cp-da-apply-messagebox',
+                                            width='auto'
+                                        )],
+                                        justify='center'
+                                    ),
                                 ],
                                 id='cp-dataanalyser-options',
                                 fluid=True,
@@ -321,6 +466,137 @@ def get_app(ms : MachineState) -> dash.Dash:
                         className='mt-3'
                     )]
                 ), label="Processing controls", id='processing-options', tab_id='processing-options-tab', disabled=True),
+                dbc.Tab(dbc.Container([
+                    dbc.Row([
+                        dbc.Col(
+                            dbc.Select(id='hi-file', placeholder="Select a saved run"),
+                            width=6
+                        ),
+                        dbc.Col(
+                            dbc.Select(id='hi-series', placeholder="Select data"),
+                            width=3
+                        )],
+                        justify='center',
+                        className='mt-3 mb-2'
+                    ),
+                    dbc.Row(
+                        dbc.Col(
+                            "",
+                            id='hi-info',
+                            width='auto'
+                        ),
+                        justify='center'
+                    ),
+                    dbc.Row(
+                        dbc.Col(
+                            dcc.Graph(id='hi-graph', config={'displayModeBar': True}, figure={'data': []})
+                        ),
+                        justify='center'
+                    ),
+                    html.H4("Compare runs", className='mt-3'),
+                    dbc.Row([
+                        dbc.Col(
+                            dbc.Button("Summarise runs", id='hi-summary-show', color='info'),
+                            width='auto'
+                        ),
+                        dbc.Col(
+                            html.A("Download the summaries as csv", href='/runs/summary.csv'),
+                            width='auto'
+                        )],
+                        className='mt-1 mb-1'
+                    ),
+                    dbc.Row(
+                        dbc.Col(
+                            dcc.Loading(html.Div(id='hi-summary', style={'overflowX': 'auto'}))
+                        )
+                    ),
+                    dbc.Row([
+                        dbc.Col(
+                            dcc.Dropdown(id='hi-compare-files', multi=True, placeholder="Select runs to overlay"),
+                            width=6
+                        ),
+                        dbc.Col(
+                            dbc.Select(id='hi-compare-series', value='processed_ys', options=[
+                                {'label': "Peak voltages", 'value': 'processed_ys'},
+                                {'label': "Averaged peak voltages", 'value': 'averaged_processed_ys'},
+                                {'label': "Raw data", 'value': 'ys'}
+                            ]),
+                            width=3
+                        )],
+                        justify='center',
+                        className='mt-3 mb-2'
+                    ),
+                    dbc.Row(
+                        dbc.Col(
+                            dcc.Graph(id='hi-compare-graph', config={'displayModeBar': True}, figure={'data': []})
+                        ),
+                        justify='center'
+                    )],
+                    className='mt-3'
+                ), label="History", tab_id='history-tab'),
+                dbc.Tab(dbc.Container([
+                    FullRedrawGraph(app, ms, 'histogram-graph', "Distribution of the peak voltages", functools.partial(histogram_graph_func, ms),
+                        fig_func_output=[Output('histogram-graph', 'figure'), Output('histogram-graph-info', 'children')],
+                        fig_func_state=[State('histogram-graph-which', 'value')],
+                        additional_controls=[
+                            dbc.Row([
+                                dbc.Col(
+                                    dbc.Select(id='histogram-graph-which', value='window', options=[
+                                        {'label': "Current window", 'value': 'window'},
+                                        {'label': "Whole run", 'value': 'total'}
+                                    ]),
+                                    width=3
+                                ),
+                                dbc.Col(
+                                    dbc.FormGroup([
+                                        dbc.Label("Restart the window every [s]:", html_for='histogram-graph-reset', width='auto'),
+                                        dbc.Col(
+                                            dbc.Input(id='histogram-graph-reset', type='number', min=0, step=1, placeholder="never"),
+                                            width=4
+                                        ),
+                                        dbc.Button("Set", id='histogram-graph-reset-set', color='primary')
+                                    ],
+                                    row=True
+                                    ),
+                                    width='auto'
+                                )],
+                                justify='center',
+                                className='mt-2'
+                            ),
+                            dbc.Row(
+                                dbc.Col(
+                                    "",
+                                    id='histogram-graph-reset-messagebox',
+                                    width='auto'
+                                ),
+                                justify='center'
+                            ),
+                            dbc.Row(
+                                dbc.Col(
+                                    "",
+                                    id='histogram-graph-info',
+                                    width='auto'
+                                ),
+                                justify='center'
+                            )
+                        ])
+                    ]
+                ), label="Distribution", tab_id='distribution-tab'),
+                dbc.Tab(dbc.Container([
+                    FullRedrawGraph(app, ms, 'spectrum-graph', "Power spectral density of the raw data", functools.partial(spectrum_graph_func, ms),
+                        fig_func_output=[Output('spectrum-graph', 'figure'), Output('spectrum-graph-info', 'children')],
+                        additional_controls=[
+                            dbc.Row(
+                                dbc.Col(
+                                    "The spectral analysis is off, run the server with --spectrum to turn it on." if not ms.spectrum_segment_length else "",
+                                    id='spectrum-graph-info',
+                                    width='auto'
+                                ),
+                                justify='center'
+                            )
+                        ])
+                    ]
+                ), label="Spectrum", tab_id='spectrum-tab'),
                 dbc.Tab(dbc.Container([
                     html.H3("System overview"),
                     html.P("""
@@ -356,6 +632,11 @@ def get_app(ms : MachineState) -> dash.Dash:
                         Lastly, there are also the Averaged peak voltages, those are calculated from Peak voltages by averaging a set amount of them, this is done to reduce noise.
                         The Average count parameter sets how many peak voltages should be averaged.
                     """),
+                    html.P("""
+                        The parameters can also be changed during the acquisition with the "Apply to the running acquisition" button, the acquisition keeps running and keeps saving to the same file.
+                        The new parameters are used from the next section transition and the averaging starts over from there, the first peak voltage after the change is skipped as its sections were found with the old parameters.
+                        Every change is saved in hdf5 files along with the sample at which it happened.
+                    """),
                     html.H3("Graph controls and info"),
                     html.P("""
                         Both graphs have two options.
@@ -366,22 +647,59 @@ def get_app(ms : MachineState) -> dash.Dash:
                         When switch Show graph off, it automatically switches Update graph off too.
                         When you plan to let the acquisition run for a longer time it is strongly recommended to switch Show graph off for graphs of all data, otherwise they might cause issues.
                     """),
+                    html.H3("History"),
+                    html.P("""
+                        The History tab shows the runs saved as hdf5 files in the log directory.
+                        When a run is opened for the first time an overview of it is made, this can take a while for long runs but afterwards it is cached.
+                        The graph only loads as much detail as is needed for the current zoom, when zoomed out the shaded area shows the minimum and maximum and the line is the mean.
+                        Zoom in on the graph to see more detail, double click it to zoom out.
+                        Runs which are still being recorded can not be opened.
+                    """),
+                    html.P("""
+                        Under the graph, Summarise runs shows a table with the duration, peak rate, peak voltage statistics, irregular data and gaps of every saved run, it can also be downloaded as csv.
+                        The summaries are remembered so only new runs take time.
+                        Selecting multiple runs in the box below overlays them in one graph (by the time since their start) so they can be compared.
+                    """),
                     html.P("""
                         On the live graph there are two extra things.
                         First you can set how much data it will show and secondly, once it's running it will tell you how many Peak voltages it gets per second (in that interval).
                         The Peaks per second display can be very useful to find the right value for Edge detection threshold.
+                        After the interval is made longer, the average only covers the new data until the whole interval has passed.
+                    """),
+                    html.P("""
+                        While an acquisition runs, a watchdog checks that the samples keep coming at the sampling rate.
+                        When they stop coming for a while, when some are missing (usually because the device buffer overflowed) or when the sampling clock drifts from the computer clock, a red warning is shown under the live graph for a minute.
+                        The times of the data are corrected after every such problem, the corrections and the problems are saved in hdf5 files.
+                    """),
+                    html.P("""
+                        The Distribution tab shows the histogram of the peak voltages, either of the whole run or of the current window which restarts every few seconds (if the controller set it with the "Set" button, it is the same for everyone).
+                        The bins are set from the first peak voltages and are made wider when a peak voltage doesn't fit.
+                        The histogram of the whole run is saved with the run in hdf5 files.
+                    """),
+                    html.P("""
+                        When the server is run with the spectrum option, the Spectrum tab shows the power spectral density of the raw data (by Welch's method), which helps to find electrical noise.
+                        The current spectrum is averaged over the last few segments, the average over the whole run is shown too and saved with the run in hdf5 files.
+                    """),
+                    html.P("""
+                        Most of the raw data is the baseline between the pulses, so instead of all of it only the raw data around the pulses can be saved in hdf5 files.
+                        By default a few samples before and after every peak voltage are saved, the server options can change how many and trigger on the raw data level or slope instead.
+                    """),
+                    html.P("""
+                        When the server is run with more channels, the graphs and the histogram show the peak voltages of every channel, the extra channels are marked by their name (like "ai1").
+                        The NI-6002 shares its sampling rate between the channels, so with two channels each of them is sampled at 25 kHz.
+                        In hdf5 files the first channel is saved like a single one and the other channels are saved in groups named after them.
                     """)],
                     className='mt-3'
                 ), label="Help", tab_id='help-tab')
             ], id='main-tabs')
         ]),
         dbc.Container(id='graphs', children=[
-            ExtendableGraph(app, ms, 'full-graph', "All data from this measurement", full_graph_base_fig, full_graph_extend,
+            ExtendableGraph(app, ms, 'full-graph', "All data from this measurement", full_graph_base_fig, functools.partial(full_graph_extend, ms),
                 extend_func_output=[Output('full-graph', 'extendData'), Output('full-graph-indices', 'data')],
                 extend_func_state=[State('full-graph-indices', 'data')]),
-            FullRedrawGraph(app, ms, 'live-graph', "Data from the last few seconds", live_graph_func,
+            FullRedrawGraph(app, ms, 'live-graph', "Data from the last few seconds", functools.partial(live_graph_func, ms),
                 fig_func_output=[Output('live-graph', 'figure'), Output('live-graph-average', 'children'),
-                    Output('live-graph-count', 'children')],
+                    Output('live-graph-count', 'children'), Output('live-graph-watchdog', 'children')],
                 fig_func_state=[State('live-graph-T', 'value')],
                 additional_controls=[
                     dbc.Row([
@@ -414,6 +732,15 @@ def get_app(ms : MachineState) -> dash.Dash:
                             width='auto'
                         )],
                         justify='center'
+                    ),
+                    dbc.Row([
+                        dbc.Col(
+                            "",
+                            id='live-graph-watchdog',
+                            className='text-danger',
+                            width='auto'
+                        )],
+                        justify='center'
                     )
                 ])
         ]),
@@ -494,6 +821,56 @@ def get_app(ms : MachineState) -> dash.Dash:
             infobox.append(dbc.Button("Force release?", id='ad-force_release', color='danger', className='ml-3 mr-3'))
             return [True, True, True, True, infobox, 'administration-tab']
 
+    @app.callback(Output('ad-callback-stats', 'children'), [
+            Input('ad-callback-stats-show', 'n_clicks'),
+            Input('ad-callback-stats-reset', 'n_clicks')
+        ])
+    def show_callback_stats(show_ncl, reset_ncl):
+        """Shows a table with the statistics of all callbacks, sorted by their 95th percentile latency"""
+        if not (show_ncl or reset_ncl):
+            raise PreventUpdate()
+        if dash.callback_context.triggered[0]['prop_id'].startswith('ad-callback-stats-reset'):
+            callback_stats.reset()
+            return "The callback statistics have been reset."
+        def fmt(x):
+            return "" if x is None else "{:.4g}".format(x)
+        records = sorted(callback_stats.summary()['callbacks'].values(),
+                key=lambda x: x['latency_ms'].get('p95', 0), reverse=True)
+        header = ["Callback", "Output", "Calls", "Prevented", "Errors", "p50 [ms]", "p95 [ms]", "p99 [ms]",
+                "Request p95 [ms]", "Mean size [B]", "Max size [B]"]
+        rows = [html.Tr([
+                html.Td(x['function']), html.Td(x['output']), html.Td(x['calls']), html.Td(x['prevented']), html.Td(x['errors']),
+                html.Td(fmt(x['latency_ms'].get('p50'))), html.Td(fmt(x['latency_ms'].get('p95'))), html.Td(fmt(x['latency_ms'].get('p99'))),
+                html.Td(fmt(x['request_latency_ms'].get('p95'))), html.Td(fmt(x['response_bytes'].get('mean'))),
+                html.Td(fmt(x['response_bytes'].get('max')))
+            ]) for x in records]
+        return dbc.Table([html.Thead(html.Tr([html.Th(x) for x in header])), html.Tbody(rows)],
+                size='sm', bordered=True, className='mt-1')
+
+    def start_sampling_profiler(duration):
+        """
+        Starts the sampling profiler of `ms` for `duration` seconds, returns the urls
+        of the files the results will be in or None if it is already running.
+        """
+        profiler = ms.start_sampling_profiler(duration)
+        if not profiler:
+            return None
+        return ['/logs/' + os.path.basename(profiler.pstats_filename), '/logs/' + os.path.basename(profiler.collapsed_filename)]
+
+    @app.callback(Output('ad-sampling-profiler-info', 'children'), [Input('ad-sampling-profiler-start', 'n_clicks')],
+            [State('ad-sampling-profiler-duration', 'value')])
+    def sampling_profiler_button(n_clicks, duration):
+        """Handles the "Start sampling profiler" button"""
+        if not n_clicks:
+            raise PreventUpdate()
+        if not duration or duration <= 0:
+            return "The duration has to be a positive number of seconds."
+        urls = start_sampling_profiler(min(duration, 600))
+        if not urls:
+            return "The sampling profiler is already running."
+        return ["The sampling profiler is running, after " + str(duration) + " s the results will be in ",
+                html.A("pstats", href=urls[0]), " and ", html.A("collapsed stacks (for flame graphs)", href=urls[1]), "."]
+
     @app.callback(Output('ut-fake-output', 'children'), [Input('ad-delete-logs', 'n_clicks')])
     def deleter_logs(n_clicks):
         if n_clicks:
@@ -596,16 +973,17 @@ def get_app(ms : MachineState) -> dash.Dash:
                     edge_detection_threshold=edge_detection_threshold, average_count=average_count, items=save_items,
                     correction_func=linear_correct_func(correction_a, correction_b))
             if should_save:
-                out = ["", True, False, True, True]
+                out = ["", True, False, True, False]
                 if ms.saver:
                     out.append("Started acquiring and saving to file \"" + ms.saver.full_filename + "\"")
                 elif should_save:
                     out.append("Acquiring has started but there has been an error with saving the data")
             else:
-                out = ["", True, False, True, True, "Acquisition has started successfully"]
+                out = ["", True, False, True, False, "Acquisition has started successfully"]
         elif prop_id.startswith('cp-stop'):
-            ms.stop_experiment()
-            msgbox = ["The Acquisition has been successfully stopped."]
+            timings = ms.stop_experiment()
+            msgbox = ["The Acquisition has been successfully stopped" +
+                (" in " + format(timings['total'], '.2f') + " seconds." if timings else ".")]
             if ms.data:
                 if ms.saver:
                     msgbox.append(html.A(
@@ -617,6 +995,52 @@ def get_app(ms : MachineState) -> dash.Dash:
             raise PreventUpdate()
         return out + [""]
 
+    @app.callback(Output('cp-da-apply-messagebox', 'children'), [Input('cp-da-apply', 'n_clicks')], [
+            State('session-id', 'data'),
+            State('cp-da-edge_detection_threshold', 'value'),
+            State('cp-da-average_count', 'value'),
+            State('cp-da-correction_a', 'value'),
+            State('cp-da-correction_b', 'value')
+        ])
+    def apply_parameters(n_clicks, sid, edge_detection_threshold, average_count, correction_a, correction_b):
+        """
+        Handles the "Apply to the running acquisition" button, it changes the processing parameters of the running
+        acquisition without stopping it (see `PINSoftware.DataAnalyser.DataAnalyser.reconfigure`).
+        """
+        if not n_clicks:
+            raise PreventUpdate()
+        if sid != ms.controller:
+            return "Only the controller can change the processing parameters."
+        if not ms.experiment_running:
+            return "No acquisition is running, the parameters will be used when it is started."
+        if None in [edge_detection_threshold, average_count, correction_a, correction_b] or average_count < 1:
+            return "Some of the parameters are not valid, nothing was changed."
+        ms.data.reconfigure(edge_detection_threshold=edge_detection_threshold, average_count=int(average_count),
+            correction_a=correction_a, correction_b=correction_b)
+        return "The new parameters are used from the next section transition."
+
+    @app.callback(Output('histogram-graph-reset-messagebox', 'children'), [Input('histogram-graph-reset-set', 'n_clicks')], [
+            State('session-id', 'data'),
+            State('histogram-graph-reset', 'value')
+        ])
+    def set_histogram_reset_interval(n_clicks, sid, reset_interval):
+        """
+        Handles the "Set" button of the Distribution tab, it changes how often the window of the peak voltage histograms
+        of the running acquisition restarts (an empty field means never). The histograms are shared by all the clients,
+        so only the controller can do this.
+        """
+        if not n_clicks:
+            raise PreventUpdate()
+        if sid != ms.controller:
+            return "Only the controller can change how often the window restarts."
+        if not ms.data or not ms.data.histogram:
+            return "There is no histogram to change."
+        for channel in get_channels(ms):
+            channel.histogram.set_reset_interval(reset_interval or None)
+        if reset_interval:
+            return "The window now restarts every " + format(reset_interval, 'g') + " s."
+        return "The window now never restarts."
+
     @app.callback([
             Output('cp-save-base_filename-row', 'style'),
             Output('cp-save-select_ft-row', 'style'),
@@ -693,17 +1117,179 @@ def get_app(ms : MachineState) -> dash.Dash:
         ])
     def save_config(edt, ca, cb, ac, not_used):
         """Sets the href on the download link to the new value whenever the parameters change."""
-        config = 'edge_detection_threshold=' + str(edt) + '\n' + 'correction_a=' + str(ca) + '\n' + 'correction_b=' + str(cb) + '\n' + 'average_count=' + str(ac) + '\n'
+        config = get_config_string(edt, ca, cb, ac)
         return 'data:text/csv;charset=utf-8,' + urllib.parse.quote(config),
 
+    history_pyramids = {}
+    history_pyramid_locks = collections.defaultdict(threading.Lock)
+    history_pyramids_lock = threading.Lock()
+
+    def get_history_pyramid(filename : str) -> OverviewPyramid:
+        """
+        Returns the `PINSoftware.OverviewPyramid.OverviewPyramid` for the saved run `filename` (a name in the
+        log directory). The pyramids are kept open and are reopened when the file changes.
+
+        The callbacks run in multiple threads, so every file has its own lock and only one thread at a time
+        builds its pyramid (they would all write the same sidecar file). A replaced pyramid isn't closed as
+        other threads may still be reading it, it gets closed when it is garbage collected.
+        """
+        full_filename = os.path.join(ms.log_directory, os.path.basename(filename))
+        with history_pyramids_lock:
+            lock = history_pyramid_locks[full_filename]
+        with lock:
+            pyramid = history_pyramids.get(full_filename)
+            if not pyramid or pyramid.source_mtime != os.path.getmtime(full_filename):
+                pyramid = OverviewPyramid(full_filename, os.path.join(ms.log_directory, '.pyramids'))
+                history_pyramids[full_filename] = pyramid
+        return pyramid
+
+    @app.callback([
+            Output('hi-file', 'options'),
+            Output('hi-compare-files', 'options')
+        ], [Input('main-tabs', 'active_tab')])
+    def history_list_runs(active_tab):
+        """Refreshes the lists of saved runs whenever the History tab is opened"""
+        if active_tab != 'history-tab':
+            raise PreventUpdate()
+        files = sorted(x for x in os.listdir(ms.log_directory)
+                if x.endswith('.hdf5') and os.path.isfile(os.path.join(ms.log_directory, x)))
+        options = [{'label': x, 'value': x} for x in files]
+        return [options, options]
+
+    @app.callback([
+            Output('hi-series', 'options'),
+            Output('hi-series', 'value'),
+        ], [Input('hi-file', 'value')])
+    def history_open_run(filename):
+        """Opens the selected run (building its pyramid if it wasn't opened before) and lists its data"""
+        if not filename:
+            raise PreventUpdate()
+        try:
+            pyramid = get_history_pyramid(filename)
+        except OSError:
+            return [[], None]
+        names = {'ys': "Raw data", 'processed_ys': "Peak voltages", 'averaged_processed_ys': "Averaged peak voltages",
+                'markers': "Debug markers"}
+        options = [{'label': names[series], 'value': series} for series in pyramid.series]
+        if 'processed_ys' in pyramid.series:
+            return [options, 'processed_ys']
+        return [options, pyramid.series[0] if pyramid.series else None]
+
+    @app.callback([
+            Output('hi-graph', 'figure'),
+            Output('hi-info', 'children')
+        ], [
+            Input('hi-series', 'value'),
+            Input('hi-graph', 'relayoutData')
+        ], [State('hi-file', 'value')])
+    def history_graph(series, relayout, filename):
+        """
+        Draws the history graph. Whenever the graph is zoomed, only the data in view is loaded
+        from the appropriate level of the pyramid.
+        """
+        if not filename:
+            raise PreventUpdate()
+        try:
+            pyramid = get_history_pyramid(filename)
+        except OSError:
+            return [{'data': []}, "The run could not be opened, it may still be being recorded."]
+        if series not in pyramid.series:
+            return [{'data': []}, "There is no data in this run."]
+        prop_id = dash.callback_context.triggered[0]['prop_id']
+        x_start, x_stop = None, None
+        if prop_id.startswith('hi-graph') and relayout and 'xaxis.range[0]' in relayout:
+            x_start = float(relayout['xaxis.range[0]'] * pyramid.freq)
+            x_stop = float(relayout['xaxis.range[1]'] * pyramid.freq)
+        elif prop_id.startswith('hi-graph') and not (relayout and 'xaxis.autorange' in relayout):
+            raise PreventUpdate()
+
+        result = pyramid.get(series, x_start, x_stop)
+        xs = (result['x'] / pyramid.freq).tolist()
+        if result['level'] == 0:
+            data = [{'x': xs, 'y': result['mean'].tolist(), 'type': 'scattergl', 'mode': 'lines+markers', 'name': series}]
+        else:
+            data = [
+                {'x': xs, 'y': result['min'].tolist(), 'type': 'scatter', 'mode': 'lines', 'line': {'width': 0},
+                    'showlegend': False, 'name': 'min'},
+                {'x': xs, 'y': result['max'].tolist(), 'type': 'scatter', 'mode': 'lines', 'line': {'width': 0},
+                    'fill': 'tonexty', 'name': 'min - max'},
+                {'x': xs, 'y': result['mean'].tolist(), 'type': 'scatter', 'mode': 'lines', 'name': 'mean'}
+            ]
+        layout = {'uirevision': filename + series, 'xaxis': {'title': 'Time since start [s]'}}
+        if x_start is not None:
+            layout['xaxis']['range'] = [x_start / pyramid.freq, x_stop / pyramid.freq]
+        info = "Showing " + str(len(xs)) + " points" + (" (overview level " + str(result['level']) + ")" if result['level'] else "")
+        return [{'data': data, 'layout': layout}, info]
+
+    run_summaries = RunSummaryCache(os.path.join(ms.log_directory, '.summaries', 'runs.json'))
+
+    @app.callback(Output('hi-summary', 'children'), [Input('hi-summary-show', 'n_clicks')])
+    def history_summary(n_clicks):
+        """Shows the table of the summaries of all saved runs, see `PINSoftware.RunSummary`"""
+        if not n_clicks:
+            raise PreventUpdate()
+        def fmt(x):
+            return "" if x is None else "{:.4g}".format(x)
+        summaries = run_summaries.summarise_directory(ms.log_directory)
+        if not summaries:
+            return "There are no saved hdf5 runs."
+        header = ["Run", "Start", "Duration [s]", "Peaks", "Peak rate [1/s]", "Mean [V]", "Std [V]", "p5 [V]", "p50 [V]",
+                "p95 [V]", "Irregular", "Gaps", "EDT [V]", "Avg count"]
+        rows = [html.Tr([
+                html.Td(x['filename']), html.Td(x.get('start') or ""), html.Td(fmt(x.get('duration'))), html.Td(fmt(x.get('peaks'))),
+                html.Td(fmt(x.get('peak_rate'))), html.Td(fmt(x.get('mean'))), html.Td(fmt(x.get('std'))), html.Td(fmt(x.get('p5'))),
+                html.Td(fmt(x.get('p50'))), html.Td(fmt(x.get('p95'))),
+                html.Td("" if x.get('irregular_fraction') is None else "{:.2%}".format(x['irregular_fraction'])),
+                html.Td(fmt(x.get('gaps'))), html.Td(fmt(x.get('edge_detection_threshold'))), html.Td(fmt(x.get('average_count')))
+            ] if not x.get('error') else [html.Td(x['filename']), html.Td("Could not be read: " + x['error'], colSpan=len(header) - 1)])
+            for x in summaries]
+        return dbc.Table([html.Thead(html.Tr([html.Th(x) for x in header])), html.Tbody(rows)],
+                size='sm', bordered=True, className='mt-1')
+
+    @app.callback(Output('hi-compare-graph', 'figure'), [
+            Input('hi-compare-files', 'value'),
+            Input('hi-compare-series', 'value')
+        ])
+    def history_compare(filenames, series):
+        """Overlays the selected runs, each one decimated by its `PINSoftware.OverviewPyramid.OverviewPyramid`"""
+        if not filenames:
+            return {'data': []}
+        data = []
+        for filename in filenames:
+            try:
+                pyramid = get_history_pyramid(filename)
+            except OSError:
+                continue
+            if series not in pyramid.series:
+                continue
+            result = pyramid.get(series, max_points=2000)
+            data.append({'x': (result['x'] / pyramid.freq).tolist(), 'y': result['mean'].tolist(), 'type': 'scatter',
+                    'mode': 'lines', 'name': filename})
+        layout = {'uirevision': series, 'xaxis': {'title': 'Time since start [s]'}, 'legend': {'orientation': 'h'}}
+        return {'data': data, 'layout': layout}
+
+    @app.server.route('/runs/summary.csv')
+    def get_run_summaries():
+        """Returns the summaries of all saved runs as csv"""
+        return flask.Response(summaries_to_csv(run_summaries.summarise_directory(ms.log_directory)), mimetype='text/csv',
+                headers={'Content-Disposition': 'attachment; filename="summary.csv"'})
+
     logs_page_template = """
         <ul>
             {% for file in files %}
             <li>
                 <a href="{{ file }}">{{ file }}</a>
+                {% if file.endswith('.hdf5') %}
+                (export <a href="/export/{{ file }}?dataset=processed_ys&format=csv">peak voltages as csv</a>,
+                <a href="/export/{{ file }}?dataset=ys&format=npy">raw data as npy</a>)
+                {% endif %}
             </li>
             {% endfor %}
         </ul>
+        <p>
+            Parts of hdf5 files can be exported at /export/&lt;file&gt;?dataset=&lt;dataset&gt;&amp;start=&lt;start&gt;&amp;stop=&lt;stop&gt;&amp;step=&lt;step&gt;&amp;format=&lt;csv|npy&gt;,
+            where start, stop and step select the values as in dataset[start:stop:step].
+        </p>
     """
 
     @app.server.route('/logs/')
@@ -721,4 +1307,121 @@ def get_app(ms : MachineState) -> dash.Dash:
         result = flask.send_from_directory(ms.log_directory, path)
         return result
 
+    @app.server.route('/stats/callbacks')
+    def get_callback_stats():
+        """Returns the callback statistics (see `PINSoftware.CallbackStats`) as JSON"""
+        return flask.Response(json.dumps(callback_stats.summary()), mimetype='application/json')
+
+    @app.server.route('/stats/peaks')
+    def get_peak_stats():
+        """
+        Returns the rolling statistics of the peak voltages of the current (or last) run (see `PINSoftware.RollingStats`)
+        as JSON, the "window" query parameter selects a single window.
+        """
+        if not ms.data or not ms.data.stats:
+            flask.abort(404, "There is no run.")
+        window = flask.request.args.get('window')
+        if window is None:
+            summary = ms.data.stats.summary(len(ms.data.ys))
+        elif window in ms.data.stats.windows:
+            summary = ms.data.stats.window_summary(window, len(ms.data.ys))
+        else:
+            flask.abort(404, "There is no window \"" + window + "\".")
+        return flask.Response(json.dumps(summary), mimetype='application/json')
+
+    @app.server.route('/stats/memory')
+    def get_memory_stats():
+        """
+        Returns the memory usage as JSON (see `PINSoftware.MemoryStats`), the sizes of the series of the current (or last)
+        run, of the saver, the profilers, the log queue and the dash caches, and the resident memory of the process over
+        time, the "since" query parameter (a unix time) limits its history.
+        """
+        result = ms.memory_monitor.summary(flask.request.args.get('since', None, type=float))
+        result['analyser'] = analyser_sizes(ms.data) if ms.data else None
+        result['saver'] = saver_sizes(ms.saver) if ms.saver else None
+        result['profilers'] = {profiler.name: profiler_sizes(profiler) for profiler in
+            ([ms.du.profiler] if ms.du and ms.du.profiler else []) + [channel.irregular_data_prof for channel in get_channels(ms)]
+            } if ms.data else {}
+        result['log_queue'] = log_queue.qsize()
+        result['dash'] = {
+            'callback_records': len(callback_stats.records),
+            'history_pyramids': len(history_pyramids),
+            'run_summaries': len(run_summaries.entries)
+        }
+        return flask.Response(json.dumps(result, default=int), mimetype='application/json')
+
+    @app.server.route('/stats/memory/allocations', methods=['POST'])
+    def get_allocation_diff():
+        """
+        Returns the allocation sites which grew the most since the previous request as JSON (see
+        `PINSoftware.MemoryStats.MemoryMonitor.allocation_diff`), the first request starts tracing the allocations.
+        Tracing slows the whole program down, so only the current controller can do this, the "session" parameter
+        has to be their session id. The "top" and "key" parameters are the number of sites and how they are grouped
+        ("lineno", "filename" or "traceback"), "stop=1" stops the tracing instead. The tracing also stops by itself
+        some time after the last request (see `PINSoftware.MemoryStats.MemoryMonitor.trace_timeout`).
+        """
+        args = flask.request.values
+        if not ms.controller or args.get('session') != ms.controller:
+            flask.abort(403, "Only the current controller can trace the allocations.")
+        if args.get('stop', 0, type=int) == 1:
+            ms.memory_monitor.stop_tracing()
+            return flask.Response(json.dumps({'tracing': False}), mimetype='application/json')
+        key_type = args.get('key', 'lineno')
+        if key_type not in ['lineno', 'filename', 'traceback']:
+            flask.abort(400, "The key has to be one of: lineno, filename, traceback")
+        result = ms.memory_monitor.allocation_diff(args.get('top', 20, type=int), key_type)
+        result['tracing_stops_at'] = ms.memory_monitor.trace_deadline
+        return flask.Response(json.dumps(result), mimetype='application/json')
+
+    @app.server.route('/profile/sample')
+    def get_sampling_profile():
+        """
+        Starts the sampling profiler for the number of seconds given by the "seconds" query parameter
+        (10 by default) and returns the urls of the result files as JSON.
+        """
+        duration = flask.request.args.get('seconds', 10, type=float)
+        if not 0 < duration <= 600:
+            flask.abort(400, "The duration has to be between 0 and 600 seconds.")
+        urls = start_sampling_profiler(duration)
+        if not urls:
+            flask.abort(409, "The sampling profiler is already running.")
+        return flask.Response(json.dumps({'seconds': duration, 'pstats': urls[0], 'collapsed': urls[1]}),
+                mimetype='application/json')
+
+    @app.server.route('/metrics')
+    def get_metrics():
+        """Returns all the metrics (see `PINSoftware.Metrics`) in the Prometheus text format"""
+        return flask.Response(ms.metrics.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+    @app.server.route('/export/<path:path>')
+    def export_log(path):
+        """
+        This streams a part of a saved hdf5 log, see `PINSoftware.DataExporter`. The dataset, range,
+        decimation and format are given by the "dataset", "start", "stop", "step" and "format" query
+        parameters, "wall_time=1" makes the csv timestamps wall clock times. The data is read and sent in
+        chunks so even huge files are fine.
+        """
+        filename = os.path.realpath(os.path.join(ms.log_directory, path))
+        if (os.path.dirname(filename) != os.path.realpath(ms.log_directory)) or (not os.path.isfile(filename)):
+            flask.abort(404)
+        args = flask.request.args
+        fmt = args.get('format', 'csv')
+        if fmt not in export_formats:
+            flask.abort(400, "Unknown format, use one of: " + ", ".join(export_formats))
+        kwargs = {'wall_time': args.get('wall_time', 0, type=int) == 1} if fmt == 'csv' else {}
+        try:
+            chunks = export(filename, args.get('dataset', 'processed_ys'), fmt,
+                    start=args.get('start', 0, type=int), stop=args.get('stop', None, type=int),
+                    step=args.get('step', 1, type=int), **kwargs)
+            # The first chunk is taken here so that a wrong request ends with an error instead of an empty file
+            first = next(chunks)
+        except (ExportException, OSError) as e:
+            flask.abort(400, str(e))
+        download_name = os.path.splitext(os.path.basename(filename))[0] + "_" + args.get('dataset', 'processed_ys') + "." + fmt
+        return flask.Response(
+            itertools.chain([first], chunks),
+            mimetype='text/csv' if fmt == 'csv' else 'application/octet-stream',
+            headers={'Content-Disposition': 'attachment; filename="' + download_name + '"'}
+        )
+
     return app
@@ -1,4 +1,7 @@
+import bisect
 import datetime
+import threading
+import time
 
 from os import path
 
@@ -6,6 +9,9 @@ import numpy as np
 
 from PINSoftware.Debugger import Debugger
 from PINSoftware.Profiler import Profiler
+from PINSoftware.Metrics import MetricsRegistry
+from PINSoftware.RollingStats import RollingStats, default_windows
+from PINSoftware.StreamingHistogram import StreamingHistogram
 
 
 def remove_outliers(data):
@@ -13,6 +19,23 @@ def remove_outliers(data):
     s = np.std(data)
     return [e for e in data if (u - 2 * s <= e <= u + 2 * s)]
 
+def linear_correct_func(cor_a, cor_b):
+    """Get a linear function with `a` and `b` as its coefficients"""
+    return lambda x: cor_a * x + cor_b
+
+def get_config_string(edge_detection_threshold, correction_a, correction_b, average_count) -> str:
+    """Get the processing parameters in the `key=value` format of the config files the app can upload and download"""
+    return ('edge_detection_threshold=' + str(edge_detection_threshold) + '\n' + 'correction_a=' + str(correction_a) + '\n' +
+        'correction_b=' + str(correction_b) + '\n' + 'average_count=' + str(average_count) + '\n')
+
+def minmax_decimate(values : np.ndarray, bin_size : int):
+    """
+    Splits `values` into bins of `bin_size` consecutive values and returns two numpy arrays, the minimums
+    and the maximums of the bins. The values after the last whole bin are ignored.
+    """
+    bins = values[:len(values) // bin_size * bin_size].reshape(-1, bin_size)
+    return bins.min(axis=1), bins.max(axis=1)
+
 class DataAnalyser():
     """
     This class takes care of data analysis and storage.
@@ -31,11 +54,27 @@ class DataAnalyser():
     will be correctly scaled on the x axis. The problem is however that this assumes that the data comes at a
     precise frequency but the NI-6002 can offer that so it should be alright.
 
+    `DataAnalyser.stats` are the `PINSoftware.RollingStats.RollingStats` of the peak voltages, they are updated
+    with every new peak voltage so the current statistics can be read at any time without going through the lists.
+    The same way `DataAnalyser.histogram` is the `PINSoftware.StreamingHistogram.StreamingHistogram` of the peak voltages.
+
+    The processing parameters can be changed while the data is coming in with `DataAnalyser.reconfigure`, the new ones
+    are used from the next section transition (the sections found before are dropped, so the first peak voltage after
+    it is skipped) and every change is recorded in `DataAnalyser.parameter_changes`.
+
+    Because the data may not come at a precise frequency after all (the device buffer may overflow or the reads may
+    stall), there is also a table of time anchors, `DataAnalyser.time_anchor_indices` are indices into `DataAnalyser.ys`
+    and `DataAnalyser.time_anchor_times` are the wall clock times of those samples. The first one is added by
+    `DataAnalyser.on_start`, the rest by the `PINSoftware.Watchdog.Watchdog`. Use `DataAnalyser.sample_to_time` to get
+    the wall clock time of a sample.
+
     Once the `DataAnalyser.on_start` is called a profiler about irregular data is also started, each second
     it prints how many irregular data issues there were.
     """
     def __init__(self, data_frequency : int, plot_buffer_len : int = 200, debugger : Debugger = Debugger(),
-            edge_detection_threshold : float = 0.005, average_count : int = 50, correction_func=lambda x: x):
+            edge_detection_threshold : float = 0.005, average_count : int = 50, correction_func=lambda x: x,
+            metrics : MetricsRegistry = None, rolling_windows : list = default_windows, histogram_bins : int = 100,
+            histogram_range : tuple = None, histogram_reset_interval : float = None, channel_name : str = None):
         """
         `data_frequency` is the frequency of the incoming data, this is used for calculating real timestamps
         and is saved if hdf5 saving is enabled.
@@ -54,6 +93,17 @@ class DataAnalyser():
 
         `correction_func` is the function to run the peak voltages through before using them. This is
         to correct some systematic errors or do some calculations.
+
+        `metrics` is the `PINSoftware.Metrics.MetricsRegistry` to count the peaks and irregular data in (or None).
+
+        `rolling_windows` are the windows of `DataAnalyser.stats` (see `PINSoftware.RollingStats.default_windows`),
+        if it is None no rolling statistics are kept (`DataAnalyser.stats` is None).
+
+        `histogram_bins`, `histogram_range` and `histogram_reset_interval` are the number of bins, the (low, high)
+        range (None means auto-ranging) and the window restart interval in seconds (None means never) of
+        `DataAnalyser.histogram`, if `histogram_bins` is None no histogram is kept.
+
+        `channel_name` is the name of the input channel, it is only used in printouts (see `MultiChannelDataAnalyser`).
         """
         self.freq = data_frequency
         self.period = 1 / data_frequency
@@ -82,14 +132,53 @@ class DataAnalyser():
         self.average_running_sum = 0
         self.average_index = 0
 
-        self.irregular_data_prof = Profiler("Irregular data", start_delay=0)
+        self.parameters_lock = threading.Lock()
+        self.pending_parameters = None
+        self.pending_deadline = None
+        self.parameter_changes = []
+
+        self.time_anchor_indices = []
+        self.time_anchor_times = []
+
+        self.stats = RollingStats(data_frequency, rolling_windows) if rolling_windows is not None else None
+        if histogram_bins:
+            self.histogram = StreamingHistogram(data_frequency, histogram_bins, histogram_range, histogram_reset_interval)
+        else:
+            self.histogram = None
+
+        self.irregular_data_prof = Profiler("Irregular data" + (" " + channel_name if channel_name else ""), start_delay=0)
+        self.irregular_count = 0
+
+        if metrics:
+            self.peak_counter = metrics.counter("peaks_total", "Number of peak voltages found")
+            self.irregular_counter = metrics.counter("irregular_data_total", "Number of irregular data issues found")
+        else:
+            self.peak_counter = None
+            self.irregular_counter = None
 
         self.ready_to_plot = True
 
     def on_start(self):
-
+        self.add_time_anchor(len(self.ys), time.time())
         self.irregular_data_prof.start()
 
+    def add_time_anchor(self, index : int, wall_time : float):
+        """Records that the sample `index` of `DataAnalyser.ys` came at the wall clock time `wall_time` (a unix timestamp)"""
+        # The time goes first, so a reader which sees the index also sees its time
+        self.time_anchor_times.append(wall_time)
+        self.time_anchor_indices.append(index)
+
+    def sample_to_time(self, index : float) -> float:
+        """
+        Returns the wall clock time (a unix timestamp) of the sample `index` of `DataAnalyser.ys`, it is counted
+        from the last time anchor before it. Without anchors it is counted from the first peak voltage.
+        """
+        indices = self.time_anchor_indices
+        if not indices:
+            return self.first_processed_timestamp + index * self.period
+        i = max(bisect.bisect_right(indices, index) - 1, 0)
+        return self.time_anchor_times[i] + (index - indices[i]) * self.period
+
     def actual_append_first(self, new_processed_y):
         """
         This appends the new processed value, works on the averaged processed values and
@@ -100,6 +189,12 @@ class DataAnalyser():
         self.processed_ys.append(new_processed_y)
         self.first_processed_timestamp = datetime.datetime.now().timestamp()
         self.processed_timestamps.append(len(self.ys))
+        if self.peak_counter:
+            self.peak_counter.inc()
+        if self.stats:
+            self.stats.add(len(self.ys), new_processed_y)
+        if self.histogram:
+            self.histogram.add(len(self.ys), new_processed_y)
 
         self.average_running_sum += new_processed_y
         self.average_index += 1
@@ -114,6 +209,12 @@ class DataAnalyser():
         """
         self.processed_ys.append(new_processed_y)
         self.processed_timestamps.append(len(self.ys))
+        if self.peak_counter:
+            self.peak_counter.inc()
+        if self.stats:
+            self.stats.add(len(self.ys), new_processed_y)
+        if self.histogram:
+            self.histogram.add(len(self.ys), new_processed_y)
 
         self.average_running_sum += new_processed_y
         self.average_index += 1
@@ -157,12 +258,65 @@ class DataAnalyser():
                     # self.marker_timestamps.append(len(self.ys))
                     # self.debugger.warning("Irregular data, something may be wrong.")
                     self.irregular_data_prof.add_count()
+                    self.irregular_count += 1
+                    if self.irregular_counter:
+                        self.irregular_counter.inc()
 
             if len(self.last_up_section) > 0:
                 self.last_down_section = self.last_up_section
                 self.last_up_section = []
+            if self.pending_parameters is not None:
+                self.apply_parameters()
         else:
             self.last_up_section.append(new_y)
+            # Without any transitions (like with a threshold too high) the new parameters are applied after a second
+            if self.pending_parameters is not None and len(self.ys) >= self.pending_deadline:
+                self.apply_parameters()
+
+    def reconfigure(self, edge_detection_threshold : float = None, average_count : int = None,
+            correction_a : float = None, correction_b : float = None):
+        """
+        Changes the processing parameters of the running analysis, the ones which are None stay the same.
+        This is safe to call from other threads, the parameters are swapped together at the next section transition
+        (or after a second of data if there is none). The sections found with the old parameters are dropped then, so
+        no peak voltage is calculated from sections of both configurations, the first one after the change is skipped.
+        `correction_a` and `correction_b` are the coefficients of a new `linear_correct_func`, they must be given together.
+
+        The averaging restarts at the change, so no averaged peak voltage mixes peak voltages of both configurations,
+        the peak voltages since the last averaged one are left out of the averages.
+        """
+        if (correction_a is None) != (correction_b is None):
+            raise ValueError("correction_a and correction_b must be changed together")
+        parameters = {name: value for name, value in [('edge_detection_threshold', edge_detection_threshold),
+            ('average_count', average_count), ('correction_a', correction_a), ('correction_b', correction_b)] if value is not None}
+        if not parameters:
+            return
+        with self.parameters_lock:
+            if self.pending_parameters is None:
+                self.pending_deadline = len(self.ys) + self.freq
+                self.pending_parameters = parameters
+            else:
+                self.pending_parameters = dict(self.pending_parameters, **parameters)
+
+    def apply_parameters(self):
+        """Applies the parameters waiting from `DataAnalyser.reconfigure` and records the change"""
+        with self.parameters_lock:
+            parameters = self.pending_parameters
+            self.pending_parameters = None
+        if 'edge_detection_threshold' in parameters:
+            self.edge_detection_threshold = parameters['edge_detection_threshold']
+        if 'correction_a' in parameters:
+            self.correction_func = linear_correct_func(parameters['correction_a'], parameters['correction_b'])
+        if 'average_count' in parameters:
+            self.average_count = parameters['average_count']
+        self.average_running_sum = 0
+        self.average_index = 0
+        # The sections were found with the old threshold (the current one may even be cut in the middle)
+        self.last_up_section = []
+        self.last_down_section = []
+        self.parameter_changes.append((len(self.ys), parameters))
+        self.debugger.info("DataAnalyser: Processing parameters changed at sample " + str(len(self.ys)) + ": " +
+            ", ".join(name + "=" + str(value) for name, value in parameters.items()))
 
     def append(self, new_y):
         """
@@ -177,6 +331,11 @@ class DataAnalyser():
 
         self.ready_to_plot = True
 
+    def extend(self, new_ys):
+        """Appends all the values of `new_ys` one by one, see `DataAnalyser.append`"""
+        for new_y in new_ys:
+            self.append(new_y)
+
     def on_stop(self):
         self.irregular_data_prof.stop()
 
@@ -184,3 +343,61 @@ class DataAnalyser():
         """This is what plots the data on the raw data graph if graphing is enabled"""
         if self.ready_to_plot:
             plt.plot(self.ys[-self.plot_buffer_len:])
+
+class MultiChannelDataAnalyser():
+    """
+    This takes care of the data of several input channels (for example the xPIN diode and a reference diode). Each
+    channel has its own `DataAnalyser` in `MultiChannelDataAnalyser.channels` with its own processing state, new data
+    comes in blocks of all the channels which are split by numpy and each channel's part is processed by its analyser
+    in one go (the processing is pure python, so threads wouldn't run the channels at the same time anyway).
+
+    Everything else (`ys`, `processed_ys`, `stats`, ...) is taken from the first channel, so this can be used
+    wherever a single `DataAnalyser` is expected, only the parts which know about channels show the others.
+    """
+    def __init__(self, data_frequency : int, channel_count : int, channel_names : list = None,
+            metrics : MetricsRegistry = None, **kwargs):
+        """
+        `data_frequency` and `kwargs` are passed to the `DataAnalyser`s of the channels.
+
+        `channel_count` is the number of channels and `channel_names` are their names ("ai0", "ai1", ... by default).
+
+        `metrics` is passed to the first channel only, so the metrics keep counting the main signal.
+        """
+        self.channel_names = channel_names or ["ai" + str(i) for i in range(channel_count)]
+        self.channels = [DataAnalyser(data_frequency, metrics=metrics if i == 0 else None, channel_name=name, **kwargs)
+            for i, name in enumerate(self.channel_names)]
+
+    def __getattr__(self, name):
+        return getattr(self.channels[0], name)
+
+    def on_start(self):
+        for channel in self.channels:
+            channel.on_start()
+
+    def on_stop(self):
+        for channel in self.channels:
+            channel.on_stop()
+
+    def add_time_anchor(self, index : int, wall_time : float):
+        """Adds the time anchor to all the channels (they are sampled together), see `DataAnalyser.add_time_anchor`"""
+        for channel in self.channels:
+            channel.add_time_anchor(index, wall_time)
+
+    def reconfigure(self, **kwargs):
+        """Changes the processing parameters of all the channels, see `DataAnalyser.reconfigure`"""
+        for channel in self.channels:
+            channel.reconfigure(**kwargs)
+
+    def append(self, new_ys):
+        """Appends a single value of every channel, `new_ys` has one value per channel"""
+        for channel, new_y in zip(self.channels, new_ys):
+            channel.append(new_y)
+
+    def extend(self, new_ys):
+        """
+        Appends a block of values of all the channels, `new_ys` is a 2-D array (or a list of lists) with one
+        row per channel, like the NI-DAQmx reads return it.
+        """
+        block = np.asarray(new_ys, dtype='f8').reshape(len(self.channels), -1)
+        for channel, values in zip(self.channels, block):
+            channel.extend(values.tolist())
@@ -0,0 +1,163 @@
+"""
+This file has the functions for exporting parts of saved hdf5 files (the ones made by
+`PINSoftware.DataSaver.Hdf5DataSaver`). The exporters are generators which read the
+selected dataset in chunks and yield the encoded result piece by piece, so they can be
+used directly as a streamed `flask.Response` and the whole dataset is never loaded into memory.
+"""
+import io
+
+from typing import Iterator
+
+import h5py
+import numpy as np
+
+
+paired_timestamps = {
+    'processed_ys': 'processed_timestamps',
+    'averaged_processed_ys': 'averaged_processed_timestamps',
+    'markers': 'marker_timestamps',
+}
+"""Maps datasets to the dataset with their timestamps, datasets not in here use the sample index instead"""
+
+export_formats = ['csv', 'npy']
+"""The supported export formats"""
+
+
+class ExportException(Exception):
+    """Raised when the export request does not make sense for the file (bad dataset, range, format...)"""
+    pass
+
+
+def iter_chunks(dataset, start : int = 0, stop : int = None, step : int = 1, chunk_size : int = 2**16) -> Iterator:
+    """
+    Reads `dataset[start:stop:step]` in chunks of at most `chunk_size` output values and yields
+    tuples of the index of the first value in the chunk and the chunk itself (a numpy array).
+    `dataset` can be anything sliceable (an `h5py.Dataset`, a `numpy.ndarray`...).
+    """
+    if stop is None or stop > len(dataset):
+        stop = len(dataset)
+    span = chunk_size * step
+    for chunk_start in range(start, stop, span):
+        yield chunk_start, np.asarray(dataset[chunk_start:min(chunk_start + span, stop):step])
+
+
+def get_export_range(length : int, start : int = 0, stop : int = None, step : int = 1):
+    """
+    Validates and clamps the export range for a dataset of length `length`, returns
+    the new `start`, `stop` and `step`. Raises `ExportException` if it is invalid.
+    """
+    if stop is None or stop > length:
+        stop = length
+    if start < 0 or stop < 0:
+        raise ExportException("The range bounds have to be non-negative.")
+    if step < 1:
+        raise ExportException("The decimation step has to be at least 1.")
+    return min(start, stop), stop, step
+
+
+def get_timestamps(f, dataset : str):
+    """Returns the timestamps dataset paired with `dataset` in the hdf5 file `f`, None if there isn't one"""
+    name = paired_timestamps.get(dataset)
+    if name is None or name not in f:
+        return None
+    return f[name]
+
+
+def get_sample_times(f, indices) -> np.ndarray:
+    """
+    Returns the wall clock times (unix timestamps) of the raw data `indices` of the hdf5 file `f`, they are counted
+    from the last time anchor before each index like `PINSoftware.DataAnalyser.DataAnalyser.sample_to_time` does.
+    Returns None if the file has no time anchors (it was saved before they were added).
+    """
+    if "time_anchor_indices" not in f or len(f["time_anchor_indices"]) == 0:
+        return None
+    anchor_indices = np.asarray(f["time_anchor_indices"])
+    anchor_times = np.asarray(f["time_anchor_times"])[:len(anchor_indices)]
+    indices = np.asarray(indices, dtype='f8')
+    i = np.maximum(np.searchsorted(anchor_indices, indices, side='right') - 1, 0)
+    return anchor_times[i] + (indices - anchor_indices[i]) / f.attrs['freq']
+
+
+def open_export(filename : str, dataset : str):
+    """
+    Opens the hdf5 file `filename` and checks that `dataset` is in it. Returns the
+    `h5py.File` and raises `ExportException` if the dataset is missing.
+    """
+    f = h5py.File(filename, 'r')
+    if dataset not in f or not isinstance(f[dataset], h5py.Dataset):
+        f.close()
+        raise ExportException("The file does not have a dataset called \"" + dataset + "\".")
+    return f
+
+
+def export_csv(filename : str, dataset : str, start : int = 0, stop : int = None, step : int = 1,
+        chunk_size : int = 2**16, wall_time : bool = False) -> Iterator[bytes]:
+    """
+    Yields the selected part of `dataset` of the hdf5 file `filename` as a csv with two columns,
+    the timestamps and the values (the same format `PINSoftware.DataSaver.CsvDataSaver` uses).
+    For datasets which have a pair in `paired_timestamps` that dataset is used for the timestamps,
+    otherwise the index of the value in the dataset is used.
+
+    `start`, `stop` and `step` select which values to export, as in `dataset[start:stop:step]`,
+    so `step` works as decimation. `chunk_size` is how many values are read at once.
+
+    If `wall_time` is true, the timestamps are converted to wall clock times (unix timestamps) by `get_sample_times`,
+    this only works for the raw data and the datasets with timestamps.
+    """
+    f = open_export(filename, dataset)
+    try:
+        values = f[dataset]
+        start, stop, step = get_export_range(len(values), start, stop, step)
+        timestamps = get_timestamps(f, dataset)
+        if wall_time:
+            if timestamps is None and dataset != 'ys':
+                raise ExportException("The dataset \"" + dataset + "\" has no timestamps to convert to wall clock time.")
+            if get_sample_times(f, [0]) is None:
+                raise ExportException("The file has no time anchors to convert the timestamps to wall clock time.")
+        yield (("time," if wall_time else "timestamps,") + dataset + "\n").encode()
+        for chunk_start, chunk in iter_chunks(values, start, stop, step, chunk_size):
+            if timestamps is not None:
+                xs = np.asarray(timestamps[chunk_start:chunk_start + len(chunk) * step:step])
+            else:
+                xs = np.arange(chunk_start, chunk_start + len(chunk) * step, step)
+            if wall_time:
+                xs = get_sample_times(f, xs[:len(chunk)])
+            out = io.StringIO()
+            np.savetxt(out, np.column_stack((xs[:len(chunk)], chunk)), fmt=['%.17g', '%.9g'], delimiter=',')
+            yield out.getvalue().encode()
+    finally:
+        f.close()
+
+
+def export_npy(filename : str, dataset : str, start : int = 0, stop : int = None, step : int = 1,
+        chunk_size : int = 2**16) -> Iterator[bytes]:
+    """
+    Yields the selected part of `dataset` of the hdf5 file `filename` as a .npy file
+    (loadable with `numpy.load`). The header is written first as the final shape is known in
+    advance and the values follow in chunks. The arguments are the same as for `export_csv`.
+    """
+    f = open_export(filename, dataset)
+    try:
+        values = f[dataset]
+        start, stop, step = get_export_range(len(values), start, stop, step)
+        header = io.BytesIO()
+        np.lib.format.write_array_header_1_0(header, {
+                'descr': np.lib.format.dtype_to_descr(values.dtype),
+                'fortran_order': False,
+                'shape': (len(range(start, stop, step)),)
+            })
+        yield header.getvalue()
+        for chunk_start, chunk in iter_chunks(values, start, stop, step, chunk_size):
+            yield chunk.astype(values.dtype, copy=False).tobytes()
+    finally:
+        f.close()
+
+
+def export(filename : str, dataset : str, fmt : str = 'csv', **kwargs) -> Iterator[bytes]:
+    """Calls the exporter for format `fmt` (one of `export_formats`), `kwargs` are passed to it"""
+    if fmt == 'csv':
+        return export_csv(filename, dataset, **kwargs)
+    elif fmt == 'npy':
+        return export_npy(filename, dataset, **kwargs)
+    else:
+        raise ExportException("Unknown export format \"" + fmt + "\".")
@@ -6,6 +6,7 @@ whose instance runs in a separate thread and periodically checks the
 `PINSoftware.DataAnalyser.DataAnalyser` for new data and then saves it.
 """
 import datetime
+import os
 import threading
 import time
 
@@ -14,8 +15,14 @@ from enum import Enum
 from typing import List
 
 import h5py
+import numpy as np
 
 from PINSoftware.DataAnalyser import DataAnalyser
+from PINSoftware.Metrics import MetricsRegistry
+from PINSoftware.Profiler import Profiler
+from PINSoftware.Spectrum import SpectrumAnalyser
+from PINSoftware.TriggeredCapture import TriggeredCapture
+from PINSoftware.Watchdog import Watchdog
 
 
 class Filetype(Enum):
@@ -50,22 +57,38 @@ class BaseDataSaver(threading.Thread):
     should inherit from this class and override the `BaseDataSaver.do_single_save` method
     to something which does the saving action itself. It can also possibly override the
     `BaseDataSaver.close` method which is called on ending the saving (usually you may want
-    to close the file objects there).
+    to close the file objects there). The saving should be stopped only after no more data is added,
+    `BaseDataSaver.close` saves the rest of it.
     """
-    def __init__(self, data : DataAnalyser, full_filename : str, save_interval : float = 1):
+    def __init__(self, data : DataAnalyser, full_filename : str, save_interval : float = 1,
+            metrics : MetricsRegistry = None, profiler : Profiler = None, fsync : bool = False):
         """
         `data` is the `PINSoftware.DataAnalyser.DataAnalyser` from which the data should be saved.
 
         `full_filename` is the full path to the file where the data should be saved (with the extension).
 
         `save_interval` is the interval in which the `PINSoftware.DataSaver` should check for new data.
+
+        `metrics` is the `PINSoftware.Metrics.MetricsRegistry` to report the saving lag and times to (or None).
+
+        `profiler` is the `PINSoftware.Profiler.Profiler` to record the durations of saves in (or None).
+
+        `fsync` is whether the file should be synced to the disk when it is closed, so the data is on the disk
+        once the saver thread ends (otherwise it may still be in the operating system cache for a while).
         """
-        super().__init__()
-        self.should_stop = False
+        super().__init__(name="DataSaver")
+        self.stop_event = threading.Event()
+        self.fsync = fsync
+        self.close_duration = None
         self.data = data
         self.debugger = self.data.debugger
         self.full_filename = full_filename
         self.save_interval = save_interval
+        self.metrics = metrics
+        self.profiler = profiler
+        if metrics:
+            self.lag_gauge = metrics.gauge("saver_lag_values", "Number of values waiting to be saved at the start of the last save")
+            self.save_histogram = metrics.histogram("saver_save_duration_seconds", "Duration of single saves")
 
     def do_single_save(self):
         """
@@ -74,30 +97,54 @@ class BaseDataSaver(threading.Thread):
         """
         pass
 
+    def get_lag(self) -> int:
+        """This method may be overridden, it should return how many values are waiting to be saved"""
+        return 0
+
     def close(self):
         """This method may be overridden, it is called at the end of saving"""
         pass
-    
+
+    def sync_file(self, fd : int):
+        """Syncs the file with the descriptor `fd` to the disk if `BaseDataSaver.fsync` is set"""
+        if self.fsync:
+            os.fsync(fd)
+
     def run(self):
         """This method is called when `BaseDataSaver.start` is called, it is the main loop"""
         self.debugger.info("BaseDataSaver: Starting")
         next_call = time.time()
-        while not self.should_stop:
+        while not self.stop_event.is_set():
             next_call += self.save_interval
-            time.sleep(max(0, next_call - time.time()))
-            self.do_single_save()
+            if self.stop_event.wait(max(0, next_call - time.time())):
+                break
+            if self.metrics or self.profiler:
+                if self.metrics:
+                    self.lag_gauge.set(self.get_lag())
+                start = time.perf_counter_ns()
+                self.do_single_save()
+                duration = time.perf_counter_ns() - start
+                if self.metrics:
+                    self.save_histogram.observe_units(duration)
+                if self.profiler:
+                    self.profiler.record("do_single_save", duration)
+            else:
+                self.do_single_save()
+        start = time.perf_counter()
         self.close()
+        self.close_duration = time.perf_counter() - start
         self.debugger.info("BaseDataSaver: Stopped successfully")
 
     def stop(self):
-        """This is a simple setter, it is here to be analogous with the way the thread was started (`BaseDataSaver.start`)"""
-        self.should_stop = True
+        """Stops the saving, it stops waiting for the next save right away and closes the file"""
+        self.stop_event.set()
 
 class CsvDataSaver(BaseDataSaver):
     """
     This is a very simple `PINSoftware.DataSaver` with very few options. It saves the peak voltages
     (`PINSoftware.DataAnalyser.DataAnalyser.processed`) along with their timestamps in a csv file.
-    The csv file format doesn't allow for storing multiple unrelated data easily so this is all.
+    The csv file format doesn't allow for storing multiple unrelated data easily so this is all, with
+    multiple channels only the first one is saved.
     """
     def __init__(self, data : DataAnalyser, save_folder : str, save_base_filename : str, **kwargs):
         """
@@ -123,17 +170,44 @@ class CsvDataSaver(BaseDataSaver):
             self.csv_file.write(str(pro_times) + "," + str(pro_y) + "\n")
         self.index = new_index
 
+    def get_lag(self):
+        """."""
+        return len(self.data.processed_ys) - self.index
+
     def close(self):
         """."""
         self.do_single_save()
+        self.csv_file.flush()
+        self.sync_file(self.csv_file.fileno())
         self.csv_file.close()
 
 class Hdf5DataSaver(BaseDataSaver):
     """
-    This is the main saver, it can save all the data in an hdf5 file. The processing parameters are saved as
-    attributes. It it possible to choose what data is saved using the `items` argument.
+    This is the main saver, it can save all the data in an hdf5 file. The processing parameters (and the number
+    of irregular data issues so far) are saved as attributes. It it possible to choose what data is saved using the `items` argument.
+    When the saving ends, the histogram of the whole run (`PINSoftware.DataAnalyser.DataAnalyser.histogram`) is saved
+    as the "histogram_counts" and "histogram_edges" datasets and the average spectrum of the whole run (if there is
+    a `PINSoftware.Spectrum.SpectrumAnalyser`) as the "spectrum_psd" and "spectrum_frequencies" datasets.
+
+    With multiple channels (a `PINSoftware.DataAnalyser.MultiChannelDataAnalyser`) the datasets of the first channel are
+    at the top of the file like for a single channel, so everything which reads the files works the same, and the
+    datasets of every other channel are in a group named after the channel (like "ai1/processed_ys").
+
+    Instead of all the raw data, only the raw data around the pulses can be saved (the "triggered_ys" item, see
+    `PINSoftware.TriggeredCapture`). The captured windows are saved one after another in the "triggered_ys" dataset,
+    "triggered_offsets" has the raw data index of the first sample of every window and "triggered_lengths" their lengths.
+
+    The attributes have the processing parameters at the start, the changes during the run (see
+    `PINSoftware.DataAnalyser.DataAnalyser.reconfigure`) are saved in the "parameter_changes" dataset as the changed
+    parameters in the `key=value` format of the config files, "parameter_change_timestamps" has the raw data index of each change.
+
+    The time anchors (see `PINSoftware.DataAnalyser.DataAnalyser.sample_to_time`) are always saved, "time_anchor_indices"
+    are the raw data indices and "time_anchor_times" the wall clock times (unix timestamps) of those samples. When the
+    run had a `PINSoftware.Watchdog.Watchdog`, the problems it found are saved at the end in the "watchdog_events"
+    dataset as "kind: message" strings, "watchdog_event_timestamps" has the raw data index of each of them.
     """
-    def __init__(self, data : DataAnalyser, save_folder : str, save_base_filename : str, items : List[str], **kwargs):
+    def __init__(self, data : DataAnalyser, save_folder : str, save_base_filename : str, items : List[str],
+            spectrum : SpectrumAnalyser = None, trigger_kwargs : dict = {}, watchdog : Watchdog = None, **kwargs):
         """
         `data` and `kwargs` are passed to `BaseDataSaver`.
 
@@ -143,10 +217,19 @@ class Hdf5DataSaver(BaseDataSaver):
         `items` determine what data gets saved. It is a list of strings and if certain strings are in there,
         some data gets saved. If it contains "ys" raw data gets saved, "processed_ys" means peak voltages
         along with their timestamps, "averaged_processed_ys" means averaged peak voltages and their timestamps.
-        Finally "markers" means markers and their timestamps.
+        Finally "markers" means markers and their timestamps. "triggered_ys" means the raw data around the triggers.
+
+        `trigger_kwargs` are passed to the `PINSoftware.TriggeredCapture.TriggeredCapture`s of the "triggered_ys" item.
+
+        `spectrum` is the `PINSoftware.Spectrum.SpectrumAnalyser` of the run whose spectrum is saved at the end (or None).
+
+        `watchdog` is the `PINSoftware.Watchdog.Watchdog` of the run whose events are saved at the end (or None).
         """
         full_filename = path.join(save_folder, save_base_filename + datetime.datetime.now().strftime("%y%m%d-%H%M%S") + ".hdf5")
         super().__init__(data, full_filename, **kwargs)
+        self.spectrum = spectrum
+        self.trigger_kwargs = trigger_kwargs
+        self.watchdog = watchdog
         try:
             self.hdf_file = h5py.File(full_filename, 'w')
             self.debugger.info("Hdf5DataSaver: Successfully created hdf5 file \"" + full_filename + "\"")
@@ -158,35 +241,88 @@ class Hdf5DataSaver(BaseDataSaver):
             self.hdf_datasets = []
             self.indices = []
             self.data_sources = []
+            self.captures = []
+            self.parameter_change_datasets = []
 
-            if "ys" in items:
-                self.hdf_datasets.append(self.hdf_file.create_dataset("ys", (0,), chunks=True, maxshape=(None,), dtype='f4'))
+            self.channels = getattr(self.data, 'channels', [self.data])
+            self.groups = [self.hdf_file]
+            if len(self.channels) > 1:
+                self.hdf_file.attrs['channel_names'] = self.data.channel_names
+                self.groups += [self.hdf_file.create_group(name) for name in self.data.channel_names[1:]]
+            for group, channel in zip(self.groups, self.channels):
+                self.add_datasets(group, channel, items)
+            # The anchors are the same for all the channels
+            for name, dtype, source in [("time_anchor_indices", 'i8', self.data.time_anchor_indices),
+                    ("time_anchor_times", 'f8', self.data.time_anchor_times)]:
+                self.hdf_datasets.append(self.hdf_file.create_dataset(name, (0,), chunks=True, maxshape=(None,), dtype=dtype))
                 self.indices.append(0)
-                self.data_sources.append(self.data.ys)
-            if "processed_ys" in items:
-                self.hdf_datasets.append(self.hdf_file.create_dataset("processed_ys", (0,), chunks=True, maxshape=(None,), dtype='f4'))
-                self.hdf_datasets.append(self.hdf_file.create_dataset("processed_timestamps", (0,), chunks=True, maxshape=(None,), dtype='f8'))
-                self.indices.append(0)
-                self.indices.append(0)
-                self.data_sources.append(self.data.processed_ys)
-                self.data_sources.append(self.data.processed_timestamps)
-            if "averaged_processed_ys" in items:
-                self.hdf_datasets.append(self.hdf_file.create_dataset("averaged_processed_ys", (0,), chunks=True, maxshape=(None,), dtype='f4'))
-                self.hdf_datasets.append(self.hdf_file.create_dataset("averaged_processed_timestamps", (0,), chunks=True, maxshape=(None,), dtype='f8'))
-                self.indices.append(0)
-                self.indices.append(0)
-                self.data_sources.append(self.data.averaged_processed_ys)
-                self.data_sources.append(self.data.averaged_processed_timestamps)
-            if "markers" in items:
-                self.hdf_datasets.append(self.hdf_file.create_dataset("markers", (0,), chunks=True, maxshape=(None,), dtype='f4'))
-                self.hdf_datasets.append(self.hdf_file.create_dataset("marker_timestamps", (0,), chunks=True, maxshape=(None,), dtype='f8'))
-                self.indices.append(0)
-                self.indices.append(0)
-                self.data_sources.append(self.data.markers)
-                self.data_sources.append(self.data.marker_timestamps)
+                self.data_sources.append(source)
         except:
             raise SavingException("Could not open file \"" + full_filename + "\" to log data in.")
 
+    def add_datasets(self, group : h5py.Group, channel : DataAnalyser, items : List[str]):
+        """Creates the datasets selected by `items` for the data of `channel` in `group`"""
+        sources = []
+        if "ys" in items:
+            sources.append(("ys", 'f4', channel.ys))
+        if "processed_ys" in items:
+            sources.append(("processed_ys", 'f4', channel.processed_ys))
+            sources.append(("processed_timestamps", 'f8', channel.processed_timestamps))
+        if "averaged_processed_ys" in items:
+            sources.append(("averaged_processed_ys", 'f4', channel.averaged_processed_ys))
+            sources.append(("averaged_processed_timestamps", 'f8', channel.averaged_processed_timestamps))
+        if "markers" in items:
+            sources.append(("markers", 'f4', channel.markers))
+            sources.append(("marker_timestamps", 'f8', channel.marker_timestamps))
+        for name, dtype, source in sources:
+            self.hdf_datasets.append(group.create_dataset(name, (0,), chunks=True, maxshape=(None,), dtype=dtype))
+            self.indices.append(0)
+            self.data_sources.append(source)
+        self.parameter_change_datasets.append((
+            group.create_dataset("parameter_change_timestamps", (0,), chunks=True, maxshape=(None,), dtype='i8'),
+            group.create_dataset("parameter_changes", (0,), chunks=True, maxshape=(None,), dtype=h5py.string_dtype())))
+        if "triggered_ys" in items:
+            capture = TriggeredCapture(**self.trigger_kwargs)
+            datasets = [group.create_dataset(name, (0,), chunks=True, maxshape=(None,), dtype=dtype)
+                for name, dtype in [("triggered_ys", 'f4'), ("triggered_offsets", 'i8'), ("triggered_lengths", 'i8')]]
+            datasets[0].attrs['mode'] = capture.mode
+            datasets[0].attrs['pre_samples'] = capture.pre_samples
+            datasets[0].attrs['post_samples'] = capture.post_samples
+            if capture.threshold is not None:
+                datasets[0].attrs['threshold'] = capture.threshold
+            self.captures.append({'channel': channel, 'capture': capture, 'datasets': datasets, 'peak_index': 0})
+
+    def save_captured(self, capture : dict):
+        """Passes the new raw data of a channel through its `PINSoftware.TriggeredCapture.TriggeredCapture` and saves the captured chunks"""
+        channel = capture['channel']
+        # The raw data length is read first, so every peak found in it is among the peaks read after
+        new_index = len(channel.ys)
+        peak_index = len(channel.processed_timestamps)
+        chunks = capture['capture'].process(channel.ys[capture['capture'].position:new_index],
+            channel.processed_timestamps[capture['peak_index']:peak_index])
+        capture['peak_index'] = peak_index
+        ys_dataset, offsets_dataset, lengths_dataset = capture['datasets']
+        ys_dataset.attrs['raw_length'] = new_index
+        if not chunks:
+            return
+        offsets = list(offsets_dataset[-1:])
+        lengths = list(lengths_dataset[-1:])
+        kept = len(offsets)
+        for offset, values in chunks:
+            # A chunk continuing the last window is a part of it
+            if offsets and offsets[-1] + lengths[-1] == offset:
+                lengths[-1] += len(values)
+            else:
+                offsets.append(offset)
+                lengths.append(len(values))
+        first = len(offsets_dataset) - kept
+        for dataset, values in [(offsets_dataset, offsets), (lengths_dataset, lengths)]:
+            dataset.resize((first + len(values),))
+            dataset[first:] = values
+        new_ys = np.concatenate([values for offset, values in chunks])
+        ys_dataset.resize((len(ys_dataset) + len(new_ys),))
+        ys_dataset[-len(new_ys):] = new_ys
+
     def do_single_save(self):
         """."""
         new_indices = [len(source) for source in self.data_sources]
@@ -194,7 +330,70 @@ class Hdf5DataSaver(BaseDataSaver):
             dataset.resize((new_index,))
             dataset[index:new_index] = source[index:new_index]
         self.indices = new_indices
+        for capture in self.captures:
+            self.save_captured(capture)
+        for channel, (timestamps_dataset, changes_dataset) in zip(self.channels, self.parameter_change_datasets):
+            index = len(timestamps_dataset)
+            new_changes = channel.parameter_changes[index:]
+            if new_changes:
+                for dataset in (timestamps_dataset, changes_dataset):
+                    dataset.resize((index + len(new_changes),))
+                timestamps_dataset[index:] = [timestamp for timestamp, parameters in new_changes]
+                changes_dataset[index:] = ["".join(name + "=" + str(value) + "\n" for name, value in parameters.items())
+                    for timestamp, parameters in new_changes]
+        for group, channel in zip(self.groups, self.channels):
+            group.attrs['irregular_count'] = channel.irregular_count
+
+    def get_lag(self):
+        """."""
+        return (sum(len(source) - index for source, index in zip(self.data_sources, self.indices)) +
+            sum(len(capture['channel'].ys) - capture['capture'].position for capture in self.captures))
+
+    def save_peak_histogram(self):
+        """Saves the histograms of the peak voltages of the whole run"""
+        for group, channel in zip(self.groups, self.channels):
+            if not channel.histogram:
+                continue
+            counts, edges = channel.histogram.get(total=True)
+            for name, values in [("histogram_counts", counts), ("histogram_edges", edges)]:
+                if name in group:
+                    del group[name]
+                group.create_dataset(name, data=values)
+            group["histogram_counts"].attrs['underflow'] = channel.histogram.underflow
+            group["histogram_counts"].attrs['overflow'] = channel.histogram.overflow
+
+    def save_spectrum(self):
+        """Saves the average spectrum of the whole run"""
+        if not self.spectrum:
+            return
+        frequencies, psd = self.spectrum.get(total=True)
+        if psd is None:
+            return
+        for name, values in [("spectrum_psd", psd), ("spectrum_frequencies", frequencies)]:
+            if name in self.hdf_file:
+                del self.hdf_file[name]
+            self.hdf_file.create_dataset(name, data=values)
+        self.hdf_file["spectrum_psd"].attrs['segment_length'] = self.spectrum.segment_length
+        self.hdf_file["spectrum_psd"].attrs['segments'] = self.spectrum.segments
+
+    def save_watchdog_events(self):
+        """Saves the problems found by the watchdog"""
+        if not self.watchdog:
+            return
+        events = list(self.watchdog.events)
+        self.hdf_file.create_dataset("watchdog_event_timestamps", data=np.array([count for wall, count, kind, message in events], dtype='i8'))
+        self.hdf_file.create_dataset("watchdog_events", data=[kind + ": " + message for wall, count, kind, message in events],
+            dtype=h5py.string_dtype())
+        self.hdf_file["watchdog_events"].attrs['lost_samples'] = self.watchdog.lost_samples
+        if self.watchdog.drift_ppm is not None:
+            self.hdf_file["watchdog_events"].attrs['drift_ppm'] = self.watchdog.drift_ppm
 
     def close(self):
         """."""
+        self.do_single_save()
+        self.save_peak_histogram()
+        self.save_spectrum()
+        self.save_watchdog_events()
+        self.hdf_file.flush()
+        self.sync_file(self.hdf_file.id.get_vfd_handle())
         self.hdf_file.close()
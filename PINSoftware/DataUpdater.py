@@ -2,11 +2,14 @@ import random
 import threading
 import time
 
-import nidaqmx
+import numpy as np
 
 from PINSoftware.Profiler import Profiler
 from PINSoftware.Debugger import Debugger
 from PINSoftware.DataAnalyser import DataAnalyser
+from PINSoftware.DAQTask import DAQTaskManager, READ_ALL_AVAILABLE
+from PINSoftware.Metrics import MetricsRegistry
+from PINSoftware.SyntheticData import PulseGenerator
 
 
 class BaseDataUpdater(threading.Thread):
@@ -14,19 +17,30 @@ class BaseDataUpdater(threading.Thread):
     Base class for `PINSoftware.DataUpdater.DataUpdater`s, it takes care of the profiler, stopping
     lays out the main loop (`BaseDataUpdater.run`) and so on. It provides a common interface.
     """
-    def __init__(self, data : DataAnalyser, debugger : Debugger = Debugger(), profiler : Profiler = None):
+    def __init__(self, data : DataAnalyser, debugger : Debugger = Debugger(), profiler : Profiler = None,
+            metrics : MetricsRegistry = None):
         """
         `data` is the `PINSoftware.DataAnalyser.DataAnalyser` to add the new data to.
 
         `debugger` is the `PINSoftware.Debugger.Debugger` to use for printouts.
 
         `profiler` is the `PINSoftware.Profiler.Profiler` to use (or None if a profiler should not be run).
+
+        `metrics` is the `PINSoftware.Metrics.MetricsRegistry` to count the acquired samples in (or None).
         """
-        super().__init__()
+        super().__init__(name="DataUpdater")
         self.should_stop = False
         self.data = data
+        # A `PINSoftware.DataAnalyser.MultiChannelDataAnalyser` gets the values of all its channels at once
+        self.channel_count = len(getattr(data, 'channels', [data]))
         self.debugger = debugger
         self.profiler = profiler
+        self.metrics = metrics
+        if metrics:
+            self.samples_counter = metrics.counter("samples_total", "Number of raw samples acquired")
+            self.reads_counter = metrics.counter("daq_reads_total", "Number of reads from the data source")
+            self.read_size_gauge = metrics.gauge("daq_read_size_samples",
+                "Samples returned by the last read, this is how many were queued in the device buffer")
 
     def on_start(self):
         """
@@ -42,6 +56,14 @@ class BaseDataUpdater(threading.Thread):
         """
         return 1
 
+    def drain(self) -> int:
+        """
+        This is called when the main loop ends, before the data analysis is stopped. This method is meant to be
+        overridden by sources which buffer the data, it should add the samples which are still waiting and return
+        how many there were, so they are analysed and saved too.
+        """
+        return 0
+
     def on_stop(self):
         """
         This is called when the `BaseDataUpdater.run` method is finishing. This method is meant to be
@@ -58,17 +80,31 @@ class BaseDataUpdater(threading.Thread):
         self.data.on_start()
         if self.profiler:
             self.profiler.start()
-            while not self.should_stop:
+        while not self.should_stop:
+            if self.profiler:
+                start = time.perf_counter_ns()
                 counts = self.loop()
-                self.profiler.add_count(counts)
+                self.profiler.record("loop", time.perf_counter_ns() - start)
+            else:
+                counts = self.loop()
+            self.add_counts(counts)
+        self.add_counts(self.drain())
+        if self.profiler:
             self.profiler.stop()
-        else:
-            while not self.should_stop:
-                self.loop()
         self.data.on_stop()
         self.on_stop()
         self.debugger.info("Stopping the DataUpdater")
 
+    def add_counts(self, counts : int):
+        """Adds the number of samples from a single read to the profiler and the metrics"""
+        if counts:
+            if self.profiler:
+                self.profiler.add_count(counts)
+            if self.metrics:
+                self.samples_counter.inc(counts)
+                self.reads_counter.inc()
+                self.read_size_gauge.set(counts)
+
     def stop(self):
         """Just a simple setter, it is here to be consistent with starting by calling `BaseDataUpdater.start`"""
         self.should_stop = True
@@ -82,7 +118,9 @@ class LoadedDataUpdater(BaseDataUpdater):
     def __init__(self, filename : str, *args, freq : int = 50000, **kwargs):
         """
         `filename` is the path to the file to read the data from. The file should be a text file with a number
-        on each line, those numbers are the ones added to the `PINSoftware.DataAnalyser.DataAnalyser`.
+        on each line, those numbers are the ones added to the `PINSoftware.DataAnalyser.DataAnalyser`. For
+        multiple channels the line has comma separated numbers, one for each channel, a line with a single
+        number is used for all the channels.
 
         `freq` is the frequency is the simulated source, it will add this many datapoints per second.
 
@@ -105,15 +143,20 @@ class LoadedDataUpdater(BaseDataUpdater):
         self.next_call = time.time()
 
     def loop(self):
+        line = self.file.readline()
+        if line == "":
+            self.debugger.warning("Reached end of file")
+            return 0
         try:
-            new_y = float(self.file.readline())
+            new_ys = [float(value) for value in line.split(",")]
         except ValueError:
-            if self.file.readline() == "":
-                self.debugger.warning("Reached end of file")
-                return
-        except:
+            # A bad line is skipped, the repeated warnings are limited by the `PINSoftware.Debugger`
             self.debugger.warning("Couldn't parse line")
-        self.data.append(new_y)
+            return 0
+        if self.channel_count == 1:
+            self.data.append(new_ys[0])
+        else:
+            self.data.append(new_ys * self.channel_count if len(new_ys) == 1 else new_ys)
         self.next_call += self.timedelta
         time.sleep(max(0, self.next_call - time.time()))
         return 1
@@ -122,39 +165,139 @@ class LoadedDataUpdater(BaseDataUpdater):
         self.file.close()
 
 
+class SyntheticDataUpdater(BaseDataUpdater):
+    """
+    This `PINSoftware.DataUpdater` is also for running without the hardware, but unlike `LoadedDataUpdater`
+    it behaves like the NI-6002. The data is generated by a `PINSoftware.SyntheticData.PulseGenerator`,
+    samples become available at `freq` per second by the wall clock and every loop reads all of the available
+    ones at once. The available samples wait in a simulated device buffer, if they are not read in time the
+    buffer overflows and the oldest samples are lost, they are counted in `SyntheticDataUpdater.dropped`.
+    This makes it possible to see how the acquisition holds up when the server is under load.
+
+    For multiple channels every channel has its own generator (with a different seed), the blocks of all the
+    channels are added at once like from `NiDAQmxDataUpdater`.
+    """
+    def __init__(self, *args, freq : int = 50000, buffer_size : int = 100000, read_interval : float = 0.001,
+            generator_kwargs : dict = {}, **kwargs):
+        """
+        `freq` is the frequency of the simulated source.
+
+        `buffer_size` is the size of the simulated device buffer in samples.
+
+        `read_interval` is how long to wait when there are no new samples, in seconds.
+
+        `generator_kwargs` are passed to the `PINSoftware.SyntheticData.PulseGenerator`s, the seed is increased by
+        the index of the channel.
+
+        `args` and `kwargs` are passed to the `BaseDataUpdater`.
+        """
+        super().__init__(*args, **kwargs)
+        self.freq = freq
+        self.buffer_size = buffer_size
+        self.read_interval = read_interval
+        seed = generator_kwargs.get('seed', 0)
+        self.generators = [PulseGenerator(freq=freq, **dict(generator_kwargs, seed=seed + i)) for i in range(self.channel_count)]
+        self.acquired = 0
+        self.dropped = 0
+        self.lag = 0
+        if self.metrics:
+            self.dropped_counter = self.metrics.counter("daq_dropped_samples_total",
+                "Number of samples lost because the simulated device buffer overflowed")
+
+    def on_start(self):
+        self.start_time = time.monotonic()
+
+    def loop(self):
+        available = int((time.monotonic() - self.start_time) * self.freq) - self.acquired
+        if available <= 0:
+            time.sleep(self.read_interval)
+            return 0
+        if available > self.buffer_size:
+            dropped = available - self.buffer_size
+            for generator in self.generators:
+                generator.skip(dropped)
+            self.acquired += dropped
+            self.dropped += dropped
+            if self.metrics:
+                self.dropped_counter.inc(dropped)
+            available = self.buffer_size
+        self.lag = available / self.freq
+        if self.channel_count == 1:
+            self.data.extend(self.generators[0].next(available).tolist())
+        else:
+            self.data.extend(np.stack([generator.next(available) for generator in self.generators]))
+        self.acquired += available
+        return available
+
+    def drain(self):
+        """."""
+        return self.loop()
+
+
 class NiDAQmxDataUpdater(BaseDataUpdater):
     """
     This is the most important `PINSoftware.DataUpdater`, this is the one actually reading from the NI-6002.
-    It first checks if there is exactly one device and if the device is the NI-6002, if not, the app crashes.
-    If it is, then it sets up a `nidaqmx.Task` and adds the correct channel to it. It then sets the `task` to continuous
-    acquisition and reads the data.
+    The `nidaqmx.Task` comes from a `PINSoftware.DAQTask.DAQTaskManager` which checks the device and sets the task
+    up for continuous acquisition, the task is kept by the manager between the runs so this only starts and stops it.
+
+    For multiple channels (when the data is a `PINSoftware.DataAnalyser.MultiChannelDataAnalyser`) the first physical
+    channels are added. The device interleaves their samples, they are read by a `nidaqmx.stream_readers.AnalogMultiChannelReader`
+    straight into a 2-D numpy buffer (one row per channel) which is reused between the reads.
     """
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, freq : int = 50000, task_manager : DAQTaskManager = None, **kwargs):
         """
+        `freq` is the sampling frequency of every channel, the USB-6002 can do at most 50000 samples
+        per second in total, so with more channels each of them has to be slower.
+
+        `task_manager` is the `PINSoftware.DAQTask.DAQTaskManager` to get the task from, if it is None a new one
+        is made just for this run and the task is closed at the end.
+
         `args` and `kwargs` are passed to the `BaseDataUpdater`.
         """
         super().__init__(*args, **kwargs)
-
-        self.system = nidaqmx.system.System.local()
-        if len(self.system.devices) != 1:
-            self.debugger.warning("There should be exactly one device connected, but there is: " + str(len(self.system.devices)) + ", the program may not work correctly")
-        self.device = self.system.devices[0]
-        if self.device.product_type != 'USB-6002':
-            self.debugger.error("Incorrect device connected, exiting.")
-            raise Exception
-        self.task = nidaqmx.Task()
-        self.task.ai_channels.add_ai_voltage_chan(self.device.ai_physical_chans[0].name)
-        self.task.timing.cfg_samp_clk_timing(50000, sample_mode=nidaqmx.constants.AcquisitionType.CONTINUOUS)
+        self.owns_task_manager = task_manager is None
+        self.task_manager = task_manager or DAQTaskManager(debugger=self.debugger)
+        self.task, self.reader = self.task_manager.get(self.channel_count, freq)
+        if self.channel_count > 1:
+            self.buffer = np.empty(0)
 
     def on_start(self):
         self.task.start()
 
     def loop(self):
-        new_data = self.task.read(nidaqmx.constants.READ_ALL_AVAILABLE)
+        if self.channel_count > 1:
+            return self.read_channels()
+        if self.profiler:
+            with self.profiler.timer("task.read"):
+                new_data = self.task.read(READ_ALL_AVAILABLE)
+        else:
+            new_data = self.task.read(READ_ALL_AVAILABLE)
         for new_y in new_data:
             self.data.append(new_y)
         return len(new_data)
 
+    def read_channels(self) -> int:
+        """Reads all the available samples of all the channels into the buffer and adds them, returns how many samples per channel"""
+        available = self.task.in_stream.avail_samp_per_chan
+        if available == 0:
+            return 0
+        if len(self.buffer) < available * self.channel_count:
+            self.buffer = np.empty(available * self.channel_count * 2)
+        # The start of the flat buffer is a contiguous (channels, samples) array, as the reader requires
+        block = self.buffer[:available * self.channel_count].reshape(self.channel_count, available)
+        if self.profiler:
+            with self.profiler.timer("task.read"):
+                self.reader.read_many_sample(block, number_of_samples_per_channel=available)
+        else:
+            self.reader.read_many_sample(block, number_of_samples_per_channel=available)
+        self.data.extend(block)
+        return available
+
+    def drain(self):
+        """."""
+        return self.loop()
+
     def on_stop(self):
         self.task.stop()
-        self.task.close()
+        if self.owns_task_manager:
+            self.task_manager.release()
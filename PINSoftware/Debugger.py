@@ -1,22 +1,232 @@
+"""
+This file has the `Debugger` through which the whole program logs its messages. The messages only go into a queue,
+a single logging thread takes them from it, prints them and (once `add_log_file` was called) writes them as JSON lines
+into a rotating file. This way the acquisition and saving threads never wait for the terminal or the disk, when the
+queue is full (the logging thread can't keep up) new messages are dropped and counted instead.
+
+Repeated messages (the same level and text) are limited in the logging thread, at most `RepeatFilter.burst` of them
+are let through in `RepeatFilter.interval` seconds, the next one let through afterwards says how many were left out.
+"""
+import atexit
+import json
+import logging
+import logging.handlers
 import os
+import queue
 import sys
+import threading
+
+
+log_queue = queue.Queue(maxsize=10000)
+"""The queue of the log records waiting for the logging thread"""
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """A `logging.handlers.QueueHandler` which never blocks, a record which doesn't fit into the queue is dropped and counted"""
+    def __init__(self, queue : queue.Queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def prepare(self, record : logging.LogRecord) -> logging.LogRecord:
+        # The messages are plain strings, so the formatting and copying done by default is left to the logging thread
+        return record
+
+    def enqueue(self, record : logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class RepeatFilter():
+    """Limits repeated messages, see the module documentation"""
+    def __init__(self, burst : int = 5, interval : float = 10):
+        """`burst` is how many of the same messages are let through in `interval` seconds"""
+        self.burst = burst
+        self.interval = interval
+        self.seen = {}
+
+    def filter(self, record : logging.LogRecord) -> bool:
+        """Returns whether `record` should be logged, it adds the number of left out repeats to it as `suppressed`"""
+        key = (record.levelno, record.getMessage())
+        state = self.seen.get(key)
+        if state is None or record.created - state[0] >= self.interval:
+            record.suppressed = state[2] if state else 0
+            if len(self.seen) > 1000:
+                self.seen.clear()
+            self.seen[key] = [record.created, 1, 0]
+            return True
+        state[1] += 1
+        if state[1] <= self.burst:
+            record.suppressed = 0
+            return True
+        state[2] += 1
+        return False
+
+
+class ConsoleFormatter(logging.Formatter):
+    """Formats the records like the printouts always looked, for example "Info: Starting the DataUpdater" """
+    def format(self, record : logging.LogRecord) -> str:
+        message = record.levelname.capitalize() + ": " + record.getMessage()
+        if getattr(record, 'suppressed', 0):
+            message += " (the same message was repeated " + str(record.suppressed) + " more times)"
+        if getattr(record, 'dropped', 0):
+            message += " (" + str(record.dropped) + " messages before this one were dropped)"
+        return message
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats the records as JSON objects"""
+    def format(self, record : logging.LogRecord) -> str:
+        entry = {
+            'time': record.created,
+            'level': record.levelname.lower(),
+            'thread': record.threadName,
+            'message': record.getMessage()
+        }
+        if getattr(record, 'suppressed', 0):
+            entry['suppressed'] = record.suppressed
+        if getattr(record, 'dropped', 0):
+            entry['dropped'] = record.dropped
+        return json.dumps(entry)
+
+
+class LogListener(logging.handlers.QueueListener):
+    """
+    The logging thread, it filters the repeated messages once and then passes the records to all the handlers.
+    The number of messages dropped since the last logged one is added to it as `dropped`.
+    """
+    def __init__(self, queue : queue.Queue, *handlers):
+        super().__init__(queue, *handlers, respect_handler_level=True)
+        self.repeat_filter = RepeatFilter()
+        self.reported_dropped = 0
+        # Held while a record is handled, so a removed handler is never used (and its file reopened) after it is closed
+        self.handlers_lock = threading.Lock()
+
+    def handle(self, record : logging.LogRecord):
+        if self.repeat_filter.filter(record):
+            dropped = queue_handler.dropped
+            record.dropped = dropped - self.reported_dropped
+            self.reported_dropped = dropped
+            with self.handlers_lock:
+                super().handle(record)
+
+    def enqueue_sentinel(self):
+        # The queue may be full, the sentinel has to wait for a free place
+        self.queue.put(self._sentinel)
+
+
+logger = logging.getLogger("PINSoftware")
+logger.setLevel(logging.INFO)
+logger.propagate = False
+queue_handler = DroppingQueueHandler(log_queue)
+logger.addHandler(queue_handler)
+listener = None
+listener_lock = threading.Lock()
+
+
+def start_logging():
+    """Starts the logging thread (printing to the standard output) if it isn't running yet"""
+    global listener
+    with listener_lock:
+        if listener is None:
+            console = logging.StreamHandler(sys.stdout)
+            console.setFormatter(ConsoleFormatter())
+            listener = LogListener(log_queue, console)
+            listener.start()
+            atexit.register(stop_logging)
+
+
+def stop_logging():
+    """Stops the logging thread after it handles all the queued records"""
+    global listener
+    with listener_lock:
+        if listener is not None:
+            listener.stop()
+            for handler in listener.handlers:
+                try:
+                    handler.flush()
+                except (OSError, ValueError):
+                    # The stream may already be closed when this runs at exit
+                    pass
+            listener = None
+
+
+def add_log_file(directory : str, max_bytes : int = 10 * 2**20, backup_count : int = 5) -> str:
+    """
+    Makes the logging thread also write the messages as JSON lines into "debug.jsonl" in `directory`, when it gets
+    longer than `max_bytes` it is renamed to "debug.jsonl.1" (and so on up to `backup_count`) and a new one is started.
+    A file added before is closed (see `remove_log_file`), so this can also be used to start a new file after the old
+    one was deleted. Returns the path to the file.
+    """
+    start_logging()
+    remove_log_file()
+    filename = os.path.join(directory, "debug.jsonl")
+    handler = logging.handlers.RotatingFileHandler(filename, maxBytes=max_bytes, backupCount=backup_count)
+    handler.setFormatter(JsonFormatter())
+    with listener_lock:
+        with listener.handlers_lock:
+            listener.handlers += (handler,)
+    return filename
+
+
+def remove_log_file():
+    """
+    Stops writing the messages into the file added by `add_log_file` and closes it, this has to be done before
+    the file is deleted (Windows doesn't allow deleting open files). The messages are still printed.
+    """
+    with listener_lock:
+        if listener is None:
+            return
+        with listener.handlers_lock:
+            file_handlers = [handler for handler in listener.handlers if isinstance(handler, logging.handlers.RotatingFileHandler)]
+            listener.handlers = tuple(handler for handler in listener.handlers if handler not in file_handlers)
+            for handler in file_handlers:
+                handler.close()
+
+
+def log(level : int, msg : str):
+    """Puts the message `msg` with `level` into the queue (if the level is logged), this is all the logging threads do"""
+    if logger.isEnabledFor(level):
+        # The record is made directly, the usual lookup of the calling function would take most of the time
+        queue_handler.enqueue(logging.LogRecord(logger.name, level, "", 0, msg, None, None))
+
+
+def set_log_level(level : str):
+    """Sets the lowest level of the messages which are logged ("debug", "info", "warning" or "error")"""
+    logger.setLevel(level.upper())
+
 
 class Debugger():
     """
     A very simple IO handler, it is here to make printouts more consistent and easy to find.
     Calling `Debugger.error` is also the correct way to exit on error.
+
+    All the instances log through the same queue (see the module documentation), so logging only takes a
+    non-blocking put into the queue.
     """
     def __init__(self, exit_on_error=True):
         """If `exit_on_error` is true, then whenever `Debugger.exit` is called, the program halts."""
         self.exit_on_error = exit_on_error
+        start_logging()
+
+    def debug(self, msg):
+        log(logging.DEBUG, msg)
 
     def info(self, msg):
-        print("Info:", msg)
+        log(logging.INFO, msg)
 
     def warning(self, msg):
-        print("Warning:", msg)
+        log(logging.WARNING, msg)
 
     def error(self, msg, n=1):
-        print("Error:", msg)
+        log(logging.ERROR, msg)
         if self.exit_on_error:
+            # The queued messages are written out before exiting
+            stop_logging()
             os._exit(n)
+
+    @property
+    def dropped(self) -> int:
+        """The number of messages dropped because the queue was full"""
+        return queue_handler.dropped
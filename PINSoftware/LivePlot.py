@@ -0,0 +1,173 @@
+"""
+This file has the `LivePlot`, the live graph of the raw data shown on the host computer when the server
+is run with the graphing option. It is made to cost as little as possible so it doesn't compete with the
+acquisition. Only the new raw data is read on each frame, it is decimated into bins (the minimum and the
+maximum of each bin are kept, so the spikes stay visible) which are kept in a ring buffer. They are shown
+as a filled band between the minimums and the maximums, drawing it is much cheaper than a line going up
+and down within every bin. The band is created once and only its vertices are changed, it is redrawn
+using blitting (only the band is drawn again, not the whole figure). The time between frames adapts to how long the drawing takes so that
+drawing never takes more than a small part of the time.
+"""
+import math
+import time
+
+import numpy as np
+from matplotlib.patches import Polygon
+
+from PINSoftware.DataAnalyser import DataAnalyser, minmax_decimate
+
+
+class LivePlot():
+    """
+    The live raw data graph. Call `LivePlot.run` to show it, it hangs until the window is closed.
+    Pressing "p" pauses the graph.
+    """
+    def __init__(self, plt, get_data, window : int = 200, max_points : int = 2000, interval : int = 100,
+            max_interval : int = 2000, draw_budget : float = 0.02, freq : int = 50000, min_range : float = 0.02):
+        """
+        `plt` should be the `matplotlib.pyplot` module or something equivalent.
+
+        `get_data` is a function returning the current `PINSoftware.DataAnalyser.DataAnalyser` (or None).
+
+        `window` is how many of the latest raw values are shown.
+
+        `max_points` is the maximum number of bins the window is decimated into.
+
+        `interval` is the shortest time between frames in milliseconds and `max_interval` is the longest.
+
+        `draw_budget` is the largest part of the time which can be spent drawing, the time between
+        frames is made longer if drawing takes more.
+
+        `freq` is the frequency of the raw data, used to show the x axis in seconds.
+
+        `min_range` is the smallest range of the data (in V) the y axis is fitted to, so a flat signal (like the
+        baseline when there is no beam) doesn't make the axis change with the noise on every frame.
+        """
+        self.plt = plt
+        self.get_data = get_data
+        self.window = window
+        self.bin_size = max(1, math.ceil(window / max_points))
+        self.bins = math.ceil(window / self.bin_size)
+        self.min_interval = interval
+        self.max_interval = max_interval
+        self.draw_budget = draw_budget
+        self.freq = freq
+        self.min_range = min_range
+        self.pause = False
+        self.background = None
+        self.last_draw_time = 0
+
+        self.fig = plt.figure()
+        self.ax = self.fig.add_subplot(1, 1, 1)
+        self.xs = np.arange(-self.bins + 1, 1) * self.bin_size / freq
+        # The outline keeps the band visible where it is flat (the minimum and maximum of the bins are the same)
+        self.band = self.ax.add_patch(Polygon(np.zeros((1, 2)), animated=True, linewidth=0.8, closed=True))
+        self.ax.set_xlim(self.xs[0], self.xs[-1])
+        self.ax.set_xlabel("Time [s]")
+        self.ax.set_ylabel("Raw data [V]")
+        self.ylim = None
+        self.reset(None)
+
+    def reset(self, data : DataAnalyser):
+        """Forgets everything shown, this is done when a new `PINSoftware.DataAnalyser.DataAnalyser` is started"""
+        self.data = data
+        self.read_index = len(data.ys) if data else 0
+        self.mins = np.full(self.bins, np.nan)
+        self.maxs = np.full(self.bins, np.nan)
+        self.ring_index = 0
+        self.remainder = np.empty(0)
+
+    def update(self):
+        """Reads the raw data added since the last update and adds it to the bins"""
+        data = self.get_data()
+        if data is not self.data:
+            self.reset(data)
+        if not data:
+            return
+        new_index = len(data.ys)
+        # Only the values which will be visible are read
+        read_from = max(self.read_index, new_index - self.window - self.bin_size)
+        if read_from > self.read_index:
+            self.remainder = np.empty(0)
+        new = np.asarray(data.ys[read_from:new_index], dtype='f8')
+        self.read_index = new_index
+        if len(self.remainder):
+            new = np.concatenate((self.remainder, new))
+        full = len(new) // self.bin_size * self.bin_size
+        self.remainder = new[full:]
+        mins, maxs = minmax_decimate(new[:full], self.bin_size)
+        if len(mins) > self.bins:
+            mins, maxs = mins[-self.bins:], maxs[-self.bins:]
+        indices = (self.ring_index + np.arange(len(mins))) % self.bins
+        self.mins[indices] = mins
+        self.maxs[indices] = maxs
+        self.ring_index = (self.ring_index + len(mins)) % self.bins
+
+    def get_vertices(self) -> np.ndarray:
+        """
+        Returns the vertices of the band, along the maximums of the bins from the oldest and back along the minimums.
+        The bins which weren't filled yet (the oldest ones) are left out.
+        """
+        order = (self.ring_index + np.arange(self.bins)) % self.bins
+        mins, maxs = self.mins[order], self.maxs[order]
+        filled = ~np.isnan(mins)
+        xs, mins, maxs = self.xs[filled], mins[filled], maxs[filled]
+        if len(xs) == 0:
+            return np.zeros((1, 2))
+        return np.column_stack((np.concatenate((xs, xs[::-1])), np.concatenate((maxs, mins[::-1]))))
+
+    def update_ylim(self) -> bool:
+        """
+        Changes the y axis if the data doesn't fit (or only uses a small part of it), returns whether
+        it changed (then the whole figure has to be redrawn)
+        """
+        if np.all(np.isnan(self.mins)):
+            return False
+        low, high = np.nanmin(self.mins), np.nanmax(self.maxs)
+        data_range = max(high - low, self.min_range)
+        if self.ylim and self.ylim[0] <= low and high <= self.ylim[1] and data_range * 4 > self.ylim[1] - self.ylim[0]:
+            return False
+        # A tenth of the range is added on both sides
+        middle = (low + high) / 2
+        self.ylim = (middle - data_range * 0.6, middle + data_range * 0.6)
+        self.ax.set_ylim(*self.ylim)
+        return True
+
+    def on_draw(self, event):
+        """Called when the whole figure is drawn (at the start or when it is resized), saves the background for blitting"""
+        if self.fig.canvas.supports_blit:
+            self.background = self.fig.canvas.copy_from_bbox(self.fig.bbox)
+        self.ax.draw_artist(self.band)
+
+    def frame(self):
+        """Updates and redraws the band, then sets the time to the next frame based on how long it took"""
+        if self.pause:
+            return
+        start = time.perf_counter()
+        self.update()
+        self.band.set_xy(self.get_vertices())
+        canvas = self.fig.canvas
+        if self.update_ylim() or self.background is None:
+            canvas.draw()
+        else:
+            canvas.restore_region(self.background)
+            self.ax.draw_artist(self.band)
+            canvas.blit(self.fig.bbox)
+        canvas.flush_events()
+        self.last_draw_time = time.perf_counter() - start
+        interval = min(max(self.min_interval, self.last_draw_time / self.draw_budget * 1000), self.max_interval)
+        self.timer.interval = int(interval)
+
+    def on_key_press(self, event):
+        """The function to call when a key is pressed in the live graph window"""
+        if event.key == "p":
+            self.pause = not self.pause
+
+    def run(self):
+        """Shows the graph, this hangs until the window is closed"""
+        self.fig.canvas.mpl_connect('draw_event', self.on_draw)
+        self.fig.canvas.mpl_connect('key_press_event', self.on_key_press)
+        self.timer = self.fig.canvas.new_timer(interval=self.min_interval)
+        self.timer.add_callback(self.frame)
+        self.timer.start()
+        self.plt.show()
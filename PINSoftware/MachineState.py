@@ -1,15 +1,23 @@
+import datetime
 import os
 import shutil
+import time
 
 from typing import List
 
-import matplotlib.animation as animation
-
-from PINSoftware.Debugger import Debugger
+from PINSoftware.DAQTask import DAQTaskManager, FakeBackend
+from PINSoftware.Debugger import Debugger, add_log_file, remove_log_file
+from PINSoftware.LivePlot import LivePlot
 from PINSoftware.Profiler import Profiler
-from PINSoftware.DataAnalyser import DataAnalyser
+from PINSoftware.Publisher import Publisher
+from PINSoftware.Metrics import MetricsRegistry, add_process_metrics
+from PINSoftware.MemoryStats import MemoryMonitor
+from PINSoftware.SamplingProfiler import SamplingProfiler
+from PINSoftware.DataAnalyser import DataAnalyser, MultiChannelDataAnalyser
 from PINSoftware.DataSaver import CsvDataSaver, Hdf5DataSaver, Filetype, SavingException
-from PINSoftware.DataUpdater import NiDAQmxDataUpdater, LoadedDataUpdater
+from PINSoftware.DataUpdater import NiDAQmxDataUpdater, LoadedDataUpdater, SyntheticDataUpdater
+from PINSoftware.Spectrum import SpectrumAnalyser
+from PINSoftware.Watchdog import Watchdog
 
 class MachineState():
     """
@@ -18,7 +26,11 @@ class MachineState():
     of the run.
     """
     def __init__(self, plt, dummy : bool, dummy_data_file : str, profiler : bool = False,
-            plot_update_interval : int = 100, log_directory : str = "logs"):
+            plot_update_interval : int = 100, log_directory : str = "logs", synthetic : bool = False,
+            graph_window : float = None, spectrum_segment_length : int = None, spectrum_averages : int = 16,
+            channels : int = 1, trigger_mode : str = 'spike', trigger_pre : int = 15, trigger_post : int = 5,
+            trigger_threshold : float = None, fake_daq : bool = False, fsync : bool = False, stop_timeout : float = 10,
+            publish_address : str = None):
         """
         `plt` should be the `matplotlib.pyplot` module or something equivalent, this is for plotting the live
         data graph on the host machine when the graphing option is enabled.
@@ -28,55 +40,94 @@ class MachineState():
 
         `dummy_data_file` is a path to the data to use for dummy mode.
 
-        `profiler` is whether the DataUpdater should be profiled.
+        `profiler` is whether the DataUpdater and the DataSaver should be profiled, the reports are written
+        into a JSON lines file in the `log_directory`.
 
-        `plot_update_interval` is the update interval of the live data graph.
+        `plot_update_interval` is the shortest update interval of the live data graph in milliseconds, it gets
+        longer when drawing is slow (see `PINSoftware.LivePlot.LivePlot`).
 
         `log_directory` is the directory where to put saved data.
+
+        `synthetic` means the data is generated by a `PINSoftware.DataUpdater.SyntheticDataUpdater` instead of
+        being read from the NI-6002 or the dummy file, this overrides `dummy`.
+
+        `graph_window` is how many seconds of raw data the live data graph shows, by default it
+        shows the last 200 values.
+
+        `spectrum_segment_length` enables the spectral analysis of the raw data (`PINSoftware.Spectrum.SpectrumAnalyser`)
+        with segments of this many values, `spectrum_averages` is about how many segments the current spectrum is
+        averaged over. If it is None, there is no spectral analysis.
+
+        `channels` is the number of analog input channels to acquire, the first is the main signal and the others
+        are shown and saved alongside it (see `PINSoftware.DataAnalyser.MultiChannelDataAnalyser`). The NI-6002 shares
+        its 50 kHz sampling rate between the channels, so each channel is sampled at `MachineState.freq` = 50000 / `channels`.
+
+        `trigger_mode`, `trigger_pre`, `trigger_post` and `trigger_threshold` set up the capturing of the raw data around the
+        pulses when the "triggered_ys" item is saved, they are the arguments of `PINSoftware.TriggeredCapture.TriggeredCapture`.
+
+        `fake_daq` means the NI-6002 is replaced by a `PINSoftware.DAQTask.FakeBackend`, the data is read the same
+        way as from the device but it is generated. The task (real or fake) is kept in `MachineState.task_manager`
+        between the runs and released by `MachineState.stop_everything`.
+
+        `fsync` is whether the saved files should be synced to the disk when a run is stopped.
+
+        `stop_timeout` is the longest time in seconds to wait for each phase of stopping a run (see `MachineState.stop_experiment`).
+
+        `publish_address` is where a `PINSoftware.Publisher.Publisher` streaming the peak voltages to other programs listens
+        (see `PINSoftware.Publisher.parse_address`), if it is None there is no publisher.
         """
         self.plt = plt
         self.dummy = dummy
         self.dummy_data_file = dummy_data_file
+        self.synthetic = synthetic
         self.profiler = profiler
         self.plot_update_interval = plot_update_interval
+        self.graph_window = graph_window
+        self.spectrum_segment_length = spectrum_segment_length
+        self.spectrum_averages = spectrum_averages
+        self.channels = channels
+        self.freq = 50000 // channels
+        self.channel_names = ["ai" + str(i) for i in range(channels)]
+        self.trigger_kwargs = {'mode': trigger_mode, 'pre_samples': trigger_pre, 'post_samples': trigger_post,
+            'threshold': trigger_threshold}
+        self.fsync = fsync
+        self.stop_timeout = stop_timeout
         self.log_directory = os.path.join(os.path.curdir, log_directory)
 
-        self.init_graph()
-
         self.debugger = Debugger()
+        self.metrics = MetricsRegistry()
+        add_process_metrics(self.metrics)
+        self.metrics.gauge("experiment_running", "Whether an experiment is running").set_function(lambda: int(self.experiment_running))
         self.controller = None
+        self.task_manager = DAQTaskManager(FakeBackend() if fake_daq else None, debugger=self.debugger)
         self.du = None
         self.data = None
         self.saver = None
+        self.spectrum = None
+        self.watchdog = None
+        self.sampling_profiler = None
         self.experiment_running = False
+        self.stop_timings = None
+        self.memory_monitor = MemoryMonitor(debugger=self.debugger)
+        self.memory_monitor.start()
+        self.publisher = None
+        if publish_address:
+            try:
+                self.publisher = Publisher(lambda: self.data, publish_address, debugger=self.debugger, metrics=self.metrics)
+            except (OSError, ValueError) as e:
+                self.debugger.error("Could not start the publisher on \"" + publish_address + "\": " + str(e))
+            else:
+                self.publisher.start()
 
         if not os.path.exists(self.log_directory):
             os.mkdir(self.log_directory)
-
-    def init_graph(self):
-        """Setup for the live graphing"""
-        self.fig = self.plt.figure()
-        self.ax = self.fig.add_subplot(1, 1, 1)
-
-        self.pause = False
-
-    def animate(self, i):
-        """The animate function for the `animation.FuncAnimation` class"""
-        if not self.pause and self.du:
-            if self.du.data:
-                self.ax.clear()
-                self.du.data.plot(self.plt)
-
-    def onKeyPress(self, event):
-        """The function to call when a key is pressed in the live graph window"""
-        if event.key == "p":
-            self.pause = not self.pause
+        add_log_file(self.log_directory)
 
     def run_graphing(self):
         """This runs the actual graphing, this hangs until the window is closed"""
-        self.ani = animation.FuncAnimation(self.fig, self.animate, interval=self.plot_update_interval)
-        self.fig.canvas.mpl_connect('key_press_event', self.onKeyPress)
-        self.plt.show()
+        window = int(self.graph_window * self.freq) if self.graph_window else 200
+        self.live_plot = LivePlot(self.plt, lambda: self.data, window=window, interval=self.plot_update_interval, freq=self.freq)
+        self.live_plot.run()
 
     def grab_control(self, controller_sid):
         """
@@ -97,8 +148,9 @@ class MachineState():
     def start_experiment(self, save_base_filename : str = None, save_filetype : Filetype = Filetype.Csv,
             items : List[str] = ["ys","processed_ys"], **kwargs):
         """
-        This starts a data acquisition run. It creates a new `PINSoftware.DataAnalyser.DataAnalyser` and an appropriate `DataUpdater`.
-        Then it may also create and start a `DataSaver` and/or a `Profiler` based on the situation.
+        This starts a data acquisition run. It creates a new `PINSoftware.DataAnalyser.DataAnalyser` and an appropriate `DataUpdater`
+        and a `PINSoftware.Watchdog.Watchdog` watching them. Then it may also create and start a `DataSaver` and/or a `Profiler`
+        based on the situation.
 
         `save_base_filename` is the base part of the filename for the new log file. The `save_base_filename`
         is appended with a timestamp and an appropriate file extension and that makes up the filename.
@@ -112,38 +164,127 @@ class MachineState():
 
         More information on how it all works look in the module documentation: `PINSoftware`.
         """
-        self.data = DataAnalyser(50000, plot_buffer_len=200, debugger=self.debugger, **kwargs)
+        if self.channels > 1:
+            self.data = MultiChannelDataAnalyser(self.freq, self.channels, self.channel_names, plot_buffer_len=200, debugger=self.debugger,
+                metrics=self.metrics, **kwargs)
+        else:
+            self.data = DataAnalyser(self.freq, plot_buffer_len=200, debugger=self.debugger, metrics=self.metrics, **kwargs)
+        if self.spectrum_segment_length:
+            self.spectrum = SpectrumAnalyser(self.data, self.spectrum_segment_length, self.spectrum_averages)
+        else:
+            self.spectrum = None
+        self.watchdog = Watchdog(self.data, debugger=self.debugger, metrics=self.metrics)
         if save_base_filename:
             if save_filetype == Filetype.Csv:
-                self.saver = CsvDataSaver(self.data, self.log_directory, save_base_filename)
+                self.saver = CsvDataSaver(self.data, self.log_directory, save_base_filename, metrics=self.metrics, fsync=self.fsync)
             elif save_filetype == Filetype.Hdf5:
-                self.saver = Hdf5DataSaver(self.data, self.log_directory, save_base_filename, items=items)
+                self.saver = Hdf5DataSaver(self.data, self.log_directory, save_base_filename, items=items, metrics=self.metrics,
+                    spectrum=self.spectrum, trigger_kwargs=self.trigger_kwargs, watchdog=self.watchdog, fsync=self.fsync)
         else:
             self.saver = None
-        if self.dummy:
-            self.du = LoadedDataUpdater(self.dummy_data_file, self.data, freq=50000, debugger=self.debugger)
+        if self.synthetic:
+            self.du = SyntheticDataUpdater(self.data, freq=self.freq, debugger=self.debugger, metrics=self.metrics)
+        elif self.dummy:
+            self.du = LoadedDataUpdater(self.dummy_data_file, self.data, freq=self.freq, debugger=self.debugger, metrics=self.metrics)
         else:
-            self.du = NiDAQmxDataUpdater(self.data, debugger=self.debugger)
+            # The previous run must be done with the task before it is started again
+            if self.du and self.du.is_alive():
+                self.du.join()
+            self.du = NiDAQmxDataUpdater(self.data, freq=self.freq, task_manager=self.task_manager, debugger=self.debugger,
+                metrics=self.metrics)
         if self.profiler:
-            self.du.profiler = Profiler(name="DataUpdater RPS", start_delay=3)
+            profiler_filename = os.path.join(self.log_directory,
+                "profile" + datetime.datetime.now().strftime("%y%m%d-%H%M%S") + ".jsonl")
+            self.du.profiler = Profiler(name="DataUpdater RPS", start_delay=3, output_filename=profiler_filename)
+            if self.saver:
+                self.saver.profiler = self.du.profiler
         self.du.start()
+        self.watchdog.start()
+        if self.spectrum:
+            self.spectrum.start()
         if self.saver:
             self.saver.start()
         self.experiment_running = True
 
-    def stop_experiment(self):
-        """This stops the current experiment and all the threads working on it"""
+    def join_threads(self, threads : list) -> float:
+        """
+        Waits for the started `threads` to end, at most `MachineState.stop_timeout` seconds for all of them together,
+        a warning is printed for those which don't. Returns how long it took in seconds.
+        """
+        start = time.perf_counter()
+        deadline = start + self.stop_timeout
+        for thread in threads:
+            if thread and thread.ident is not None:
+                thread.join(max(0, deadline - time.perf_counter()))
+                if thread.is_alive():
+                    self.debugger.warning("The thread \"" + thread.name + "\" didn't stop in " + str(self.stop_timeout) + " seconds")
+        return time.perf_counter() - start
+
+    def stop_experiment(self) -> dict:
+        """
+        This stops the current experiment and waits for all the threads working on it, so the next experiment can
+        be started right after this returns. It is done in phases:
+
+        1. acquisition - the data source is stopped, the samples still waiting in it are read and analysed,
+        2. analysis - the spectral analysis and the watchdog are stopped,
+        3. saving - the rest of the data is saved and the file is closed (and synced to the disk if `MachineState.fsync`),
+        4. profilers - the profilers of the run write their last reports.
+
+        Returns the durations of the phases in seconds (also kept in `MachineState.stop_timings`), or None if no
+        experiment was running.
+        """
+        if not self.experiment_running:
+            return None
+        self.experiment_running = False
+        start = time.perf_counter()
+        timings = {}
         if self.du:
             self.du.stop()
+        timings['acquisition'] = self.join_threads([self.du])
+        self.watchdog.stop()
+        if self.spectrum:
+            self.spectrum.stop()
+        timings['analysis'] = self.join_threads([self.watchdog, self.spectrum])
         if self.saver:
             self.saver.stop()
-        self.experiment_running = False
+        timings['saving'] = self.join_threads([self.saver])
+        channels = getattr(self.data, 'channels', [self.data])
+        timings['profilers'] = self.join_threads([self.du.profiler] + [channel.irregular_data_prof for channel in channels])
+        timings['total'] = time.perf_counter() - start
+        self.stop_timings = timings
+        self.debugger.info("Stopped the experiment in " + format(timings['total'], '.3f') + " s (" +
+            ", ".join(name + " " + format(duration, '.3f') + " s" for name, duration in timings.items() if name != 'total') + ")")
+        return timings
 
     def stop_everything(self):
-        """This currently just calls `stop_experiment` but there might be stuff added here,
-        this is meant to be a sort of stop all button"""
+        """
+        This stops the current experiment, releases the DAQ task and stops the `PINSoftware.MemoryStats.MemoryMonitor`
+        and the `PINSoftware.Publisher.Publisher`, this is meant to be a sort of stop all button
+        """
         self.stop_experiment()
+        self.memory_monitor.stop()
+        if self.publisher:
+            self.publisher.stop()
+        self.join_threads([self.du, self.memory_monitor, self.publisher])
+        self.task_manager.release()
+
+    def start_sampling_profiler(self, duration : float) -> SamplingProfiler:
+        """
+        Starts a `PINSoftware.SamplingProfiler.SamplingProfiler` of all threads for `duration` seconds,
+        its results are saved into the log directory. Returns the new profiler or None if one is
+        already running.
+        """
+        if self.sampling_profiler and self.sampling_profiler.is_alive():
+            return None
+        self.sampling_profiler = SamplingProfiler(duration, self.log_directory, debugger=self.debugger)
+        self.sampling_profiler.start()
+        return self.sampling_profiler
 
     def delete_logs(self):
-        shutil.rmtree(self.log_directory)
-        os.mkdir(self.log_directory)
+        """Deletes everything in the log directory, the log file is closed first and a new one is started afterwards"""
+        remove_log_file()
+        try:
+            shutil.rmtree(self.log_directory)
+        finally:
+            os.makedirs(self.log_directory, exist_ok=True)
+            add_log_file(self.log_directory)
@@ -0,0 +1,211 @@
+"""
+This file has the memory instrumentation of the server. It answers two questions, which of the structures of the
+program hold how much memory (`analyser_sizes`, `saver_sizes`, `profiler_sizes`) and how the memory of the whole
+process changes over time (the `MemoryMonitor` keeps a history of the resident memory).
+
+When the sizes don't explain the growth, `MemoryMonitor.allocation_diff` compares two `tracemalloc` snapshots
+and returns the allocation sites which grew the most between them. Tracing the allocations slows the whole program
+down, so it is only started by the first call of `MemoryMonitor.allocation_diff` and runs until
+`MemoryMonitor.stop_tracing` is called or until `MemoryMonitor.trace_timeout` seconds pass without another call.
+
+The sizes in bytes are estimates, the lists hold a separate python object for every value, so their size is counted as
+the size of the list plus the size of its last value for every value (the values of a list are all of the same type).
+"""
+import collections
+import sys
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+
+from PINSoftware.DataAnalyser import DataAnalyser
+from PINSoftware.Debugger import Debugger
+from PINSoftware.Metrics import get_process_rss
+from PINSoftware.Profiler import Profiler
+
+
+analyser_series = ['ys', 'processed_ys', 'processed_timestamps', 'averaged_processed_ys', 'averaged_processed_timestamps',
+    'markers', 'marker_timestamps', 'parameter_changes', 'time_anchor_indices', 'time_anchor_times']
+"""The growing series of `PINSoftware.DataAnalyser.DataAnalyser` whose sizes are reported"""
+
+
+def estimate_bytes(values) -> int:
+    """Returns the estimated size of `values` (a list, a deque or a numpy array) in bytes, see the module documentation"""
+    if isinstance(values, np.ndarray):
+        return values.nbytes
+    size = sys.getsizeof(values)
+    if len(values):
+        size += len(values) * sys.getsizeof(values[-1])
+    return size
+
+
+def get_size(values) -> dict:
+    """Returns the number of elements and the estimated bytes of `values` as a dict"""
+    return {'count': len(values), 'bytes': estimate_bytes(values)}
+
+
+def analyser_sizes(data : DataAnalyser) -> dict:
+    """
+    Returns the sizes (see `get_size`) of the series of every channel of `data` (a `PINSoftware.DataAnalyser.DataAnalyser`
+    or a `PINSoftware.DataAnalyser.MultiChannelDataAnalyser`) and of the windows of their rolling statistics, by channel name.
+    """
+    channels = getattr(data, 'channels', [data])
+    names = getattr(data, 'channel_names', ["ai0"])
+    result = {}
+    for name, channel in zip(names, channels):
+        sizes = {series: get_size(getattr(channel, series)) for series in analyser_series}
+        if channel.stats:
+            for window_name, window in list(channel.stats.windows.items()):
+                queues = [window.values, window.timestamps, window.mins, window.maxs]
+                sizes['stats_' + window_name] = {'count': len(window.values), 'bytes': sum(estimate_bytes(queue) for queue in queues)}
+        result[name] = sizes
+    return result
+
+
+def saver_sizes(saver) -> dict:
+    """
+    Returns how much the `PINSoftware.DataSaver` `saver` holds, the number of values waiting to be saved and the
+    sizes of the ring buffers and the waiting triggers of its `PINSoftware.TriggeredCapture.TriggeredCapture`s.
+    """
+    captures = getattr(saver, 'captures', [])
+    return {
+        'lag_values': saver.get_lag(),
+        'capture_buffers': {
+            'count': sum(len(capture['capture'].ring) for capture in captures),
+            'bytes': sum(capture['capture'].ring.nbytes for capture in captures)
+        },
+        'capture_pending_triggers': {
+            'count': sum(len(capture['capture'].pending_triggers) for capture in captures),
+            'bytes': sum(estimate_bytes(capture['capture'].pending_triggers) for capture in captures)
+        }
+    }
+
+
+def profiler_sizes(profiler : Profiler) -> dict:
+    """Returns the number of operation histograms a `PINSoftware.Profiler.Profiler` keeps (for the interval and for the whole run)"""
+    return {'timings': len(profiler.timings), 'total_timings': len(profiler.total_timings)}
+
+
+class MemoryMonitor(threading.Thread):
+    """
+    Records the resident memory of the process every `MemoryMonitor.interval` seconds into `MemoryMonitor.history`
+    (a bounded deque of (unix time, bytes) tuples) and does the `tracemalloc` snapshot diffs, see the module documentation.
+    Call `MemoryMonitor.stop` to stop it.
+    """
+    def __init__(self, interval : float = 10, history_length : int = 8640, trace_frames : int = 1,
+            trace_timeout : float = 600, debugger : Debugger = Debugger()):
+        """
+        `interval` is the time between two measurements of the resident memory in seconds.
+
+        `history_length` is how many measurements are kept, by default a day of them.
+
+        `trace_frames` is how many frames of every allocation `tracemalloc` keeps, more frames show the callers too
+        but cost more memory.
+
+        `trace_timeout` is how long in seconds after the last `MemoryMonitor.allocation_diff` the tracing is stopped
+        (checked every `interval` seconds).
+
+        `debugger` is the `PINSoftware.Debugger.Debugger` to use.
+        """
+        super().__init__(name="MemoryMonitor", daemon=True)
+        self.stop_event = threading.Event()
+        self.interval = interval
+        self.history = collections.deque(maxlen=history_length)
+        self.trace_frames = trace_frames
+        self.trace_timeout = trace_timeout
+        self.debugger = debugger
+        # Reentrant as `MemoryMonitor.stop_idle_tracing` calls `MemoryMonitor.stop_tracing`
+        self.lock = threading.RLock()
+        self.snapshot = None
+        self.snapshot_time = None
+        self.trace_deadline = None
+
+    def take_snapshot(self) -> tracemalloc.Snapshot:
+        """Takes a `tracemalloc` snapshot without the allocations of `tracemalloc` and the imports"""
+        return tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+            tracemalloc.Filter(False, "<unknown>")
+        ])
+
+    def allocation_diff(self, top : int = 20, key_type : str = 'lineno') -> dict:
+        """
+        Takes a snapshot of the allocations and compares it to the one taken by the previous call, the new one is kept
+        for the next call. Returns a dict with the times of the two snapshots, the traced memory and the `top` allocation
+        sites (grouped by `key_type`, "lineno", "filename" or "traceback") which grew the most. The first call only starts
+        tracing and takes the first snapshot, so the returned dict has no sites.
+        """
+        with self.lock:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(self.trace_frames)
+                self.snapshot = None
+                self.debugger.info("MemoryMonitor: Started tracing the allocations")
+            now = time.time()
+            self.trace_deadline = now + self.trace_timeout
+            snapshot = self.take_snapshot()
+            previous, previous_time = self.snapshot, self.snapshot_time
+            self.snapshot, self.snapshot_time = snapshot, now
+        traced, peak = tracemalloc.get_traced_memory()
+        result = {'since': previous_time, 'until': now, 'traced_bytes': traced, 'traced_peak_bytes': peak, 'sites': []}
+        if previous is None:
+            return result
+        for stat in snapshot.compare_to(previous, key_type)[:top]:
+            # The frames go from the oldest to the most recent one, the site is the most recent
+            frames = [str(frame) for frame in stat.traceback]
+            result['sites'].append({
+                'site': frames[-1],
+                'traceback': frames,
+                'size_diff': stat.size_diff,
+                'size': stat.size,
+                'count_diff': stat.count_diff,
+                'count': stat.count
+            })
+        return result
+
+    def stop_tracing(self):
+        """Stops tracing the allocations and forgets the last snapshot"""
+        with self.lock:
+            if tracemalloc.is_tracing():
+                tracemalloc.stop()
+                self.debugger.info("MemoryMonitor: Stopped tracing the allocations")
+            self.snapshot = None
+            self.snapshot_time = None
+            self.trace_deadline = None
+
+    def stop_idle_tracing(self):
+        """Stops the tracing if there was no `MemoryMonitor.allocation_diff` for `MemoryMonitor.trace_timeout` seconds"""
+        with self.lock:
+            if self.trace_deadline is not None and time.time() >= self.trace_deadline:
+                self.debugger.info("MemoryMonitor: No allocation diff for " + format(self.trace_timeout, 'g') + " s")
+                self.stop_tracing()
+
+    def summary(self, since : float = None) -> dict:
+        """
+        Returns the current resident memory, its history since the unix time `since` (all of it if None) and the tracing
+        state (with the unix time when the tracing stops by itself)
+        """
+        history = list(self.history)
+        if since is not None:
+            history = [entry for entry in history if entry[0] >= since]
+        return {
+            'rss_bytes': get_process_rss(),
+            'rss_history': history,
+            'tracing': tracemalloc.is_tracing(),
+            'tracing_stops_at': self.trace_deadline,
+            'traced_bytes': tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else None
+        }
+
+    def run(self):
+        """This method is called when `MemoryMonitor.start` is called, it is the main loop"""
+        while True:
+            self.history.append((time.time(), get_process_rss()))
+            self.stop_idle_tracing()
+            if self.stop_event.wait(self.interval):
+                break
+
+    def stop(self):
+        """Stops the thread and the tracing"""
+        self.stop_event.set()
+        self.stop_tracing()
@@ -0,0 +1,229 @@
+"""
+This file has a small metrics registry which can be rendered in the Prometheus text format
+(https://prometheus.io/docs/instrumenting/exposition_formats/). There is one `MetricsRegistry`
+in `PINSoftware.MachineState.MachineState` and all the parts of the program (the `PINSoftware.DataUpdater`,
+`PINSoftware.DataAnalyser.DataAnalyser`, the `PINSoftware.DataSaver` and the web server) add to it.
+It is served at /metrics.
+
+Updating a metric is just changing a number so it is cheap enough to be done from the acquisition
+thread. Values which are easy to get when needed (like the process memory) are not updated
+continuously but are read by collectors whenever the metrics are rendered.
+"""
+import os
+import threading
+
+from PINSoftware.Profiler import Histogram as BucketHistogram
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+def format_value(value) -> str:
+    """Formats a number the way Prometheus expects it"""
+    if value == float('inf'):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+
+def format_labels(labels : dict) -> str:
+    """Formats the labels of a sample, returns an empty string when there are none"""
+    if not labels:
+        return ""
+    escaped = (k + '="' + str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"' for k, v in labels.items())
+    return "{" + ",".join(escaped) + "}"
+
+
+class Metric():
+    """
+    The base class of all metrics. A metric can have label names, in that case the values are
+    set on its children which are gotten through `Metric.labels`.
+    """
+    type_name = "untyped"
+
+    def __init__(self, name : str, documentation : str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+        self.lock = threading.Lock()
+
+    def labels(self, **labels):
+        """Returns the child metric for the given label values, it is created if it doesn't exist"""
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        child = self.children.get(key)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(key, type(self)(self.name, self.documentation))
+        return child
+
+    def samples(self, labels : dict):
+        """Should yield (suffix, labels, value) tuples for the metric without children"""
+        return []
+
+    def render(self) -> str:
+        """Renders the metric with its header in the text format"""
+        lines = ["# HELP " + self.name + " " + self.documentation, "# TYPE " + self.name + " " + self.type_name]
+        if self.labelnames:
+            sources = [(dict(zip(self.labelnames, key)), child) for key, child in list(self.children.items())]
+        else:
+            sources = [({}, self)]
+        for labels, source in sources:
+            for suffix, sample_labels, value in source.samples(labels):
+                lines.append(self.name + suffix + format_labels(sample_labels) + " " + format_value(value))
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    """A value which only ever goes up (like the number of samples acquired)"""
+    type_name = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.value = 0
+        self.function = None
+
+    def inc(self, amount=1):
+        """Increases the counter by `amount`"""
+        self.value += amount
+
+    def set_function(self, function):
+        """Makes the counter call `function` to get its value when rendered"""
+        self.function = function
+
+    def samples(self, labels):
+        yield "", labels, self.function() if self.function else self.value
+
+
+class Gauge(Metric):
+    """A value which can go up and down (like the memory used)"""
+    type_name = "gauge"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.value = 0
+        self.function = None
+
+    def set(self, value):
+        """Sets the gauge to `value`"""
+        self.value = value
+
+    def inc(self, amount=1):
+        """Increases the gauge by `amount`"""
+        self.value += amount
+
+    def dec(self, amount=1):
+        """Decreases the gauge by `amount`"""
+        self.value -= amount
+
+    def set_function(self, function):
+        """Makes the gauge call `function` to get its value when rendered"""
+        self.function = function
+
+    def samples(self, labels):
+        yield "", labels, self.function() if self.function else self.value
+
+
+class Histogram(Metric):
+    """
+    A histogram of observed values, it is backed by a `PINSoftware.Profiler.Histogram` which only
+    takes integers, so the values are divided by `unit` first (by default the values are seconds and
+    are kept in nanoseconds). The buckets shown are the powers of two between `2**min_exponent` and
+    `2**max_exponent` units.
+    """
+    type_name = "histogram"
+
+    def __init__(self, *args, unit : float = 1e-9, min_exponent : int = 10, max_exponent : int = 36, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.unit = unit
+        self.min_exponent = min_exponent
+        self.max_exponent = max_exponent
+        self.histogram = BucketHistogram()
+
+    def labels(self, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        child = self.children.get(key)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(key, Histogram(self.name, self.documentation, unit=self.unit,
+                    min_exponent=self.min_exponent, max_exponent=self.max_exponent))
+        return child
+
+    def observe(self, value):
+        """Records `value` (in the same units the histogram was made for)"""
+        self.histogram.record(value / self.unit)
+
+    def observe_units(self, value : int):
+        """Records `value` which is already in `unit`s, this skips the division"""
+        self.histogram.record(value)
+
+    def samples(self, labels):
+        counts = self.histogram.counts
+        for exponent in range(self.min_exponent, self.max_exponent + 1):
+            # Values under 2**exponent are exactly the ones in the buckets before 4 * (exponent - 1)
+            yield "_bucket", dict(labels, le=format_value(float(2 ** exponent * self.unit))), sum(counts[:4 * (exponent - 1)])
+        yield "_bucket", dict(labels, le="+Inf"), self.histogram.count
+        yield "_sum", labels, self.histogram.total * self.unit
+        yield "_count", labels, self.histogram.count
+
+
+class MetricsRegistry():
+    """
+    Holds all the metrics. The `MetricsRegistry.counter`, `MetricsRegistry.gauge` and
+    `MetricsRegistry.histogram` methods return the existing metric if there already is one
+    with the name, so the same metrics keep being used across experiments.
+    """
+    def __init__(self, prefix : str = "pin_"):
+        """`prefix` is prepended to all metric names"""
+        self.prefix = prefix
+        self.metrics = {}
+        self.collectors = []
+        self.lock = threading.Lock()
+
+    def get_or_create(self, cls, name : str, documentation : str, **kwargs):
+        """Returns the metric called `name`, if it doesn't exist it is created as `cls(name, documentation, **kwargs)`"""
+        name = self.prefix + name
+        metric = self.metrics.get(name)
+        if metric is None:
+            with self.lock:
+                metric = self.metrics.setdefault(name, cls(name, documentation, **kwargs))
+        return metric
+
+    def counter(self, name : str, documentation : str, **kwargs) -> Counter:
+        return self.get_or_create(Counter, name, documentation, **kwargs)
+
+    def gauge(self, name : str, documentation : str, **kwargs) -> Gauge:
+        return self.get_or_create(Gauge, name, documentation, **kwargs)
+
+    def histogram(self, name : str, documentation : str, **kwargs) -> Histogram:
+        return self.get_or_create(Histogram, name, documentation, **kwargs)
+
+    def add_collector(self, collector):
+        """`collector` is called without arguments before every rendering, it can update metrics"""
+        self.collectors.append(collector)
+
+    def render(self) -> str:
+        """Returns all the metrics in the Prometheus text format"""
+        for collector in self.collectors:
+            collector()
+        return "\n".join(metric.render() for metric in list(self.metrics.values())) + "\n"
+
+
+def get_process_rss() -> int:
+    """Returns the resident memory of this process in bytes, uses psutil if installed"""
+    if psutil:
+        return psutil.Process().memory_info().rss
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return 0
+
+
+def add_process_metrics(registry : MetricsRegistry):
+    """Adds the process metrics (the resident memory and the thread count) to `registry`"""
+    registry.gauge("process_resident_memory_bytes", "Resident memory size of the server process").set_function(get_process_rss)
+    registry.gauge("process_threads", "Number of running python threads").set_function(threading.active_count)
@@ -0,0 +1,206 @@
+"""
+This file has the `OverviewPyramid` which is used for viewing saved runs quickly. Plotting
+a long recording directly means reading and sending millions of values, so instead the
+pyramid keeps multiple levels of the data, each being `OverviewPyramid.factor` times shorter
+than the previous one where each value is the min, max and mean of a block of the level below.
+When a range of data is requested, only the coarsest level which still has enough detail is read.
+The pyramid is built once and cached in a sidecar hdf5 file, it is rebuilt when the source file changes.
+"""
+import os
+
+import h5py
+import numpy as np
+
+from PINSoftware.DataExporter import get_timestamps
+
+
+pyramid_series = ['ys', 'processed_ys', 'averaged_processed_ys', 'markers']
+"""The datasets of a saved run for which pyramids are built (if they are in the file)"""
+
+
+class OverviewPyramid():
+    """
+    A min/max/mean pyramid of a saved hdf5 run (made by `PINSoftware.DataSaver.Hdf5DataSaver`).
+    The source is only read when building, afterwards all reads go to the sidecar file.
+
+    Level 0 is the source dataset itself, level `k` has blocks of `factor ** k` source values.
+    All x coordinates used here are in samples, this is how the timestamps are saved. For "ys" the
+    x coordinate is the index of the value and for the other datasets it is their paired timestamp.
+    """
+    def __init__(self, filename : str, cache_directory : str, factor : int = 16, max_top_level_length : int = 1000,
+            chunk_size : int = 2**20):
+        """
+        `filename` is the path to the saved run.
+
+        `cache_directory` is where to keep the sidecar file, it is created if it doesn't exist.
+
+        `factor` is how many values from one level make up one value in the next level.
+
+        `max_top_level_length` sets when to stop adding levels, the last level is at most this long.
+
+        `chunk_size` is how many values are read and reduced at once when building.
+        """
+        self.filename = filename
+        self.factor = factor
+        self.max_top_level_length = max_top_level_length
+        self.chunk_size = chunk_size - chunk_size % factor
+        if not os.path.exists(cache_directory):
+            os.makedirs(cache_directory)
+        self.sidecar_filename = os.path.join(cache_directory, os.path.basename(filename) + ".pyramid.hdf5")
+
+        self.source = h5py.File(filename, 'r')
+        self.freq = self.source.attrs.get('freq', 50000)
+        try:
+            self.source_mtime = os.path.getmtime(filename)
+            if not self.is_cache_valid():
+                self.build()
+            self.pyramid = h5py.File(self.sidecar_filename, 'r')
+        except:
+            self.source.close()
+            raise
+        self.series = [series for series in pyramid_series if series in self.pyramid]
+
+    def is_cache_valid(self) -> bool:
+        """Checks whether the sidecar exists and was built from the current version of the source"""
+        if not os.path.exists(self.sidecar_filename):
+            return False
+        try:
+            with h5py.File(self.sidecar_filename, 'r') as f:
+                return f.attrs['source_mtime'] == self.source_mtime and f.attrs['factor'] == self.factor
+        except (OSError, KeyError):
+            return False
+
+    def build(self):
+        """
+        Builds the sidecar file. It is written to a temporary file first and then moved in place
+        so that an interrupted build never leaves a broken cache behind.
+        """
+        temp_filename = self.sidecar_filename + ".tmp"
+        with h5py.File(temp_filename, 'w') as f:
+            f.attrs['source_mtime'] = self.source_mtime
+            f.attrs['factor'] = self.factor
+            for series in pyramid_series:
+                if series in self.source:
+                    self.build_series(f.create_group(series), series)
+        os.replace(temp_filename, self.sidecar_filename)
+
+    def build_series(self, group, series : str):
+        """Builds all the levels for one dataset into `group`"""
+        source = self.source[series]
+        timestamps = get_timestamps(self.source, series)
+        raw_length = len(source)
+        group.attrs['length'] = raw_length
+        level = 0
+        length = raw_length
+        mins = maxs = means = source
+        xs = timestamps
+        while length > self.max_top_level_length:
+            level += 1
+            level_group = self.build_level(group.create_group(str(level)), mins, maxs, means, xs,
+                    length, raw_length, self.factor ** (level - 1))
+            mins, maxs, means = level_group['min'], level_group['max'], level_group['mean']
+            xs = level_group.get('x')
+            length = len(mins)
+        group.attrs['levels'] = level
+
+    def build_level(self, group, mins, maxs, means, xs, length : int, raw_length : int, block : int):
+        """
+        Reduces one level (given by `mins`, `maxs`, `means` and possibly `xs`, all of `length`) into the
+        next one and stores it in `group`. `block` is how many source values one value of the given level
+        covers, it is used to weigh the means correctly as the last block of a level is usually shorter.
+        """
+        new_length = -(-length // self.factor)
+        out_min = group.create_dataset('min', (new_length,), dtype='f4')
+        out_max = group.create_dataset('max', (new_length,), dtype='f4')
+        out_mean = group.create_dataset('mean', (new_length,), dtype='f4')
+        out_x = group.create_dataset('x', (new_length,), dtype='f8') if xs is not None else None
+        for start in range(0, length, self.chunk_size):
+            stop = min(start + self.chunk_size, length)
+            chunk_min = np.asarray(mins[start:stop], dtype='f8')
+            chunk_max = chunk_min if maxs is mins else np.asarray(maxs[start:stop], dtype='f8')
+            chunk_mean = chunk_min if means is mins else np.asarray(means[start:stop], dtype='f8')
+            weights = np.full(stop - start, block, dtype='f8')
+            if stop == length:
+                weights[-1] = raw_length - (length - 1) * block
+            block_starts = np.arange(0, stop - start, self.factor)
+            out_start = start // self.factor
+            out_stop = out_start + len(block_starts)
+            out_min[out_start:out_stop] = np.minimum.reduceat(chunk_min, block_starts)
+            out_max[out_start:out_stop] = np.maximum.reduceat(chunk_max, block_starts)
+            out_mean[out_start:out_stop] = np.add.reduceat(chunk_mean * weights, block_starts) / np.add.reduceat(weights, block_starts)
+            if out_x is not None:
+                out_x[out_start:out_stop] = xs[start:stop:self.factor]
+        return group
+
+    def get_length(self, series : str) -> int:
+        """Returns the length of the source dataset"""
+        return int(self.pyramid[series].attrs['length'])
+
+    def get_x_range(self, series : str):
+        """Returns the x coordinates of the first and the last value of the dataset"""
+        length = self.get_length(series)
+        if length == 0:
+            return 0, 0
+        timestamps = get_timestamps(self.source, series)
+        if timestamps is None:
+            return 0, length - 1
+        return float(timestamps[0]), float(timestamps[length - 1])
+
+    def x_to_index(self, series : str, x : float) -> int:
+        """Finds the index of the first value in the dataset which has its x coordinate at least `x`"""
+        length = self.get_length(series)
+        timestamps = get_timestamps(self.source, series)
+        if timestamps is None:
+            return int(min(max(np.ceil(x), 0), length))
+        low, high = 0, length
+        while low < high:
+            mid = (low + high) // 2
+            if timestamps[mid] < x:
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    def get(self, series : str, x_start : float = None, x_stop : float = None, max_points : int = 2000):
+        """
+        Returns the data of `series` between the x coordinates `x_start` and `x_stop` (the whole dataset
+        if they are None) with at most about `max_points` values. Only the needed part of one level is read.
+
+        The result is a dict with "level" and "x", "min", "max", "mean" numpy arrays. For level 0 all
+        of "min", "max" and "mean" are the source values.
+        """
+        length = self.get_length(series)
+        start = 0 if x_start is None else self.x_to_index(series, x_start)
+        stop = length if x_stop is None else min(self.x_to_index(series, x_stop) + 1, length)
+        start = max(0, min(start, stop - 1))
+        levels = int(self.pyramid[series].attrs['levels'])
+        level = 0
+        while level < levels and (stop - start) / (self.factor ** level) > max_points:
+            level += 1
+
+        timestamps = get_timestamps(self.source, series)
+        if level == 0:
+            ys = np.asarray(self.source[series][start:stop])
+            if timestamps is not None:
+                xs = np.asarray(timestamps[start:stop])
+            else:
+                xs = np.arange(start, stop)
+            return {'level': 0, 'x': xs, 'min': ys, 'max': ys, 'mean': ys}
+
+        block = self.factor ** level
+        level_group = self.pyramid[series][str(level)]
+        level_start = start // block
+        level_stop = -(-stop // block)
+        result = {'level': level}
+        for name in ['min', 'max', 'mean']:
+            result[name] = np.asarray(level_group[name][level_start:level_stop])
+        if 'x' in level_group:
+            result['x'] = np.asarray(level_group['x'][level_start:level_stop])
+        else:
+            result['x'] = np.arange(level_start, level_stop) * block
+        return result
+
+    def close(self):
+        """Closes both the source and the sidecar file"""
+        self.pyramid.close()
+        self.source.close()
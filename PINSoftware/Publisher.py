@@ -0,0 +1,367 @@
+"""
+This file has the `Publisher` which streams the peak voltages to other programs while they are found, and the
+`Subscriber` which is a small client for it. The publisher listens on a local TCP port or a Unix socket (see
+`parse_address`) and any number of subscribers can connect to it. It doesn't need anything from them, it just
+sends them binary frames.
+
+Every frame starts with its length (the number of bytes after it) as a little endian uint32, followed by the frame
+header (`frame_header`: the format version, the frame kind, the channel index and the run number) and then:
+
+* a run frame (kind `RUN_FRAME`, sent when a run starts and to every new subscriber) has the sampling frequency as
+  a float64, the wall clock time of the sample index 0 (a unix timestamp) as a float64 and the number of channels as
+  a uint16,
+* a peaks frame (kind `PEAKS_FRAME`, one per channel in every `Publisher.interval` which has something new) has the
+  number of the new peak voltages and of the new averaged peak voltages as two uint32s, followed by the sample indices
+  (int64) and the values (float32) of the peak voltages and then the sample indices (float64) and the values (float32)
+  of the averaged peak voltages.
+
+The sample indices are the timestamps used in `PINSoftware.DataAnalyser.DataAnalyser`, so they are the same as in
+the saved files. The averaged ones are in the middle of the averaged peak voltages, so they can be halfway between
+two samples, that is why they are floats. A subscriber only gets the peak voltages found after it connected.
+
+The publisher only reads the lists of the `PINSoftware.DataAnalyser.DataAnalyser` from its own thread and all its
+sockets are non-blocking, so it never slows down the acquisition. A subscriber which doesn't read fast enough has its
+frames waiting in memory, once there is more than `Publisher.max_buffer` bytes of them it is disconnected (it can
+connect again and continue from the next frame).
+
+Unix sockets are only available where python supports them (not on Windows).
+
+The client can also be run from the command line with `python -m PINSoftware.Publisher <address>`, it prints the frames.
+"""
+import argparse
+import os
+import selectors
+import socket
+import struct
+import threading
+import time
+
+from typing import Callable, Iterator
+
+import numpy as np
+
+from PINSoftware.Debugger import Debugger
+from PINSoftware.Metrics import MetricsRegistry
+
+
+PROTOCOL_VERSION = 2
+"""The version of the frame format, version 2 sends the averaged sample indices as float64 instead of int64"""
+
+RUN_FRAME = 0
+"""The kind of the frames sent when a run starts"""
+
+PEAKS_FRAME = 1
+"""The kind of the frames with new peak voltages"""
+
+frame_length = struct.Struct('<I')
+"""The length prefix of the frames"""
+
+frame_header = struct.Struct('<BBHI')
+"""The header of the frames, the version, kind, channel index and run number"""
+
+run_body = struct.Struct('<ddH')
+"""The body of a run frame, the sampling frequency, the wall clock time of the sample 0 and the number of channels"""
+
+peaks_counts = struct.Struct('<II')
+"""The start of the body of a peaks frame, the number of the peak voltages and of the averaged peak voltages"""
+
+
+def parse_address(address : str) -> tuple:
+    """
+    Parses a publisher address, "unix:<path>" is a Unix socket and "<host>:<port>" or just "<port>" is a TCP port
+    (on 127.0.0.1 if there is no host). Returns a tuple of the socket family and the address for it. A `ValueError`
+    is raised for an invalid address or a Unix socket where the platform doesn't have them.
+    """
+    if address.startswith("unix:"):
+        if not hasattr(socket, 'AF_UNIX'):
+            raise ValueError("Unix sockets (\"" + address + "\") aren't supported on this platform, use <host>:<port> or <port>")
+        return socket.AF_UNIX, address[len("unix:"):]
+    host, _, port = address.rpartition(":")
+    try:
+        return socket.AF_INET, (host or "127.0.0.1", int(port))
+    except ValueError:
+        raise ValueError("Invalid publisher address \"" + address + "\", use <host>:<port>, <port> or unix:<path>")
+
+
+def encode_frame(kind : int, channel : int, run : int, body : bytes) -> bytes:
+    """Returns a whole frame (with the length prefix) with `body` after the header"""
+    return frame_length.pack(frame_header.size + len(body)) + frame_header.pack(PROTOCOL_VERSION, kind, channel, run) + body
+
+
+def encode_peaks(channel : int, run : int, processed_indices, processed_ys, averaged_indices, averaged_ys) -> bytes:
+    """Returns a peaks frame with the peak voltages and the averaged peak voltages and their sample indices"""
+    return encode_frame(PEAKS_FRAME, channel, run, b"".join([
+        peaks_counts.pack(len(processed_ys), len(averaged_ys)),
+        np.asarray(processed_indices, dtype='<i8').tobytes(),
+        np.asarray(processed_ys, dtype='<f4').tobytes(),
+        np.asarray(averaged_indices, dtype='<f8').tobytes(),
+        np.asarray(averaged_ys, dtype='<f4').tobytes()
+    ]))
+
+
+def decode_frame(payload : bytes) -> dict:
+    """Decodes a frame without its length prefix into a dict, the arrays of a peaks frame are numpy arrays"""
+    version, kind, channel, run = frame_header.unpack_from(payload)
+    if version != PROTOCOL_VERSION:
+        raise ValueError("Unsupported frame version " + str(version))
+    offset = frame_header.size
+    if kind == RUN_FRAME:
+        freq, start_time, channels = run_body.unpack_from(payload, offset)
+        return {'kind': 'run', 'run': run, 'freq': freq, 'start_time': start_time, 'channels': channels}
+    processed_count, averaged_count = peaks_counts.unpack_from(payload, offset)
+    offset += peaks_counts.size
+    frame = {'kind': 'peaks', 'run': run, 'channel': channel}
+    for name, count, index_dtype in [('processed', processed_count, '<i8'), ('averaged', averaged_count, '<f8')]:
+        frame[name + '_indices'] = np.frombuffer(payload, dtype=index_dtype, count=count, offset=offset)
+        offset += 8 * count
+        frame[name + '_ys'] = np.frombuffer(payload, dtype='<f4', count=count, offset=offset)
+        offset += 4 * count
+    return frame
+
+
+class Publisher(threading.Thread):
+    """
+    The thread which sends the new peak voltages of the current run to the subscribers, see the module documentation.
+    It keeps running between the runs, call `Publisher.stop` to stop it.
+    """
+    def __init__(self, get_data : Callable, address : str, interval : float = 0.05, max_buffer : int = 2**22,
+            debugger : Debugger = Debugger(), metrics : MetricsRegistry = None):
+        """
+        `get_data` returns the `PINSoftware.DataAnalyser.DataAnalyser` (or `PINSoftware.DataAnalyser.MultiChannelDataAnalyser`)
+        of the current run or None, a new one means a new run.
+
+        `address` is where to listen, see `parse_address`. If listening fails an `OSError` is raised, if the address
+        isn't valid a `ValueError`.
+
+        `interval` is how often the new peak voltages are sent in seconds, all of them go in one frame per channel.
+
+        `max_buffer` is how many bytes can wait for a subscriber before it is disconnected.
+
+        `debugger` is the `PINSoftware.Debugger.Debugger` to use.
+
+        `metrics` is the `PINSoftware.Metrics.MetricsRegistry` to count the subscribers and frames in (or None).
+        """
+        super().__init__(name="Publisher", daemon=True)
+        self.stop_event = threading.Event()
+        self.get_data = get_data
+        self.address = address
+        self.interval = interval
+        self.max_buffer = max_buffer
+        self.debugger = debugger
+
+        self.family, self.socket_address = parse_address(address)
+        # There is no AF_UNIX on Windows
+        self.is_unix = self.family == getattr(socket, 'AF_UNIX', None)
+        if self.is_unix and os.path.exists(self.socket_address):
+            os.unlink(self.socket_address)
+        self.server = socket.socket(self.family, socket.SOCK_STREAM)
+        try:
+            if self.family == socket.AF_INET:
+                self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.server.bind(self.socket_address)
+            self.server.listen()
+            self.server.setblocking(False)
+        except OSError:
+            self.server.close()
+            raise
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.server, selectors.EVENT_READ)
+        self.subscribers = {}
+
+        self.data = None
+        self.run_number = 0
+        self.run_frame = None
+        self.indices = []
+        self.frames_sent = 0
+        self.disconnected_slow = 0
+        if metrics:
+            metrics.gauge("publisher_subscribers", "Number of connected subscribers").set_function(lambda: len(self.subscribers))
+            self.frames_counter = metrics.counter("publisher_frames_total", "Number of frames published")
+            self.slow_counter = metrics.counter("publisher_slow_disconnects_total", "Number of subscribers disconnected for being too slow")
+        else:
+            self.frames_counter = None
+        self.debugger.info("Publisher: Listening on " + address)
+
+    def accept(self):
+        """Accepts a new subscriber, it gets the run frame of the current run first"""
+        try:
+            connection, peer = self.server.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        connection.setblocking(False)
+        self.subscribers[connection] = bytearray(self.run_frame or b"")
+        self.selector.register(connection, selectors.EVENT_READ | (selectors.EVENT_WRITE if self.run_frame else 0))
+        self.debugger.info("Publisher: A subscriber connected, there are " + str(len(self.subscribers)))
+
+    def disconnect(self, connection : socket.socket, reason : str):
+        """Closes the connection of a subscriber"""
+        self.selector.unregister(connection)
+        del self.subscribers[connection]
+        connection.close()
+        self.debugger.info("Publisher: A subscriber " + reason + ", there are " + str(len(self.subscribers)))
+
+    def flush(self, connection : socket.socket):
+        """Sends as much of the waiting frames of a subscriber as it takes without blocking"""
+        buffer = self.subscribers[connection]
+        try:
+            sent = connection.send(buffer)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except OSError:
+            self.disconnect(connection, "disconnected")
+            return
+        del buffer[:sent]
+        self.selector.modify(connection, selectors.EVENT_READ | (selectors.EVENT_WRITE if buffer else 0))
+
+    def publish(self, frames : list):
+        """Adds `frames` to the waiting frames of every subscriber and sends them, only the publisher thread may call this"""
+        if not frames:
+            return
+        self.frames_sent += len(frames)
+        if self.frames_counter:
+            self.frames_counter.inc(len(frames))
+        message = b"".join(frames)
+        for connection, buffer in list(self.subscribers.items()):
+            if len(buffer) + len(message) > self.max_buffer:
+                self.disconnected_slow += 1
+                if self.frames_counter:
+                    self.slow_counter.inc()
+                self.disconnect(connection, "was too slow and was disconnected")
+                continue
+            buffer += message
+            self.flush(connection)
+
+    def start_run(self, data) -> bytes:
+        """Starts publishing from `data`, the analyser of a new run, and returns its run frame"""
+        self.data = data
+        self.run_number += 1
+        channels = getattr(data, 'channels', [data])
+        self.indices = [[0, 0] for _ in channels]
+        start_time = data.sample_to_time(0) if data.time_anchor_indices else time.time()
+        self.run_frame = encode_frame(RUN_FRAME, 0, self.run_number, run_body.pack(data.freq, start_time, len(channels)))
+        return self.run_frame
+
+    def collect(self) -> list:
+        """Returns the frames with the new peak voltages of all the channels of the current run"""
+        frames = []
+        data = self.get_data()
+        if data is None:
+            return frames
+        if data is not self.data:
+            frames.append(self.start_run(data))
+        for channel_index, (channel, indices) in enumerate(zip(getattr(data, 'channels', [data]), self.indices)):
+            new = []
+            for i, (timestamps, values) in enumerate([(channel.processed_timestamps, channel.processed_ys),
+                    (channel.averaged_processed_timestamps, channel.averaged_processed_ys)]):
+                # The value and its timestamp are appended one after the other, only the pairs which are both there are taken
+                end = min(len(timestamps), len(values))
+                new += [timestamps[indices[i]:end], values[indices[i]:end]]
+                indices[i] = end
+            if new[1] or new[3]:
+                frames.append(encode_peaks(channel_index, self.run_number, *new))
+        return frames
+
+    def run(self):
+        """This method is called when `Publisher.start` is called, it is the main loop"""
+        next_publish = time.monotonic()
+        while not self.stop_event.is_set():
+            for key, events in self.selector.select(max(0, next_publish - time.monotonic())):
+                connection = key.fileobj
+                if connection is self.server:
+                    self.accept()
+                    continue
+                if connection not in self.subscribers:
+                    continue
+                if events & selectors.EVENT_READ:
+                    # The subscribers don't send anything, reading only finds out when they disconnect
+                    try:
+                        received = connection.recv(4096)
+                    except (BlockingIOError, InterruptedError):
+                        received = None
+                    except OSError:
+                        received = b""
+                    if received == b"":
+                        self.disconnect(connection, "disconnected")
+                        continue
+                if events & selectors.EVENT_WRITE:
+                    self.flush(connection)
+            if time.monotonic() >= next_publish:
+                next_publish += self.interval
+                self.publish(self.collect())
+        for connection in list(self.subscribers):
+            self.disconnect(connection, "was disconnected because the publisher stopped")
+        self.selector.close()
+        self.server.close()
+        if self.is_unix and os.path.exists(self.socket_address):
+            os.unlink(self.socket_address)
+
+    def stop(self):
+        """Stops the thread, it disconnects all the subscribers and closes the socket"""
+        self.stop_event.set()
+
+
+class Subscriber():
+    """
+    A client of the `Publisher`, it connects to it and `Subscriber.frames` yields the decoded frames (see `decode_frame`).
+    It only needs the standard library and numpy.
+    """
+    def __init__(self, address : str, timeout : float = None):
+        """`address` is the address of the publisher (see `parse_address`), `timeout` is the socket timeout in seconds"""
+        family, socket_address = parse_address(address)
+        self.socket = socket.socket(family, socket.SOCK_STREAM)
+        self.socket.settimeout(timeout)
+        self.socket.connect(socket_address)
+        self.buffer = bytearray()
+
+    def read_exactly(self, count : int) -> bytes:
+        """Reads `count` bytes, returns None if the publisher closed the connection"""
+        while len(self.buffer) < count:
+            received = self.socket.recv(max(65536, count - len(self.buffer)))
+            if not received:
+                return None
+            self.buffer += received
+        result = bytes(self.buffer[:count])
+        del self.buffer[:count]
+        return result
+
+    def read_frame(self) -> dict:
+        """Reads and decodes the next frame, returns None if the publisher closed the connection"""
+        prefix = self.read_exactly(frame_length.size)
+        if prefix is None:
+            return None
+        payload = self.read_exactly(frame_length.unpack(prefix)[0])
+        return decode_frame(payload) if payload is not None else None
+
+    def frames(self) -> Iterator[dict]:
+        """Yields the frames until the publisher closes the connection"""
+        while True:
+            frame = self.read_frame()
+            if frame is None:
+                return
+            yield frame
+
+    def close(self):
+        self.socket.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prints the frames sent by the publisher of the server.")
+    parser.add_argument("address", help="The address of the publisher, <host>:<port>, <port> or unix:<path>.")
+    args = parser.parse_args()
+    subscriber = Subscriber(args.address)
+    try:
+        for frame in subscriber.frames():
+            if frame['kind'] == 'run':
+                print("Run " + str(frame['run']) + ": " + str(frame['channels']) + " channels at " + str(frame['freq']) + " Hz")
+            else:
+                print("Channel " + str(frame['channel']) + ": " + str(len(frame['processed_ys'])) + " peak voltages, " +
+                    str(len(frame['averaged_ys'])) + " averaged" +
+                    (", last " + str(frame['processed_ys'][-1]) + " at " + str(frame['processed_indices'][-1]) if len(frame['processed_ys']) else ""))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        subscriber.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,287 @@
+"""
+This file has the rolling statistics of the peak voltages. A `RollingStats` keeps several sliding windows
+(`RollingWindow`s) over the latest peak voltages, either the last N peaks or the peaks from the last few seconds,
+and updates all of them as every peak is found. Each window knows its mean, standard deviation, minimum, maximum,
+approximate median and the number of peaks per second at any time, so the graphs and the API only read the current
+values instead of going through the lists of peak voltages again.
+
+Every update takes constant time (amortized for the minimum and maximum): the mean and the variance are updated
+using Welford's algorithm (also when a value leaves the window), the minimum and maximum are kept in monotonic
+queues and the median is estimated by the P² algorithm (`P2Quantile`) which doesn't keep the values at all.
+"""
+import collections
+import math
+import threading
+
+
+default_windows = [
+    ('last_100', 'count', 100),
+    ('last_1000', 'count', 1000),
+    ('last_1s', 'time', 1),
+    ('last_10s', 'time', 10),
+    ('live_5', 'time', 5)
+]
+"""
+The windows a `PINSoftware.DataAnalyser.DataAnalyser` keeps by default as (name, kind, size), the size is a number
+of peaks for 'count' windows and seconds for 'time' windows. 'live_5' is the window of the live graph showing the default
+5 seconds, the windows for the other intervals are added when they are needed (see `RollingStats.get_live_window`).
+"""
+
+max_live_windows = 8
+"""The most live graph windows a `RollingStats` makes, see `RollingStats.get_live_window`"""
+
+
+class P2Quantile():
+    """
+    Estimates a quantile of a stream of values without keeping them, using the P² algorithm of Jain and Chlamtac.
+    It keeps 5 markers whose heights follow the minimum, the quantile, the maximum and two points between them.
+    """
+    def __init__(self, p : float = 0.5):
+        """`p` is the quantile to estimate, 0.5 is the median"""
+        self.p = p
+        self.count = 0
+        self.heights = []
+        self.positions = [1, 2, 3, 4, 5]
+        self.desired = [1, 1 + 2 * p, 1 + 4 * p, 3 + 2 * p, 5]
+        self.increments = [0, p / 2, p, (1 + p) / 2, 1]
+
+    def add(self, x : float):
+        """Adds a value"""
+        self.count += 1
+        heights = self.heights
+        if self.count <= 5:
+            heights.append(x)
+            heights.sort()
+            return
+        if x < heights[0]:
+            heights[0] = x
+            k = 0
+        elif x >= heights[4]:
+            heights[4] = x
+            k = 3
+        else:
+            k = 0
+            while x >= heights[k + 1]:
+                k += 1
+        positions = self.positions
+        for i in range(k + 1, 5):
+            positions[i] += 1
+        desired = self.desired
+        for i in range(5):
+            desired[i] += self.increments[i]
+        for i in range(1, 4):
+            d = desired[i] - positions[i]
+            if (d >= 1 and positions[i + 1] - positions[i] > 1) or (d <= -1 and positions[i - 1] - positions[i] < -1):
+                d = 1 if d > 0 else -1
+                height = self.parabolic(i, d)
+                if not heights[i - 1] < height < heights[i + 1]:
+                    height = heights[i] + d * (heights[i + d] - heights[i]) / (positions[i + d] - positions[i])
+                heights[i] = height
+                positions[i] += d
+
+    def parabolic(self, i : int, d : int) -> float:
+        """The piecewise parabolic prediction of the new height of marker `i` moved by `d`"""
+        q, n = self.heights, self.positions
+        return q[i] + d / (n[i + 1] - n[i - 1]) * ((n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i]) +
+            (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1]))
+
+    def value(self) -> float:
+        """Returns the estimate of the quantile (exact for up to 5 values) or None if there were no values"""
+        if self.count == 0:
+            return None
+        if self.count <= 5:
+            return self.heights[min(int(self.p * self.count), self.count - 1)]
+        return self.heights[2]
+
+
+class RollingWindow():
+    """
+    The statistics of the peak voltages in a sliding window, either the last `size` peaks ('count') or
+    the peaks from the last `size` seconds ('time'). The timestamps are indices of the raw data
+    (like in `PINSoftware.DataAnalyser.DataAnalyser`), `freq` converts them to seconds.
+
+    The median can't be removed from when values leave the window, so it is estimated by two `P2Quantile`s
+    which are restarted in turns every half of the window, the older one is used, it always covers between
+    a half and the whole of the window.
+    """
+    def __init__(self, kind : str, size : float, freq : int):
+        if kind not in ('count', 'time'):
+            raise ValueError("Unknown window kind \"" + kind + "\"")
+        self.kind = kind
+        self.freq = freq
+        self.values = collections.deque()
+        self.timestamps = collections.deque()
+        # Monotonic queues of (sequence number, value), the front is the minimum (maximum) of the window
+        self.mins = collections.deque()
+        self.maxs = collections.deque()
+        self.sequence = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        # The window has all the peaks since this timestamp, it is later than the start of the window after it grows
+        self.complete_from = None
+        self.size = None
+        self.resize(size)
+        self.older_quantile = P2Quantile()
+        self.newer_quantile = P2Quantile()
+        self.newer_start = None
+
+    def resize(self, size : float):
+        """Changes the size of the window, when it gets bigger it fills up as new peaks come"""
+        length = size * self.freq if self.kind == 'time' else size
+        if self.size is not None and self.timestamps and length > self.length and self.kind == 'time':
+            self.complete_from = max(self.complete_from, self.timestamps[-1] - self.length)
+        self.size = size
+        self.length = length
+        self.half = self.length / 2
+        if self.timestamps:
+            self.evict(self.timestamps[-1])
+
+    def add(self, timestamp : int, value : float):
+        """Adds the peak voltage `value` found at `timestamp`"""
+        if self.complete_from is None:
+            self.complete_from = timestamp
+        self.values.append(value)
+        self.timestamps.append(timestamp)
+        n = len(self.values)
+        delta = value - self.mean
+        self.mean += delta / n
+        self.m2 += delta * (value - self.mean)
+
+        sequence = self.sequence
+        self.sequence += 1
+        mins, maxs = self.mins, self.maxs
+        while mins and mins[-1][1] >= value:
+            mins.pop()
+        mins.append((sequence, value))
+        while maxs and maxs[-1][1] <= value:
+            maxs.pop()
+        maxs.append((sequence, value))
+
+        position = timestamp if self.kind == 'time' else sequence
+        if self.newer_start is None:
+            self.newer_start = position
+        elif position - self.newer_start >= self.half:
+            self.older_quantile = self.newer_quantile
+            self.newer_quantile = P2Quantile()
+            self.newer_start = position
+        self.older_quantile.add(value)
+        self.newer_quantile.add(value)
+        self.evict(timestamp)
+
+    def evict(self, now : int):
+        """Removes the values which aren't in the window at the time `now` anymore"""
+        values, timestamps = self.values, self.timestamps
+        if self.kind == 'time':
+            oldest = now - self.length
+            while timestamps and timestamps[0] <= oldest:
+                self.remove_oldest()
+        else:
+            while len(values) > self.length:
+                self.remove_oldest()
+
+    def remove_oldest(self):
+        """Removes the oldest value of the window"""
+        value = self.values.popleft()
+        self.timestamps.popleft()
+        n = len(self.values)
+        if n == 0:
+            self.mean = 0.0
+            self.m2 = 0.0
+        else:
+            delta = value - self.mean
+            self.mean -= delta / n
+            self.m2 = max(self.m2 - delta * (value - self.mean), 0.0)
+        first_sequence = self.sequence - n
+        if self.mins[0][0] < first_sequence:
+            self.mins.popleft()
+        if self.maxs[0][0] < first_sequence:
+            self.maxs.popleft()
+
+    def peak_rate(self, now : int) -> float:
+        """
+        Returns the number of peaks per second, for a time window the span is the window (or the time since the first
+        peak if it is shorter)
+        """
+        count = len(self.values)
+        if self.kind == 'time':
+            span = min(self.length, now - self.complete_from) if self.complete_from is not None else 0
+            return count * self.freq / span if span > 0 else None
+        if count < 2:
+            return None
+        span = self.timestamps[-1] - self.timestamps[0]
+        return (count - 1) * self.freq / span if span > 0 else None
+
+    def summary(self, now : int) -> dict:
+        """Returns the current statistics as a dict, `now` is the current timestamp (time windows are evicted up to it)"""
+        if self.kind == 'time':
+            self.evict(now)
+        count = len(self.values)
+        if count == 0:
+            return {'kind': self.kind, 'size': self.size, 'count': 0, 'mean': None, 'std': None, 'min': None, 'max': None,
+                'median': None, 'peaks_per_s': self.peak_rate(now)}
+        return {
+            'kind': self.kind,
+            'size': self.size,
+            'count': count,
+            'mean': self.mean,
+            'std': math.sqrt(self.m2 / count),
+            'min': self.mins[0][1],
+            'max': self.maxs[0][1],
+            'median': self.older_quantile.value(),
+            'peaks_per_s': self.peak_rate(now)
+        }
+
+
+class RollingStats():
+    """
+    A set of named `RollingWindow`s which are all updated with every peak voltage. It is thread safe, the
+    peaks are added from the acquisition thread while the summaries are read from the server threads.
+    """
+    def __init__(self, freq : int, windows : list = default_windows):
+        """`freq` is the frequency of the raw data and `windows` is a list of (name, kind, size) like `default_windows`"""
+        self.freq = freq
+        self.lock = threading.Lock()
+        self.windows = {name: RollingWindow(kind, size, freq) for name, kind, size in windows}
+        self.total = 0
+
+    def add(self, timestamp : int, value : float):
+        """Adds the peak voltage `value` found at `timestamp` to all the windows"""
+        with self.lock:
+            self.total += 1
+            for window in self.windows.values():
+                window.add(timestamp, value)
+
+    def get_live_window(self, size : float) -> str:
+        """
+        Returns the name of the time window of `size` seconds for the live graph. Every interval shown by a client gets
+        its own window (named "live_<size>"), it is made the first time it is asked for and it is never resized, so the
+        clients showing different intervals don't change each other's statistics. A new window fills up as new peaks come.
+        When there are already `max_live_windows` of them, the one closest to `size` is used instead.
+        """
+        name = 'live_' + format(size, 'g')
+        with self.lock:
+            if name not in self.windows:
+                live = [existing for existing in self.windows if existing.startswith('live_')]
+                if len(live) >= max_live_windows:
+                    return min(live, key=lambda existing: abs(self.windows[existing].size - size))
+                self.windows[name] = RollingWindow('time', size, self.freq)
+            return name
+
+    def resize(self, name : str, size : float):
+        """Changes the size of the window `name`"""
+        with self.lock:
+            self.windows[name].resize(size)
+
+    def window_summary(self, name : str, now : int) -> dict:
+        """Returns the `RollingWindow.summary` of the window `name`"""
+        with self.lock:
+            return self.windows[name].summary(now)
+
+    def summary(self, now : int) -> dict:
+        """Returns the summaries of all the windows, `now` is the current timestamp"""
+        with self.lock:
+            return {
+                'total': self.total,
+                'seconds': now / self.freq,
+                'windows': {name: window.summary(now) for name, window in self.windows.items()}
+            }
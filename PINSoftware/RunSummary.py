@@ -0,0 +1,175 @@
+"""
+This file summarises saved runs so they can be compared. `summarise_run` reads a single hdf5 run
+in chunks and calculates its duration, sample count, peak rate, statistics of the peak voltages,
+the irregular data fraction and the number of gaps in the peak timestamps. `RunSummaryCache`
+summarises whole directories of runs in a process pool and remembers the results by the file path and
+modification time, so only new or changed runs are summarised again.
+
+The summaries are shown in the History tab and served as csv at /runs/summary.csv. They can also be made
+from the command line by `python -m PINSoftware.RunSummary <directory>`.
+"""
+import argparse
+import concurrent.futures
+import csv
+import datetime
+import io
+import json
+import multiprocessing
+import os
+import sys
+import threading
+
+import h5py
+import numpy as np
+
+from PINSoftware.util import find_gaps, summary_stats
+
+
+summary_columns = ['filename', 'start', 'duration', 'samples', 'peaks', 'peak_rate', 'mean', 'std', 'p5', 'p50', 'p95',
+    'irregular_count', 'irregular_fraction', 'gaps', 'edge_detection_threshold', 'average_count', 'error']
+"""The columns of the summary table, in order"""
+
+
+def get_run_start(filename : str) -> str:
+    """Returns the start of the run from the timestamp in its filename (added by the `PINSoftware.DataSaver`) or None"""
+    try:
+        return str(datetime.datetime.strptime(os.path.splitext(os.path.basename(filename))[0][-13:], "%y%m%d-%H%M%S"))
+    except ValueError:
+        return None
+
+
+def summarise_run(filename : str, gap_tolerance : float = 1, chunk_size : int = 2**20) -> dict:
+    """
+    Returns the summary of the hdf5 run `filename` as a dict with the keys in `summary_columns` (the values
+    which can't be calculated for the run are None). The duration is in seconds, the peak rate in peaks per
+    second. Gaps are the spots where the time between two peak voltages differs from the usual time (the median)
+    by more than `gap_tolerance` samples. If the file can't be read, only 'filename' and 'error' are set.
+    """
+    summary = dict.fromkeys(summary_columns)
+    summary['filename'] = os.path.basename(filename)
+    try:
+        with h5py.File(filename, 'r') as f:
+            freq = f.attrs.get('freq', 50000)
+            summary['start'] = get_run_start(filename)
+            summary['edge_detection_threshold'] = float(f.attrs['edge_detection_threshold']) if 'edge_detection_threshold' in f.attrs else None
+            summary['average_count'] = int(f.attrs['average_count']) if 'average_count' in f.attrs else None
+            if 'ys' in f:
+                summary['samples'] = len(f['ys'])
+                summary['duration'] = len(f['ys']) / freq
+            if 'processed_ys' in f:
+                processed_ys = f['processed_ys']
+                timestamps = f['processed_timestamps']
+                summary['peaks'] = len(processed_ys)
+                if summary['duration'] is None and len(timestamps):
+                    summary['duration'] = float(timestamps[-1]) / freq
+                if summary['duration']:
+                    summary['peak_rate'] = len(processed_ys) / summary['duration']
+                stats = summary_stats(processed_ys, chunk_size)
+                summary['mean'], summary['std'] = stats['mean'], stats['std']
+                if len(processed_ys):
+                    # The peak voltages are a small fraction of the raw data, reading them at once is fine
+                    summary['p5'], summary['p50'], summary['p95'] = (float(x) for x in np.percentile(processed_ys[:], [5, 50, 95]))
+                if len(timestamps) > 1:
+                    period = float(np.median(np.diff(timestamps[:min(len(timestamps), 10000)])))
+                    summary['gaps'] = sum(1 for _ in find_gaps(timestamps, period, gap_tolerance, chunk_size))
+            if 'irregular_count' in f.attrs:
+                summary['irregular_count'] = int(f.attrs['irregular_count'])
+                found = summary['irregular_count'] + (summary['peaks'] or 0)
+                summary['irregular_fraction'] = summary['irregular_count'] / found if found else 0
+    except (OSError, KeyError, ValueError) as e:
+        return {'filename': os.path.basename(filename), 'error': str(e)}
+    return summary
+
+
+def summaries_to_csv(summaries : list) -> str:
+    """Returns the summaries as a csv table"""
+    output = io.StringIO()
+    writer = csv.DictWriter(output, summary_columns, extrasaction='ignore')
+    writer.writeheader()
+    writer.writerows(summaries)
+    return output.getvalue()
+
+
+class RunSummaryCache():
+    """
+    Summarises the runs in directories and caches the summaries in a json file, they are keyed by
+    the full path of the run and its modification time. Failed summaries are cached too, a run
+    which is still being recorded keeps changing so it is tried again later.
+    """
+    def __init__(self, cache_filename : str, workers : int = None):
+        """
+        `cache_filename` is the json file to keep the summaries in, it is created if it doesn't exist.
+
+        `workers` is the number of processes to summarise with, by default the number of cores.
+        """
+        self.cache_filename = cache_filename
+        self.workers = workers
+        self.lock = threading.Lock()
+        try:
+            with open(cache_filename) as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def save(self):
+        """Writes the cache into its file"""
+        os.makedirs(os.path.dirname(os.path.abspath(self.cache_filename)), exist_ok=True)
+        temporary_filename = self.cache_filename + ".tmp"
+        with open(temporary_filename, 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(temporary_filename, self.cache_filename)
+
+    def summarise(self, filenames : list) -> list:
+        """Returns the summaries of `filenames`, only the ones which aren't cached are summarised (in parallel)"""
+        with self.lock:
+            summaries = {}
+            missing = []
+            for filename in filenames:
+                key = os.path.abspath(filename)
+                entry = self.entries.get(key)
+                if entry and entry['mtime'] == os.path.getmtime(filename):
+                    summaries[filename] = entry['summary']
+                else:
+                    missing.append(filename)
+            if len(missing) == 1:
+                # Starting a process pool isn't worth it for a single run
+                new_summaries = [summarise_run(missing[0])]
+            elif missing:
+                # Spawned processes don't inherit the threads (and locks) of the server
+                with concurrent.futures.ProcessPoolExecutor(min(self.workers or os.cpu_count(), len(missing)),
+                        mp_context=multiprocessing.get_context("spawn")) as executor:
+                    new_summaries = list(executor.map(summarise_run, missing))
+            if missing:
+                for filename, summary in zip(missing, new_summaries):
+                    summaries[filename] = summary
+                    self.entries[os.path.abspath(filename)] = {'mtime': os.path.getmtime(filename), 'summary': summary}
+                for key in [key for key in self.entries if not os.path.exists(key)]:
+                    del self.entries[key]
+                self.save()
+            return [summaries[filename] for filename in filenames]
+
+    def summarise_directory(self, directory : str) -> list:
+        """Returns the summaries of all the hdf5 runs in `directory` (sorted by name)"""
+        filenames = sorted(os.path.join(directory, name) for name in os.listdir(directory)
+            if name.endswith('.hdf5') and os.path.isfile(os.path.join(directory, name)))
+        return self.summarise(filenames)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarises all the saved hdf5 runs in a directory.")
+    parser.add_argument("directory", help="The directory with the runs.")
+    parser.add_argument("--output", "-o", default=None, help="Where to save the csv table, by default it is printed.")
+    parser.add_argument("--workers", "-w", type=int, default=None, help="How many processes to use, by default the number of cores.")
+    parser.add_argument("--cache", default=None, help="The cache file, by default \".summaries.json\" in the directory.")
+    args = parser.parse_args()
+    cache = RunSummaryCache(args.cache or os.path.join(args.directory, ".summaries.json"), args.workers)
+    table = summaries_to_csv(cache.summarise_directory(args.directory))
+    if args.output:
+        with open(args.output, 'w', newline='') as f:
+            f.write(table)
+    else:
+        sys.stdout.write(table)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""
+This file has the `SamplingProfiler`, a profiler which can be turned on while the server is running.
+Instead of hooking into every function call (like `cProfile`), it looks at the stacks of all threads
+in regular intervals and counts where they are, so it is cheap enough to run during acquisition
+and costs nothing when it is not running. The results are saved as a pstats file (which can be
+opened with `pstats.Stats` or tools like snakeviz) and as a collapsed stack file which can be turned
+into a flame graph by flamegraph.pl, speedscope and other tools.
+"""
+import datetime
+import marshal
+import os
+import sys
+import threading
+import time
+
+from PINSoftware.Debugger import Debugger
+
+
+class SamplingProfiler(threading.Thread):
+    """
+    A thread which samples the stacks of all other threads every `interval` seconds for `duration`
+    seconds and then writes the results into `output_directory`. The names of the output files
+    are available as `SamplingProfiler.pstats_filename` and `SamplingProfiler.collapsed_filename`
+    as soon as it is created.
+    """
+    def __init__(self, duration : float, output_directory : str, interval : float = 0.005,
+            base_filename : str = "sampling", debugger : Debugger = Debugger()):
+        """
+        `duration` is how long to sample for in seconds.
+
+        `output_directory` is where to save the results.
+
+        `interval` is the time between samples in seconds.
+
+        `base_filename` is the start of the output filenames, a timestamp and extension is added to it.
+
+        `debugger` is the `PINSoftware.Debugger.Debugger` to use.
+        """
+        super().__init__(name="SamplingProfiler", daemon=True)
+        self.should_stop = False
+        self.duration = duration
+        self.interval = interval
+        self.debugger = debugger
+        filename = os.path.join(output_directory, base_filename + datetime.datetime.now().strftime("%y%m%d-%H%M%S"))
+        self.pstats_filename = filename + ".pstats"
+        self.collapsed_filename = filename + ".collapsed.txt"
+        self.samples = 0
+        self.collapsed = {}
+        self.stats = {}
+
+    def add_sample(self, thread_name : str, frame, weight : float):
+        """Adds the stack ending in `frame` to the results, `weight` is the time it represents"""
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+            frame = frame.f_back
+        stack.reverse()
+
+        key = thread_name + ";" + ";".join(name + " (" + os.path.basename(filename) + ":" + str(line) + ")"
+                for filename, line, name in stack)
+        self.collapsed[key] = self.collapsed.get(key, 0) + 1
+
+        # pstats entries are [primitive calls, calls, own time, cumulative time, callers], a sample counts as a call
+        seen = set()
+        for i, func in enumerate(stack):
+            entry = self.stats.get(func)
+            if entry is None:
+                entry = self.stats[func] = [0, 0, 0.0, 0.0, {}]
+            if func not in seen:
+                seen.add(func)
+                entry[0] += 1
+                entry[1] += 1
+                entry[3] += weight
+            if i == len(stack) - 1:
+                entry[2] += weight
+            if i > 0:
+                caller = entry[4].setdefault(stack[i - 1], [0, 0, 0.0, 0.0])
+                caller[0] += 1
+                caller[1] += 1
+                caller[3] += weight
+                if i == len(stack) - 1:
+                    caller[2] += weight
+
+    def run(self):
+        """Samples until `duration` runs out (or `SamplingProfiler.stop` is called) and saves the results"""
+        self.debugger.info("SamplingProfiler: Sampling all threads for " + str(self.duration) + " s")
+        own_ident = threading.get_ident()
+        end = time.monotonic() + self.duration
+        last = time.monotonic()
+        while not self.should_stop and last < end:
+            time.sleep(self.interval)
+            now = time.monotonic()
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident != own_ident:
+                    self.add_sample(names.get(ident, str(ident)), frame, now - last)
+            self.samples += 1
+            last = now
+        self.save()
+        self.debugger.info("SamplingProfiler: Took " + str(self.samples) + " samples, saved to \"" +
+                self.pstats_filename + "\" and \"" + self.collapsed_filename + "\"")
+
+    def save(self):
+        """Writes the pstats and the collapsed stacks files"""
+        stats = {func: (cc, nc, tt, ct, {caller: tuple(values) for caller, values in callers.items()})
+                for func, (cc, nc, tt, ct, callers) in self.stats.items()}
+        with open(self.pstats_filename, 'wb') as f:
+            marshal.dump(stats, f)
+        with open(self.collapsed_filename, 'w') as f:
+            for key, count in sorted(self.collapsed.items()):
+                f.write(key + " " + str(count) + "\n")
+
+    def stop(self):
+        """Stops the sampling early, the results are still saved"""
+        self.should_stop = True
@@ -0,0 +1,137 @@
+"""
+This file has the `SpectrumAnalyser`, an optional analysis which calculates the power spectral density of the raw
+data using Welch's method, so electrical noise on the sample and hold line can be seen. It runs in its own thread
+off the acquisition path, every `update_interval` seconds it takes the raw data added since the last update,
+splits it into overlapping segments (by a strided view, no copying) and transforms all of them at once.
+
+The spectra of the segments are averaged two ways, the current spectrum is an exponential average over
+about the last `averages` segments and the spectrum of the whole run is the plain average of all the segments.
+The current one is shown in the Spectrum tab and the whole run one is saved with the run.
+
+To keep the cost bounded, at most `max_segments` segments are transformed per update, when more raw data came
+only the newest is used (the skipped segments are counted).
+"""
+import threading
+import time
+
+import numpy as np
+
+from PINSoftware.DataAnalyser import DataAnalyser
+
+
+def welch_segments(values : np.ndarray, segment_length : int, step : int) -> np.ndarray:
+    """Returns a (segments, segment_length) view of `values` with the segments starting every `step` values"""
+    count = (len(values) - segment_length) // step + 1
+    if count <= 0:
+        return np.empty((0, segment_length))
+    stride = values.strides[0]
+    return np.lib.stride_tricks.as_strided(values, shape=(count, segment_length), strides=(step * stride, stride), writeable=False)
+
+
+class SpectrumAnalyser(threading.Thread):
+    """
+    The thread calculating the power spectral density of the raw data of a `PINSoftware.DataAnalyser.DataAnalyser`.
+    Call `SpectrumAnalyser.stop` to stop it. The spectra are in V²/Hz, one-sided, like `scipy.signal.welch`
+    with a Hann window, 50 % overlap and constant detrending.
+    """
+    def __init__(self, data : DataAnalyser, segment_length : int = 4096, averages : int = 16,
+            update_interval : float = 0.5, max_segments : int = 64):
+        """
+        `data` is the `PINSoftware.DataAnalyser.DataAnalyser` whose raw data is analysed.
+
+        `segment_length` is the number of values in a segment, it sets the frequency resolution (`freq / segment_length`).
+
+        `averages` is about how many of the latest segments the current spectrum is averaged over.
+
+        `update_interval` is how often the new raw data is analysed in seconds.
+
+        `max_segments` is the maximum number of segments transformed in a single update.
+        """
+        super().__init__(name="SpectrumAnalyser")
+        self.stop_event = threading.Event()
+        self.data = data
+        self.debugger = data.debugger
+        self.segment_length = segment_length
+        self.step = segment_length // 2
+        self.averages = averages
+        self.update_interval = update_interval
+        self.max_segments = max_segments
+        self.lock = threading.Lock()
+
+        # A periodic Hann window, like scipy uses for spectral analysis
+        self.window = 0.5 - 0.5 * np.cos(2 * np.pi * np.arange(segment_length) / segment_length)
+        self.scale = np.full(segment_length // 2 + 1, 2 / (data.freq * (self.window ** 2).sum()))
+        self.scale[0] /= 2
+        if segment_length % 2 == 0:
+            self.scale[-1] /= 2
+        self.frequencies = np.fft.rfftfreq(segment_length, 1 / data.freq)
+
+        self.read_index = len(data.ys)
+        self.remainder = np.empty(0)
+        self.current = None
+        self.total = np.zeros(len(self.frequencies))
+        self.segments = 0
+        self.skipped_segments = 0
+        self.update_duration = 0
+
+    def transform(self, segments : np.ndarray) -> np.ndarray:
+        """Returns the power spectral densities of `segments` (one per row)"""
+        detrended = segments - segments.mean(axis=1, keepdims=True)
+        spectra = np.fft.rfft(detrended * self.window, axis=1)
+        return (spectra.real ** 2 + spectra.imag ** 2) * self.scale
+
+    def update(self):
+        """Analyses the raw data added since the last update"""
+        new_index = len(self.data.ys)
+        # Only what fits into max_segments (and the overlap) is read, older data is skipped
+        limit = (self.max_segments - 1) * self.step + self.segment_length
+        read_from = max(self.read_index, new_index - limit)
+        if read_from > self.read_index:
+            skipped = read_from - self.read_index + len(self.remainder)
+            self.skipped_segments += skipped // self.step
+            self.remainder = np.empty(0)
+        new = np.asarray(self.data.ys[read_from:new_index], dtype='f8')
+        self.read_index = new_index
+        values = np.concatenate((self.remainder, new)) if len(self.remainder) else new
+        segments = welch_segments(values, self.segment_length, self.step)
+        if len(segments) == 0:
+            self.remainder = values
+            return
+        self.remainder = values[len(segments) * self.step:]
+        spectra = self.transform(segments)
+        with self.lock:
+            self.total += spectra.sum(axis=0)
+            self.segments += len(segments)
+            # Exponential averaging with the weight of 1 / averages per segment
+            weight = (1 - 1 / self.averages) ** len(segments)
+            mean = spectra.mean(axis=0)
+            self.current = mean if self.current is None else weight * self.current + (1 - weight) * mean
+
+    def get(self, total : bool = False) -> tuple:
+        """
+        Returns the frequencies and a copy of the current spectrum (or the average spectrum of the whole
+        run if `total`) as numpy arrays, the spectrum is None if no segment was analysed yet.
+        """
+        with self.lock:
+            if total:
+                return self.frequencies, self.total / self.segments if self.segments else None
+            return self.frequencies, self.current.copy() if self.current is not None else None
+
+    def run(self):
+        """This method is called when `SpectrumAnalyser.start` is called, it is the main loop"""
+        self.debugger.info("SpectrumAnalyser: Starting")
+        next_call = time.time()
+        while not self.stop_event.is_set():
+            next_call += self.update_interval
+            if self.stop_event.wait(max(0, next_call - time.time())):
+                break
+            start = time.perf_counter()
+            self.update()
+            self.update_duration = time.perf_counter() - start
+        # The acquisition is stopped before this thread, so the last update covers the end of the run too
+        self.update()
+        self.debugger.info("SpectrumAnalyser: Stopped successfully")
+
+    def stop(self):
+        """Stops the thread, it stops waiting for the next update right away and does the last one"""
+        self.stop_event.set()
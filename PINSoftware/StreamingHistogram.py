@@ -0,0 +1,155 @@
+"""
+This file has the `StreamingHistogram`, the histogram of the peak voltages which `PINSoftware.DataAnalyser.DataAnalyser`
+updates as every peak voltage is found. Adding a value only increments one bin, so the distribution can be
+shown at any time without going through all the peak voltages again.
+
+The bins either have a fixed range, then the values outside of it are only counted (as underflow and overflow),
+or they range automatically. Auto-ranging bins are set from the first few values and whenever a value falls outside
+of them, the range is doubled towards it by merging neighbouring bins, so the counts stay exact, only coarser.
+The range is never narrowed again, so it only grows up to `max_range_factor` times the initial one, the values
+outside of that are outliers (like a single glitch) and are counted as underflow and overflow, so they don't make
+the bins coarse for the rest of the run.
+
+The histogram keeps two sets of counts with the same bins, the counts of the whole run and the counts of the current
+window, which is restarted every `reset_interval` seconds (if it is set).
+"""
+import math
+import threading
+
+import numpy as np
+
+
+class StreamingHistogram():
+    """
+    A histogram which is updated one value at a time. It is thread safe, the values are added from the
+    acquisition thread while the counts are read from the server threads. The timestamps are indices of the raw
+    data (like in `PINSoftware.DataAnalyser.DataAnalyser`), `freq` converts them to seconds.
+    """
+    def __init__(self, freq : int, bins : int = 100, value_range : tuple = None, reset_interval : float = None,
+            initial_count : int = 50, max_range_factor : int = 16):
+        """
+        `freq` is the frequency of the raw data.
+
+        `bins` is the number of bins (it is made even when auto-ranging so that pairs of bins can be merged).
+
+        `value_range` is the (low, high) range of the bins, if it is None the bins range automatically.
+
+        `reset_interval` is how often in seconds the window counts are restarted, if it is None they never are.
+
+        `initial_count` is how many values are collected before auto-ranging bins are set.
+
+        `max_range_factor` is how many times the auto-ranging bins can grow wider than the initial ones.
+        """
+        self.freq = freq
+        self.auto_range = value_range is None
+        self.bins = bins + bins % 2 if self.auto_range else bins
+        self.initial_count = initial_count
+        self.max_range_factor = max_range_factor
+        self.lock = threading.Lock()
+        self.counts = np.zeros(self.bins, dtype='i8')
+        self.total_counts = np.zeros(self.bins, dtype='i8')
+        self.underflow = 0
+        self.overflow = 0
+        self.nonfinite = 0
+        self.initial_values = []
+        self.window_start = None
+        self.set_reset_interval(reset_interval)
+        if self.auto_range:
+            self.low = None
+            self.width = None
+        else:
+            self.low = value_range[0]
+            self.width = (value_range[1] - value_range[0]) / bins
+
+    def set_reset_interval(self, reset_interval : float):
+        """Changes how often the window counts are restarted (in seconds, None means never)"""
+        self.reset_interval = reset_interval
+        self.reset_length = reset_interval * self.freq if reset_interval else None
+
+    def add(self, timestamp : int, value : float):
+        """Adds the peak voltage `value` found at `timestamp`"""
+        with self.lock:
+            if self.window_start is None:
+                self.window_start = timestamp
+            elif self.reset_length and timestamp - self.window_start >= self.reset_length:
+                self.counts[:] = 0
+                self.window_start = timestamp
+            if not math.isfinite(value):
+                # An infinity would extend auto-ranging bins forever
+                self.nonfinite += 1
+            elif self.low is None:
+                self.initial_values.append(value)
+                if len(self.initial_values) >= self.initial_count:
+                    self.set_initial_range()
+            else:
+                self.count(value)
+
+    def set_initial_range(self):
+        """Sets the auto-ranging bins around the collected values (with a margin) and counts them"""
+        low, high = min(self.initial_values), max(self.initial_values)
+        margin = (high - low) * 0.25 or abs(low) * 0.01 or 1e-6
+        self.low = low - margin
+        self.width = (high - low + 2 * margin) / self.bins
+        self.max_width = self.width * self.max_range_factor
+        for value in self.initial_values:
+            self.count(value)
+        self.initial_values = []
+
+    def count(self, value : float):
+        """
+        Increments the bin of `value`, extends the range first if it is auto-ranging and the value doesn't fit
+        (unless it wouldn't fit even into the widest range, then it is an outlier)
+        """
+        index = math.floor((value - self.low) / self.width)
+        if self.auto_range and not 0 <= index < self.bins and self.fits_extended(value):
+            while not 0 <= index < self.bins:
+                self.double_range(index < 0)
+                index = math.floor((value - self.low) / self.width)
+        if index < 0:
+            self.underflow += 1
+            return
+        elif index >= self.bins:
+            self.overflow += 1
+            return
+        self.counts[index] += 1
+        self.total_counts[index] += 1
+
+    def fits_extended(self, value : float) -> bool:
+        """Returns whether `value` fits into the range after it is doubled towards it up to the widest range"""
+        low, width = self.low, self.width
+        while width * 2 <= self.max_width:
+            index = math.floor((value - low) / width)
+            if 0 <= index < self.bins:
+                return True
+            if index < 0:
+                low -= self.bins * width
+            width *= 2
+        return 0 <= math.floor((value - low) / width) < self.bins
+
+    def double_range(self, downwards : bool):
+        """Doubles the width of the bins by merging pairs of them, the range is extended downwards or upwards"""
+        half = self.bins // 2
+        for counts in (self.counts, self.total_counts):
+            merged = counts.reshape(half, 2).sum(axis=1)
+            counts[:] = 0
+            if downwards:
+                counts[half:] = merged
+            else:
+                counts[:half] = merged
+        if downwards:
+            self.low -= self.bins * self.width
+        self.width *= 2
+
+    def get(self, total : bool = False) -> tuple:
+        """
+        Returns a copy of the counts of the current window (or of the whole run if `total`) and the bin edges
+        as numpy arrays. The values collected before the auto-ranging bins are set are counted into a single bin.
+        """
+        with self.lock:
+            if self.low is None:
+                if not self.initial_values:
+                    return np.empty(0, dtype='i8'), np.empty(0)
+                low, high = min(self.initial_values), max(self.initial_values)
+                return np.array([len(self.initial_values)]), np.array([low, high if high > low else low + 1e-6])
+            counts = (self.total_counts if total else self.counts).copy()
+            return counts, self.low + np.arange(self.bins + 1) * self.width
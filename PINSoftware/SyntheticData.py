@@ -0,0 +1,81 @@
+"""
+This file generates synthetic data which looks like what the Sample and Hold gives the NI-6002.
+Every pulse the signal jumps from the baseline up to the peak voltage, slowly droops for a few
+samples (the "up section") and then drops back to the baseline (the "down section"). It is
+deterministic for a given seed so it can be used for benchmarks and for running without hardware.
+"""
+import numpy as np
+
+
+class PulseGenerator():
+    """
+    Generates the synthetic signal in consecutive blocks using `PulseGenerator.next`,
+    the blocks join up seamlessly so it can be used as an endless source.
+    """
+    def __init__(self, freq : int = 50000, pulse_rate : float = 1000, high_length : int = 10,
+            peak : float = 0.5, baseline : float = 0.1, droop : float = 0.0005, noise : float = 0.0005,
+            peak_jitter : float = 0.02, seed : int = 0):
+        """
+        `freq` is the sampling frequency.
+
+        `pulse_rate` is the number of pulses per second, `freq / pulse_rate` is rounded to a whole number of samples.
+
+        `high_length` is the length of the up section in samples (it must be shorter than the pulse period).
+
+        `peak` is the mean peak voltage (the jump from the baseline), each pulse is multiplied by
+        `1 + peak_jitter * N(0, 1)`.
+
+        `baseline` is the voltage between the pulses.
+
+        `droop` is how much the held voltage falls every sample during the up section.
+
+        `noise` is the standard deviation of the gaussian noise added to every sample.
+
+        `seed` is the seed of the random generator.
+        """
+        self.freq = freq
+        self.period = max(int(round(freq / pulse_rate)), 2)
+        self.high_length = min(high_length, self.period - 1)
+        self.peak = peak
+        self.baseline = baseline
+        self.droop = droop
+        self.noise = noise
+        self.peak_jitter = peak_jitter
+        self.rng = np.random.RandomState(seed)
+        self.peak_rng = np.random.RandomState(seed + 1)
+        self.index = 0
+        self.first_pulse = 0
+        self.peaks = np.empty(0)
+
+    def get_peaks(self, first_pulse : int, last_pulse : int) -> np.ndarray:
+        """Returns the peak voltages of pulses `first_pulse` to `last_pulse` (inclusive), generating new ones as needed"""
+        have = self.first_pulse + len(self.peaks)
+        if last_pulse >= have:
+            new = self.peak * (1 + self.peak_jitter * self.peak_rng.standard_normal(last_pulse + 1 - have))
+            self.peaks = np.concatenate((self.peaks, new))
+        self.peaks = self.peaks[first_pulse - self.first_pulse:]
+        self.first_pulse = first_pulse
+        return self.peaks[:last_pulse + 1 - first_pulse]
+
+    def next(self, n : int) -> np.ndarray:
+        """Returns the next `n` samples"""
+        indices = np.arange(self.index, self.index + n)
+        self.index += n
+        if n == 0:
+            return np.empty(0)
+        pulses = indices // self.period
+        phases = indices % self.period
+        peaks = self.get_peaks(pulses[0], pulses[-1])
+        ys = self.baseline + self.noise * self.rng.standard_normal(n)
+        high = phases < self.high_length
+        ys[high] += peaks[pulses[high] - pulses[0]] - self.droop * phases[high]
+        return ys
+
+    def skip(self, n : int):
+        """Skips the next `n` samples without generating them, like when they are lost"""
+        self.index += n
+
+
+def generate_pulses(n : int, **kwargs) -> np.ndarray:
+    """Returns `n` samples of a new `PulseGenerator` made with `kwargs`"""
+    return PulseGenerator(**kwargs).next(n)
@@ -0,0 +1,128 @@
+"""
+This file has the `TriggeredCapture` which picks the parts of the raw data worth keeping. Most of the raw data is
+the baseline between the pulses, so instead of saving all of it, only a window around every trigger is saved,
+`pre_samples` before it and `post_samples` after it. The samples before a trigger are kept in a fixed size ring
+buffer, so the window can start before the trigger even when the trigger comes in a later block of data.
+
+There are three trigger modes:
+
+* "spike" triggers on every peak voltage found by `PINSoftware.DataAnalyser.DataAnalyser` (at its timestamp, which
+  is where the pulse falls back to the baseline, so `pre_samples` should cover the pulse),
+* "level" triggers when the raw data rises to `threshold` or above,
+* "slope" triggers when the raw data rises by at least `threshold` from one sample to the next (a negative
+  `threshold` triggers on falling edges instead).
+
+When a trigger comes before the window of the previous one ends, the window is extended, so the windows never overlap.
+"""
+import numpy as np
+
+
+trigger_modes = ['spike', 'level', 'slope']
+"""The possible modes of `TriggeredCapture`"""
+
+
+class TriggeredCapture():
+    """
+    Finds the windows around triggers in consecutive blocks of raw data, see `TriggeredCapture.process`.
+    The windows are returned in chunks as soon as their samples are there, so only the ring buffer and the
+    current block are kept in memory. A long window may come in several chunks, they follow each other
+    without a gap (the next one starts at the index where the previous one ends).
+    """
+    def __init__(self, mode : str = 'spike', pre_samples : int = 15, post_samples : int = 5, threshold : float = None):
+        """
+        `mode` is one of `trigger_modes`.
+
+        `pre_samples` and `post_samples` are how many samples before and after each trigger are captured.
+
+        `threshold` is the level or the slope of the "level" and "slope" modes, it is not used by "spike".
+        """
+        if mode not in trigger_modes:
+            raise ValueError("Unknown trigger mode \"" + str(mode) + "\", it should be one of: " + ", ".join(trigger_modes))
+        if mode != 'spike' and threshold is None:
+            raise ValueError("The \"" + mode + "\" trigger mode needs a threshold")
+        self.mode = mode
+        self.pre_samples = pre_samples
+        self.post_samples = post_samples
+        self.threshold = threshold
+
+        self.ring = np.zeros(max(pre_samples, 1))
+        self.position = 0
+        self.last_value = None
+        self.window_end = None
+        self.captured_until = 0
+        self.triggers = 0
+        self.pending_triggers = []
+
+    def find_triggers(self, values : np.ndarray) -> np.ndarray:
+        """Returns the raw data indices of the "level" or "slope" triggers in `values`, the block starting at `TriggeredCapture.position`"""
+        previous = values[0] if self.last_value is None else self.last_value
+        extended = np.concatenate(([previous], values))
+        if self.mode == 'level':
+            found = (extended[:-1] < self.threshold) & (extended[1:] >= self.threshold)
+        elif self.threshold >= 0:
+            found = np.diff(extended) >= self.threshold
+        else:
+            found = np.diff(extended) <= self.threshold
+        return np.nonzero(found)[0] + self.position
+
+    def get_history(self) -> np.ndarray:
+        """Returns the last (up to `pre_samples`) samples before `TriggeredCapture.position` from the ring buffer"""
+        indices = np.arange(max(self.position - self.pre_samples, 0), self.position)
+        return self.ring[indices % len(self.ring)]
+
+    def remember(self, values : np.ndarray):
+        """Writes the end of `values` (the block starting at `TriggeredCapture.position`) into the ring buffer"""
+        kept = min(len(values), self.pre_samples)
+        if kept:
+            end = self.position + len(values)
+            self.ring[np.arange(end - kept, end) % len(self.ring)] = values[-kept:]
+
+    def process(self, values, triggers : list = None) -> list:
+        """
+        Takes the next block of raw data `values` and returns the newly captured chunks as a list of
+        (raw data index of the first sample, numpy array of the samples) pairs.
+
+        `triggers` are the raw data indices of the new triggers for the "spike" mode (the timestamps of the new peak
+        voltages), the ones after the end of this block are kept for the next one. They are ignored in the other modes.
+        """
+        values = np.asarray(values, dtype='f8')
+        start = self.position
+        end = start + len(values)
+        if len(values) == 0:
+            if triggers:
+                self.pending_triggers += list(triggers)
+            return []
+        if self.mode == 'spike':
+            triggers = self.pending_triggers + list(triggers or [])
+            self.pending_triggers = [trigger for trigger in triggers if trigger >= end]
+            triggers = [trigger for trigger in triggers if trigger < end]
+        else:
+            triggers = self.find_triggers(values)
+        self.triggers += len(triggers)
+
+        history = self.get_history()
+        buffer = np.concatenate((history, values))
+        buffer_start = start - len(history)
+        chunks = []
+
+        def capture(until):
+            if until > self.captured_until:
+                chunks.append((self.captured_until, buffer[self.captured_until - buffer_start:until - buffer_start]))
+                self.captured_until = until
+
+        for trigger in triggers:
+            if self.window_end is not None and trigger - self.pre_samples <= self.window_end:
+                self.window_end = max(self.window_end, trigger + self.post_samples)
+                continue
+            # The previous window ended before this trigger, so all of it is in the buffer
+            if self.window_end is not None:
+                capture(self.window_end)
+            self.captured_until = max(trigger - self.pre_samples, buffer_start, self.captured_until)
+            self.window_end = trigger + self.post_samples
+        if self.window_end is not None:
+            capture(min(self.window_end, end))
+
+        self.remember(values)
+        self.position = end
+        self.last_value = values[-1]
+        return chunks
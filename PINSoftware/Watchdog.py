@@ -0,0 +1,158 @@
+"""
+This file has the `Watchdog` which watches the acquisition while it runs. All the times in
+`PINSoftware.DataAnalyser.DataAnalyser` come from the number of samples, which is only right as long as every sample
+arrives. The watchdog regularly compares the number of samples received with the (monotonic) time which passed, so it
+notices when the samples stop coming (a stall, like when the device or the reads hang), when some are missing (a gap,
+like when the device buffer overflowed) or when there are more of them than there should be.
+
+It also keeps the time anchors of the `PINSoftware.DataAnalyser.DataAnalyser` (pairs of a sample index and the wall
+clock time of that sample, see `PINSoftware.DataAnalyser.DataAnalyser.add_time_anchor`) up to date, a new anchor is
+added after every gap and at least every `anchor_interval` seconds, so the samples can be mapped to the wall clock
+time even across gaps and over long runs when the sampling clock and the wall clock slowly drift apart.
+"""
+import threading
+import time
+
+from PINSoftware.DataAnalyser import DataAnalyser
+from PINSoftware.Debugger import Debugger
+from PINSoftware.Metrics import MetricsRegistry
+
+
+class Watchdog(threading.Thread):
+    """
+    The thread watching the acquisition into a `PINSoftware.DataAnalyser.DataAnalyser`, the problems it finds are
+    logged as warnings and kept in `Watchdog.events` as (wall clock time, sample index, kind, message) tuples, the
+    kind is "stall", "resumed", "gap" or "drift". Call `Watchdog.stop` to stop it.
+    """
+    def __init__(self, data : DataAnalyser, check_interval : float = 0.5, stall_timeout : float = 1,
+            tolerance : float = 0.05, anchor_interval : float = 60, max_drift_ppm : float = 1000,
+            debugger : Debugger = Debugger(), metrics : MetricsRegistry = None):
+        """
+        `data` is the `PINSoftware.DataAnalyser.DataAnalyser` to watch.
+
+        `check_interval` is how often the number of samples is checked in seconds.
+
+        `stall_timeout` is how long in seconds there can be no new samples before it is a stall.
+
+        `tolerance` is how many seconds worth of samples can be missing (or extra) before it is a gap (or too many samples).
+        The difference has to stay the same between two checks, so a read which is late and catches up later isn't one.
+
+        `anchor_interval` is the longest time in seconds between two time anchors.
+
+        `max_drift_ppm` is the largest difference between the sampling clock and the wall clock (in parts per million)
+        which isn't reported as drift.
+
+        `metrics` is the `PINSoftware.Metrics.MetricsRegistry` to count the problems in (or None).
+        """
+        super().__init__(name="Watchdog")
+        self.stop_event = threading.Event()
+        self.data = data
+        self.check_interval = check_interval
+        self.stall_timeout = stall_timeout
+        self.tolerance = tolerance
+        self.anchor_interval = anchor_interval
+        self.max_drift_ppm = max_drift_ppm
+        self.debugger = debugger
+
+        self.events = []
+        self.anchor = None
+        self.first_anchor = None
+        self.last_count = None
+        self.last_progress = None
+        self.stalled = False
+        self.previous_deviation = None
+        self.lost_samples = 0
+        self.drift_ppm = None
+        self.drift_reported = False
+        if metrics:
+            self.events_counter = metrics.counter("watchdog_events_total", "Number of acquisition problems found by the watchdog")
+            self.lost_gauge = metrics.gauge("watchdog_lost_samples", "Estimated number of samples lost in the gaps")
+        else:
+            self.events_counter = None
+
+    def add_event(self, wall : float, count : int, kind : str, message : str):
+        """Records and logs a problem"""
+        self.events.append((wall, count, kind, message))
+        if kind == 'resumed':
+            self.debugger.info("Watchdog: " + message)
+        else:
+            self.debugger.warning("Watchdog: " + message)
+        if self.events_counter:
+            self.events_counter.inc()
+            self.lost_gauge.set(self.lost_samples)
+
+    def set_anchor(self, count : int, mono : float, wall : float):
+        """Starts measuring from sample `count` at the monotonic time `mono` and adds it as a time anchor"""
+        self.anchor = (count, mono)
+        self.previous_deviation = None
+        self.data.add_time_anchor(count, wall)
+
+    def check(self, mono : float = None, wall : float = None):
+        """Does a single check, `mono` and `wall` are the current monotonic and wall clock times (taken now if None)"""
+        count = len(self.data.ys)
+        mono = time.monotonic() if mono is None else mono
+        wall = time.time() if wall is None else wall
+        if self.anchor is None:
+            # `PINSoftware.DataAnalyser.DataAnalyser.on_start` already added the first time anchor
+            self.anchor = self.first_anchor = (count, mono)
+            self.last_count = count
+            self.last_progress = mono
+            return
+        if count != self.last_count:
+            if self.stalled:
+                self.stalled = False
+                self.add_event(wall, count, 'resumed', "The samples are coming again after " +
+                    format(mono - self.last_progress, '.1f') + " s")
+            self.last_count = count
+            self.last_progress = mono
+        elif not self.stalled and mono - self.last_progress >= self.stall_timeout:
+            self.stalled = True
+            self.add_event(wall, count, 'stall', "No samples came for " + format(mono - self.last_progress, '.1f') + " s")
+        if self.stalled:
+            return
+
+        freq = self.data.freq
+        # In seconds, negative when there are fewer samples than the time which passed
+        deviation = (count - self.anchor[0]) / freq - (mono - self.anchor[1])
+        if abs(deviation) > self.tolerance and self.previous_deviation is not None and \
+                abs(deviation - self.previous_deviation) < self.tolerance / 2:
+            samples = int(round(abs(deviation) * freq))
+            if deviation < 0:
+                self.lost_samples += samples
+                self.add_event(wall, count, 'gap', "About " + str(samples) + " samples (" + format(-deviation, '.3f') +
+                    " s) are missing, the device buffer probably overflowed")
+            else:
+                self.lost_samples -= samples
+                self.add_event(wall, count, 'drift', "There are " + str(samples) + " more samples (" + format(deviation, '.3f') +
+                    " s) than the time which passed")
+            self.set_anchor(count, mono, wall)
+            return
+        self.previous_deviation = deviation
+
+        elapsed = mono - self.first_anchor[1]
+        if elapsed >= 10:
+            self.drift_ppm = ((count - self.first_anchor[0] + self.lost_samples) / freq - elapsed) / elapsed * 1e6
+            if abs(self.drift_ppm) > self.max_drift_ppm and not self.drift_reported:
+                self.drift_reported = True
+                self.add_event(wall, count, 'drift', "The sampling clock is off by " + format(self.drift_ppm, '.0f') +
+                    " ppm from the wall clock")
+        if mono - self.anchor[1] >= self.anchor_interval:
+            self.set_anchor(count, mono, wall)
+
+    def recent_events(self, seconds : float = 60) -> list:
+        """Returns the events from the last `seconds` seconds"""
+        since = time.time() - seconds
+        return [event for event in self.events if event[0] >= since]
+
+    def run(self):
+        """This method is called when `Watchdog.start` is called, it is the main loop"""
+        next_call = time.time()
+        while not self.stop_event.is_set():
+            next_call += self.check_interval
+            if self.stop_event.wait(max(0, next_call - time.time())):
+                break
+            self.check()
+
+    def stop(self):
+        """Stops the thread, it stops waiting for the next check right away"""
+        self.stop_event.set()
@@ -0,0 +1,230 @@
+"""
+This file isn't a part of the server! It is a benchmark suite for the hot paths of the program,
+the processing (`PINSoftware.DataAnalyser.DataAnalyser.append` and `PINSoftware.DataAnalyser.DataAnalyser.handle_processing`),
+the saving (`PINSoftware.DataSaver.Hdf5DataSaver.do_single_save` and `PINSoftware.DataSaver.CsvDataSaver.do_single_save`)
+and the graphs (`PINSoftware.DashApp.full_graph_extend` and `PINSoftware.DashApp.live_graph_func`).
+
+All benchmarks use deterministic synthetic data from `PINSoftware.SyntheticData` with several pulse rates and
+up section lengths. The results can be saved as JSON and compared against a saved baseline, then any metric
+which got worse by more than the threshold is reported as a regression. The processing also has to keep up
+with the real-time rate of the NI-6002 (50 kHz), otherwise the benchmark fails.
+
+Run it with `python -m PINSoftware.benchmark`, use `--help` for the options.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import types
+
+from PINSoftware.DataAnalyser import DataAnalyser
+from PINSoftware.DataSaver import CsvDataSaver, Hdf5DataSaver
+from PINSoftware.Debugger import Debugger
+from PINSoftware.Profiler import Histogram
+from PINSoftware.SyntheticData import generate_pulses
+
+
+real_time_freq = 50000
+"""The sampling frequency of the NI-6002, the processing has to be faster than this"""
+
+pulse_rates = [100, 1000, 5000]
+"""The pulse rates (pulses per second) to benchmark with"""
+
+high_lengths = [5, 20]
+"""The up section lengths (in samples) to benchmark with"""
+
+higher_is_better = ['samples_per_s', 'peaks_per_s', 'bytes_per_s']
+"""Metrics where a higher value is better, for all the others (latencies) lower is better"""
+
+
+def make_analyser(**kwargs) -> DataAnalyser:
+    """Makes a `PINSoftware.DataAnalyser.DataAnalyser` which doesn't print anything"""
+    return DataAnalyser(real_time_freq, debugger=Debugger(exit_on_error=False), **kwargs)
+
+
+def fill_analyser(ys : list, **kwargs) -> DataAnalyser:
+    """Returns a new analyser with all of `ys` appended"""
+    data = make_analyser(**kwargs)
+    for y in ys:
+        data.append(y)
+    return data
+
+
+def bench_append(ys : list) -> dict:
+    """Measures the throughput of `PINSoftware.DataAnalyser.DataAnalyser.append`"""
+    data = make_analyser()
+    append = data.append
+    start = time.perf_counter()
+    for y in ys:
+        append(y)
+    duration = time.perf_counter() - start
+    return {
+        'samples_per_s': len(ys) / duration,
+        'peaks_per_s': len(data.processed_ys) / duration,
+        'latency_mean_us': duration / len(ys) * 1e6,
+        'peaks': len(data.processed_ys)
+    }
+
+
+def bench_handle_processing(ys : list) -> dict:
+    """
+    Measures the latency distribution of single `PINSoftware.DataAnalyser.DataAnalyser.handle_processing`
+    calls, this includes the overhead of the timing itself (about 0.1 us).
+    """
+    data = make_analyser()
+    histogram = Histogram()
+    for y in ys:
+        start = time.perf_counter_ns()
+        data.handle_processing(y)
+        histogram.record(time.perf_counter_ns() - start)
+        data.ys.append(y)
+    summary = histogram.summary(1e-3)
+    return {'latency_mean_us': summary['mean'], 'latency_p99_us': summary['p99'], 'latency_max_us': summary['max']}
+
+
+def bench_saver(ys : list, saver_type : str) -> dict:
+    """
+    Measures `do_single_save` of a saver, the data is added one second at a time and each
+    second is saved, like when the saver runs during an experiment.
+    """
+    data = make_analyser()
+    with tempfile.TemporaryDirectory() as directory:
+        if saver_type == 'hdf5':
+            saver = Hdf5DataSaver(data, directory, "bench", items=["ys", "processed_ys", "averaged_processed_ys"])
+        else:
+            saver = CsvDataSaver(data, directory, "bench")
+        histogram = Histogram()
+        for block_start in range(0, len(ys), real_time_freq):
+            for y in ys[block_start:block_start + real_time_freq]:
+                data.append(y)
+            start = time.perf_counter_ns()
+            saver.do_single_save()
+            histogram.record(time.perf_counter_ns() - start)
+        saver.close()
+        size = os.path.getsize(saver.full_filename)
+    total = histogram.total * 1e-9
+    return {
+        'bytes_per_s': size / total,
+        'samples_per_s': len(ys) / total,
+        'latency_mean_ms': histogram.summary(1e-6)['mean'],
+        'latency_max_ms': histogram.max * 1e-6
+    }
+
+
+def bench_graphs(ys : list, repeats : int = 5) -> dict:
+    """Measures the graph functions of `PINSoftware.DashApp` on an analyser filled with `ys`"""
+    # DashApp needs dash, it is imported here so the rest of the benchmarks run without it
+    import plotly
+    from PINSoftware.DashApp import full_graph_extend, live_graph_func
+
+    ms = types.SimpleNamespace(data=fill_analyser(ys))
+    results = {}
+    for name, func in [('full_graph_extend', lambda: full_graph_extend(ms, 0, {'pro_index': 0, 'avg_index': 0})),
+            ('live_graph_func', lambda: live_graph_func(ms, 0, 5))]:
+        histogram = Histogram()
+        for _ in range(repeats):
+            start = time.perf_counter_ns()
+            result = func()
+            histogram.record(time.perf_counter_ns() - start)
+        results[name] = {
+            'latency_mean_ms': histogram.summary(1e-6)['mean'],
+            'payload_bytes': len(json.dumps(result, cls=plotly.utils.PlotlyJSONEncoder))
+        }
+    return results
+
+
+def run_benchmarks(seconds : float = 2, graphs : bool = True) -> dict:
+    """Runs all the benchmarks with `seconds` of synthetic data for each scenario and returns the results"""
+    results = {}
+    for pulse_rate in pulse_rates:
+        for high_length in high_lengths:
+            scenario = "rate=" + str(pulse_rate) + "/high=" + str(high_length)
+            ys = generate_pulses(int(seconds * real_time_freq), freq=real_time_freq, pulse_rate=pulse_rate,
+                    high_length=high_length).tolist()
+            print("Running " + scenario, file=sys.stderr)
+            results["append/" + scenario] = bench_append(ys)
+            results["handle_processing/" + scenario] = bench_handle_processing(ys)
+            results["hdf5_save/" + scenario] = bench_saver(ys, 'hdf5')
+            results["csv_save/" + scenario] = bench_saver(ys, 'csv')
+            if graphs:
+                for name, result in bench_graphs(ys).items():
+                    results[name + "/" + scenario] = result
+    return results
+
+
+def check_real_time(results : dict) -> list:
+    """Returns the names of the append benchmarks which are slower than the real-time rate"""
+    return [name for name, result in results.items()
+            if name.startswith("append/") and result['samples_per_s'] < real_time_freq]
+
+
+def compare(results : dict, baseline : dict, threshold : float) -> list:
+    """
+    Compares the results with the baseline results, returns a list of (benchmark, metric, baseline value,
+    new value, relative change) for every metric which got worse by more than `threshold` (a fraction).
+    """
+    regressions = []
+    for name, result in results.items():
+        for metric, value in result.items():
+            old = baseline.get(name, {}).get(metric)
+            if not old or metric in ['peaks', 'payload_bytes']:
+                continue
+            change = (value - old) / old
+            worse = -change if metric in higher_is_better else change
+            if worse > threshold:
+                regressions.append((name, metric, old, value, change))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the processing, saving and graph hot paths.")
+    parser.add_argument("--seconds", "-s", type=float, default=2, help="Seconds of synthetic data for each scenario.")
+    parser.add_argument("--output", "-o", default=None, help="Where to save the results as JSON.")
+    parser.add_argument("--baseline", "-b", default=None, help="A saved results file to compare to.")
+    parser.add_argument("--threshold", "-t", type=float, default=0.1, help="The relative change which counts as a regression.")
+    parser.add_argument("--no-graphs", dest="graphs", action="store_false", help="Skip the graph benchmarks (they need dash).")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.seconds, args.graphs)
+    output = {
+        'meta': {
+            'time': datetime.datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'node': platform.node(),
+            'seconds': args.seconds
+        },
+        'results': results
+    }
+    for name, result in results.items():
+        print(name + ": " + ", ".join(metric + "=" + "{:.4g}".format(value) for metric, value in result.items()))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+
+    failed = False
+    too_slow = check_real_time(results)
+    if too_slow:
+        failed = True
+        print("FAIL: slower than the real-time rate of " + str(real_time_freq) + " samples/s: " + ", ".join(too_slow))
+    else:
+        print("PASS: all processing is faster than the real-time rate of " + str(real_time_freq) + " samples/s")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f)['results'], args.threshold)
+        for name, metric, old, new, change in regressions:
+            print("REGRESSION: " + name + " " + metric + ": " + "{:.4g} -> {:.4g} ({:+.1%})".format(old, new, change))
+        if regressions:
+            failed = True
+        else:
+            print("No regressions against the baseline (threshold " + "{:.0%}".format(args.threshold) + ")")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+"""
+This file isn't a part of the server! It is a load test which finds out how many people can watch
+a run before the acquisition starts to suffer. It runs everything locally without the hardware.
+
+It starts a `PINSoftware.MachineState.MachineState` with a `PINSoftware.DataUpdater.SyntheticDataUpdater`
+(or the dummy file replay) and the dash app served by waitress, starts an experiment and then, for an
+increasing number of clients, spawns client processes which request the 'live-graph' and 'full-graph'
+callbacks at their interval rates the same way the browser does. For every number of clients it reports
+the samples dropped by the simulated device buffer, the acquisition lag, the callback latency percentiles
+(as seen by the clients) and the CPU used by the server.
+
+Run it with `python -m PINSoftware.loadtest`, use `--help` for the options.
+"""
+import argparse
+import http.client
+import json
+import multiprocessing
+import sys
+import tempfile
+import threading
+import time
+
+from PINSoftware.Profiler import Histogram
+
+
+graph_interval = 2
+"""The interval of the graphs in the app (the `dash_core_components.Interval`s) in seconds"""
+
+
+def live_graph_request(n : int, state) -> dict:
+    """The body of the request the browser sends when the 'live-graph' interval triggers"""
+    return {
+        'output': "..live-graph.figure...live-graph-average.children...live-graph-count.children...live-graph-watchdog.children..",
+        'outputs': [{'id': 'live-graph', 'property': 'figure'}, {'id': 'live-graph-average', 'property': 'children'},
+            {'id': 'live-graph-count', 'property': 'children'}, {'id': 'live-graph-watchdog', 'property': 'children'}],
+        'inputs': [{'id': 'live-graph-clock', 'property': 'n_intervals', 'value': n}],
+        'changedPropIds': ['live-graph-clock.n_intervals'],
+        'state': [{'id': 'live-graph-T', 'property': 'value', 'value': 5}]
+    }
+
+
+def full_graph_request(n : int, state) -> dict:
+    """The body of the request the browser sends when the 'full-graph' interval triggers"""
+    return {
+        'output': "..full-graph.extendData...full-graph-indices.data..",
+        'outputs': [{'id': 'full-graph', 'property': 'extendData'}, {'id': 'full-graph-indices', 'property': 'data'}],
+        'inputs': [{'id': 'full-graph-clock', 'property': 'n_intervals', 'value': n}],
+        'changedPropIds': ['full-graph-clock.n_intervals'],
+        'state': [{'id': 'full-graph-indices', 'property': 'data', 'value': state}]
+    }
+
+
+def full_graph_state(response : dict, state):
+    """Gets the new 'full-graph-indices' from a response, the browser keeps them in a `dash_core_components.Store`"""
+    return response['response']['full-graph-indices']['data']
+
+
+graph_requests = {
+    'live-graph': (live_graph_request, None, None),
+    'full-graph': (full_graph_request, full_graph_state, {'pro_index': 0, 'avg_index': 0})
+}
+"""The graphs the clients request, the values are (the request function, the state update function, the initial state)"""
+
+
+def poll_graph(host : str, port : int, graph : str, interval : float, warmup : float, end : float, results : dict):
+    """
+    Requests the callback of `graph` every `interval` seconds until `end` (a `time.monotonic` time) over a
+    single connection (like a browser does). Requests started at least `warmup` seconds after the start are
+    recorded into `results`.
+    """
+    make_request, update_state, state = graph_requests[graph]
+    record_from = time.monotonic() + warmup
+    connection = http.client.HTTPConnection(host, port, timeout=30)
+    latencies = []
+    errors = 0
+    response_bytes = 0
+    n = 0
+    next_call = time.monotonic()
+    while next_call < end:
+        time.sleep(max(0, next_call - time.monotonic()))
+        n += 1
+        body = json.dumps(make_request(n, state))
+        start = time.perf_counter_ns()
+        try:
+            connection.request('POST', '/_dash-update-component', body, {'Content-Type': 'application/json'})
+            response = connection.getresponse()
+            data = response.read()
+            ok = response.status in [200, 204]
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            data = b""
+            ok = False
+        duration = time.perf_counter_ns() - start
+        if ok and update_state and response.status == 200:
+            state = update_state(json.loads(data), state)
+        if next_call >= record_from:
+            latencies.append(duration)
+            response_bytes += len(data)
+            errors += not ok
+        next_call += interval
+    connection.close()
+    results[graph] = {'latencies': latencies, 'errors': errors, 'response_bytes': response_bytes}
+
+
+def client_main(host : str, port : int, interval : float, warmup : float, duration : float, queue):
+    """
+    The main function of a client process, it polls both graphs in their own threads (the browser
+    also sends the requests independently) and puts the results into `queue`.
+    """
+    end = time.monotonic() + warmup + duration
+    results = {}
+    threads = [threading.Thread(target=poll_graph, args=(host, port, graph, interval, warmup, end, results))
+        for graph in graph_requests]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    queue.put(results)
+
+
+def run_step(ms, host : str, port : int, clients : int, interval : float, warmup : float, duration : float) -> dict:
+    """Runs `clients` clients against the running server and measures the acquisition and the server meanwhile"""
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    processes = [context.Process(target=client_main, args=(host, port, interval, warmup, duration, queue), daemon=True)
+        for _ in range(clients)]
+    for process in processes:
+        process.start()
+    time.sleep(warmup)
+
+    # The dummy file replay has no device buffer, so nothing is ever dropped there and the lag is unknown
+    processed_start, dropped_start = len(ms.data.ys), getattr(ms.du, 'dropped', 0)
+    cpu_start, wall_start = time.process_time(), time.monotonic()
+    lags = []
+    saver_lags = []
+    while time.monotonic() < wall_start + duration:
+        lags.append(getattr(ms.du, 'lag', 0))
+        if ms.saver:
+            saver_lags.append(ms.saver.get_lag())
+        time.sleep(0.1)
+    cpu = (time.process_time() - cpu_start) / (time.monotonic() - wall_start)
+    dropped = getattr(ms.du, 'dropped', 0) - dropped_start
+    acquired = len(ms.data.ys) - processed_start + dropped
+
+    graphs = {graph: {'latencies': Histogram(), 'errors': 0, 'response_bytes': 0} for graph in graph_requests}
+    for _ in processes:
+        for graph, results in queue.get().items():
+            for latency in results['latencies']:
+                graphs[graph]['latencies'].record(latency)
+            graphs[graph]['errors'] += results['errors']
+            graphs[graph]['response_bytes'] += results['response_bytes']
+    for process in processes:
+        process.join()
+
+    return {
+        'clients': clients,
+        'drop_rate': dropped / acquired if acquired else 0,
+        'lag_ms': {'mean': sum(lags) / len(lags) * 1e3, 'max': max(lags) * 1e3},
+        'saver_lag_values_max': max(saver_lags) if saver_lags else None,
+        'server_cpu': cpu,
+        'graphs': {graph: {
+                'requests': values['latencies'].count,
+                'errors': values['errors'],
+                'response_bytes': values['response_bytes'],
+                'latency_ms': values['latencies'].summary(1e-6)
+            } for graph, values in graphs.items()}
+    }
+
+
+def format_step(result : dict) -> str:
+    """Formats the result of a step as a line of the report"""
+    line = "{:>7} {:>9.3%} {:>8.1f} {:>8.1f} {:>7.0%}".format(result['clients'], result['drop_rate'],
+        result['lag_ms']['mean'], result['lag_ms']['max'], result['server_cpu'])
+    for graph in graph_requests:
+        values = result['graphs'][graph]
+        latency = values['latency_ms']
+        if values['requests']:
+            line += "  {:>7.1f} {:>7.1f} {:>7.1f} {:>4}".format(latency['p50'], latency['p95'], latency['p99'], values['errors'])
+        else:
+            line += "  {:>7} {:>7} {:>7} {:>4}".format("-", "-", "-", "-")
+    return line
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load tests the server with simulated browser clients, without the hardware.")
+    parser.add_argument("--clients", "-c", default="0,1,2,4,8,16", help="Comma separated numbers of clients to test with.")
+    parser.add_argument("--duration", "-t", type=float, default=10, help="How long to measure each number of clients for in seconds.")
+    parser.add_argument("--warmup", "-w", type=float, default=3, help="How long to wait before measuring in seconds.")
+    parser.add_argument("--interval", "-i", type=float, default=graph_interval, help="The graph update interval of the clients in seconds.")
+    parser.add_argument("--port", type=int, default=8051, help="The port to serve the app on.")
+    parser.add_argument("--save", choices=["none", "csv", "hdf5"], default="none", help="Whether to also save the data during the test.")
+    parser.add_argument("--dummy-data", "-dd", default=None, help="Replay this dummy data file instead of generating synthetic data.")
+    parser.add_argument("--output", "-o", default=None, help="Where to save the results as JSON.")
+    args = parser.parse_args()
+
+    # The server parts are imported here so that the client processes don't import them
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    import waitress
+
+    from PINSoftware.MachineState import MachineState
+    from PINSoftware.DashApp import get_app
+    from PINSoftware.DataSaver import Filetype
+
+    host = "127.0.0.1"
+    log_directory = tempfile.mkdtemp(prefix="pin-loadtest-")
+    ms = MachineState(plt, args.dummy_data is not None, args.dummy_data, log_directory=log_directory,
+        synthetic=args.dummy_data is None)
+    server = waitress.create_server(get_app(ms).server, host=host, port=args.port, threads=8)
+    server_thread = threading.Thread(target=server.run, name="Waitress", daemon=True)
+    server_thread.start()
+
+    if args.save == "none":
+        ms.start_experiment()
+    else:
+        ms.start_experiment("loadtest", Filetype.Csv if args.save == "csv" else Filetype.Hdf5)
+
+    results = []
+    print("Logs are in " + log_directory, file=sys.stderr)
+    print("{:>7} {:>9} {:>8} {:>8} {:>7}".format("clients", "dropped", "lag ms", "max lag", "cpu") +
+        "".join("  {:>7} {:>7} {:>7} {:>4}".format(graph[:4] + " p50", "p95", "p99", "err") for graph in graph_requests))
+    try:
+        for clients in map(int, args.clients.split(",")):
+            result = run_step(ms, host, args.port, clients, args.interval, args.warmup, args.duration)
+            results.append(result)
+            print(format_step(result))
+            sys.stdout.flush()
+    finally:
+        ms.stop_everything()
+        server.close()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'args': vars(args), 'results': results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
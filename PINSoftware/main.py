@@ -7,6 +7,8 @@ import matplotlib.pyplot as plt
 
 from PINSoftware.MachineState import MachineState
 from PINSoftware.DashApp import get_app
+from PINSoftware.Debugger import set_log_level
+from PINSoftware.TriggeredCapture import trigger_modes
 
 from waitress import serve
 
@@ -20,11 +22,33 @@ def main():
             description='Server for the control of NI-6002 in use with a Sample and Hold amplifier and an xPIN diode, made at ELI Beamlines.')
     parser.add_argument("--dummy", "-d", dest="dummy", action="store_true", help="Run the server in dummy mode - do not actually use the NI-6002 but instead use data from a file.")
     parser.add_argument("--dummy-data", "-dd", dest="dummy_data", action="store", default="dummy_data", help="Name of the file to read the dummy data from.")
+    parser.add_argument("--synthetic", "-s", dest="synthetic", action="store_true", help="Run the server without the NI-6002 using generated data which arrives in blocks like from the device.")
+    parser.add_argument("--fake-daq", dest="fake_daq", action="store_true", help="Run the server with a simulated NI-6002 which is read like the real one, for testing without the device.")
+    parser.add_argument("--channels", "-ch", dest="channels", type=int, default=1, help="How many analog input channels to acquire, the first is the main signal. The 50 kHz sampling rate is shared between them.")
+    parser.add_argument("--trigger-mode", dest="trigger_mode", choices=trigger_modes, default='spike', help="What triggers capturing the raw data when only the raw data around the pulses is saved, every peak voltage (spike), the raw data rising to the threshold (level) or rising by the threshold between two samples (slope).")
+    parser.add_argument("--trigger-pre", dest="trigger_pre", type=int, default=15, help="How many raw data samples before each trigger are saved.")
+    parser.add_argument("--trigger-post", dest="trigger_post", type=int, default=5, help="How many raw data samples after each trigger are saved.")
+    parser.add_argument("--trigger-threshold", dest="trigger_threshold", type=float, default=None, help="The level in volts or the slope in volts per sample of the level and slope trigger modes.")
     parser.add_argument("--graph", "-g", dest="graph", action="store_true", help="Show the raw data graph.")
-    parser.add_argument("--profiler", "-p", dest="profiler", action="store_true", help="Run a profiler along to monitor performance.")
+    parser.add_argument("--graph-window", "-gw", dest="graph_window", type=float, default=None, help="How many seconds of raw data the graph shows, the last 200 values by default.")
+    parser.add_argument("--spectrum", dest="spectrum", action="store_true", help="Calculate the power spectral density of the raw data, it is shown in the Spectrum tab and saved with the run.")
+    parser.add_argument("--spectrum-segment-length", dest="spectrum_segment_length", type=int, default=4096, help="The number of values in a segment of the spectral analysis, it sets the frequency resolution.")
+    parser.add_argument("--spectrum-averages", dest="spectrum_averages", type=int, default=16, help="About how many segments the shown spectrum is averaged over.")
+    parser.add_argument("--fsync", dest="fsync", action="store_true", help="Sync the saved files to the disk when a run is stopped.")
+    parser.add_argument("--publish", dest="publish", default=None, help="Stream the peak voltages as binary frames to other programs, the address to listen on is <host>:<port>, <port> (on 127.0.0.1) or unix:<path>.")
+    parser.add_argument("--log-level", dest="log_level", choices=["debug", "info", "warning", "error"], default="info", help="The lowest level of the messages which are printed and written to debug.jsonl in the log directory.")
+    parser.add_argument("--profiler", "-p", dest="profiler", action="store_true", help="Run a profiler along to monitor performance, the results are saved in the log directory.")
     args = parser.parse_args()
+    set_log_level(args.log_level)
+    if args.trigger_mode != 'spike' and args.trigger_threshold is None:
+        parser.error("the " + args.trigger_mode + " trigger mode needs --trigger-threshold")
 
-    ms = MachineState(plt, args.dummy, dummy_data_file=args.dummy_data, profiler=args.profiler)
+    ms = MachineState(plt, args.dummy, dummy_data_file=args.dummy_data, profiler=args.profiler, synthetic=args.synthetic,
+            graph_window=args.graph_window, spectrum_segment_length=args.spectrum_segment_length if args.spectrum else None,
+            spectrum_averages=args.spectrum_averages, channels=args.channels,
+            trigger_mode=args.trigger_mode, trigger_pre=args.trigger_pre, trigger_post=args.trigger_post,
+            trigger_threshold=args.trigger_threshold, fake_daq=args.fake_daq,
+            fsync=args.fsync, publish_address=args.publish)
 
     app = get_app(ms)
 
@@ -0,0 +1,251 @@
+"""
+This file isn't a part of the server! It reprocesses saved runs with different processing parameters.
+If `edge_detection_threshold`, `average_count` or the correction coefficients were wrong during a run,
+the peak voltages in the file are wrong too, but as long as the raw data ("ys") was saved they can be
+calculated again.
+
+The raw data is read in chunks and streamed through the same `PINSoftware.DataAnalyser.DataAnalyser`
+which is used during acquisition, so the results are the same as if the run was done with the new parameters.
+Only the end of the raw data the analyser needs is kept in memory and the new peak voltages are written
+out after every chunk, so the memory use doesn't depend on the length of the run. The channels of
+multi-channel runs are reprocessed one after another. Multiple files are processed in parallel in a process pool.
+
+Run it with `python -m PINSoftware.reprocess`, use `--help` for the options.
+"""
+import argparse
+import concurrent.futures
+import datetime
+import os
+import sys
+import time
+
+import h5py
+import numpy as np
+
+from PINSoftware.DataAnalyser import DataAnalyser, linear_correct_func
+from PINSoftware.Debugger import Debugger
+
+
+reprocessed_series = [
+    ('processed_ys', 'f4', 'processed_timestamps'),
+    ('averaged_processed_ys', 'f4', 'averaged_processed_timestamps')
+]
+"""The series written by reprocessing, as (name, dtype, timestamps name)"""
+
+initial_ys_length = 3
+"""The length of the zeros `PINSoftware.DataAnalyser.DataAnalyser.ys` starts with, they are saved with the data"""
+
+
+def append_to_dataset(dataset : h5py.Dataset, values : list):
+    """Appends `values` to the end of the resizable `dataset`"""
+    index = dataset.shape[0]
+    dataset.resize((index + len(values),))
+    dataset[index:] = values
+
+
+def trim_analyser(data : DataAnalyser) -> int:
+    """
+    Forgets the raw data and markers of `data` which the processing doesn't need anymore (it looks
+    at most 3 values back), returns how many raw values were removed.
+    """
+    data.markers.clear()
+    data.marker_timestamps.clear()
+    removed = len(data.ys) - initial_ys_length
+    del data.ys[:removed]
+    return removed
+
+
+def drain_analyser(data : DataAnalyser, datasets : dict, offset : int):
+    """
+    Moves the new results out of `data` into `datasets` (a dict of the series names to the datasets)
+    and forgets the raw data it doesn't need anymore. The timestamps in `data` are indices into its `ys`
+    which is shortened here, `offset` is the index of the first of its `ys` in the file.
+    Returns the new offset.
+    """
+    for name, _, timestamps_name in reprocessed_series:
+        values = getattr(data, name)
+        timestamps = getattr(data, timestamps_name)
+        if values:
+            append_to_dataset(datasets[name], values)
+            append_to_dataset(datasets[timestamps_name], np.array(timestamps, dtype='f8') + offset)
+            values.clear()
+            timestamps.clear()
+    return offset + trim_analyser(data)
+
+
+def get_initial_skip(ys : h5py.Dataset) -> int:
+    """
+    Returns how many values at the start of the saved `ys` are the zeros `PINSoftware.DataAnalyser.DataAnalyser`
+    starts with. They are normally saved too, but if they aren't they are before the start of the file.
+    """
+    return initial_ys_length if len(ys) >= initial_ys_length and not ys[:initial_ys_length].any() else 0
+
+
+def get_channel_groups(f : h5py.File) -> list:
+    """
+    Returns the groups with the data of every channel of the saved run `f`. The data of the first channel
+    is in the root of the file and the other channels have their own groups (see `PINSoftware.DataSaver.Hdf5DataSaver`).
+    """
+    channel_names = f.attrs.get('channel_names')
+    if channel_names is None:
+        return [f]
+    return [f] + [f[str(name)] for name in channel_names[1:]]
+
+
+def create_datasets(group : h5py.Group, suffix : str) -> dict:
+    """Creates the empty datasets for the results in `group` (named with `suffix`), returns a dict of the series names to them"""
+    datasets = {}
+    for name, dtype, timestamps_name in reprocessed_series:
+        for dataset_name, dataset_dtype in [(name, dtype), (timestamps_name, 'f8')]:
+            if dataset_name + suffix in group:
+                del group[dataset_name + suffix]
+            datasets[dataset_name] = group.create_dataset(dataset_name + suffix, (0,), chunks=True,
+                maxshape=(None,), dtype=dataset_dtype)
+    return datasets
+
+
+def reprocess_channel(ys : h5py.Dataset, data : DataAnalyser, datasets : dict, chunk_size : int):
+    """Streams the raw data `ys` of one channel through `data` and writes the results into `datasets`"""
+    skip = get_initial_skip(ys)
+    offset = skip - initial_ys_length
+    for chunk_start in range(skip, len(ys), chunk_size):
+        for new_y in ys[chunk_start:chunk_start + chunk_size].tolist():
+            data.append(new_y)
+        offset = drain_analyser(data, datasets, offset)
+
+
+def reprocess_file(filename : str, output_filename : str = None, edge_detection_threshold : float = None,
+        average_count : int = None, correction_a : float = 1, correction_b : float = 0, chunk_size : int = 2**20) -> dict:
+    """
+    Reprocesses the run saved in `filename` and returns a summary of it as a dict. All the channels of
+    a multi-channel run are reprocessed with the same parameters, like they were during acquisition.
+
+    `output_filename` is the file to write the results into, it gets a copy of the raw data, the attributes
+    and the new results. If it is None, the results replace the old ones in `filename` itself, they are
+    only replaced once the reprocessing is finished.
+
+    `edge_detection_threshold` and `average_count` are the new parameters, if they are None the ones saved
+    in the file are used. `correction_a` and `correction_b` are the coefficients of the linear correction.
+
+    `chunk_size` is how many raw values are read at once.
+    """
+    start = time.perf_counter()
+    with h5py.File(filename, 'r' if output_filename else 'r+') as source:
+        source_groups = get_channel_groups(source)
+        for group in source_groups:
+            if 'ys' not in group:
+                raise ValueError("\"" + filename + "\" doesn't have the raw data (\"" + (group.name + "/ys").lstrip('/') + "\") saved")
+        freq = int(source.attrs.get('freq', 50000))
+        if edge_detection_threshold is None:
+            edge_detection_threshold = float(source.attrs['edge_detection_threshold'])
+        if average_count is None:
+            average_count = int(source.attrs['average_count'])
+
+        if output_filename:
+            target = h5py.File(output_filename, 'w')
+            target.attrs.update(source.attrs)
+            target.attrs['reprocessed_from'] = os.path.abspath(filename)
+            target_groups = [target] + [target.create_group(group.name) for group in source_groups[1:]]
+            for source_group, target_group in zip(source_groups, target_groups):
+                source.copy(source_group['ys'], target_group, 'ys')
+            suffix = ""
+        else:
+            target = source
+            target_groups = source_groups
+            suffix = ".reprocessing"
+        try:
+            summary = {
+                'filename': filename,
+                'output_filename': output_filename or filename,
+                'channels': len(source_groups),
+                'samples': len(source_groups[0]['ys']),
+                'peaks': 0,
+                'averaged_peaks': 0,
+                'irregular_count': 0
+            }
+            channel_datasets = []
+            for source_group, target_group in zip(source_groups, target_groups):
+                data = DataAnalyser(freq, debugger=Debugger(exit_on_error=False), edge_detection_threshold=edge_detection_threshold,
+                    average_count=average_count, correction_func=linear_correct_func(correction_a, correction_b),
+                    rolling_windows=None, histogram_bins=None)
+                datasets = create_datasets(target_group, suffix)
+                reprocess_channel(source_group['ys'], data, datasets, chunk_size)
+                channel_datasets.append((target_group, datasets))
+                summary['peaks'] += len(datasets['processed_ys'])
+                summary['averaged_peaks'] += len(datasets['averaged_processed_ys'])
+                summary['irregular_count'] += data.irregular_count
+
+            if not output_filename:
+                for target_group, datasets in channel_datasets:
+                    for dataset_name in datasets:
+                        if dataset_name in target_group:
+                            del target_group[dataset_name]
+                        target_group.move(dataset_name + suffix, dataset_name)
+            target.attrs['edge_detection_threshold'] = edge_detection_threshold
+            target.attrs['average_count'] = average_count
+            target.attrs['correction_a'] = float(correction_a)
+            target.attrs['correction_b'] = float(correction_b)
+            target.attrs['reprocessed'] = datetime.datetime.now().isoformat()
+        finally:
+            if output_filename:
+                target.close()
+    summary['duration'] = time.perf_counter() - start
+    summary['speedup'] = summary['samples'] / freq / summary['duration'] if summary['duration'] else 0
+    return summary
+
+
+def find_runs(paths : list) -> list:
+    """Returns the hdf5 files in `paths`, directories are searched (not recursively) for them"""
+    filenames = []
+    for path in paths:
+        if os.path.isdir(path):
+            filenames.extend(sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith(".hdf5")))
+        else:
+            filenames.append(path)
+    return filenames
+
+
+def get_output_filename(filename : str, output_directory : str) -> str:
+    """Returns where to write the reprocessed `filename` into when it is not reprocessed in place"""
+    base = os.path.splitext(os.path.basename(filename))[0]
+    return os.path.join(output_directory or os.path.dirname(filename), base + "-reprocessed.hdf5")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Reprocesses the raw data of saved runs with new processing parameters.")
+    parser.add_argument("paths", nargs="+", help="The hdf5 files to reprocess or directories with them.")
+    parser.add_argument("--edge-detection-threshold", "-e", type=float, default=None, help="The new edge detection threshold [V], by default the saved one is used.")
+    parser.add_argument("--average-count", "-a", type=int, default=None, help="The new average count, by default the saved one is used.")
+    parser.add_argument("--correction-a", type=float, default=1, help="The correction coefficient a (y = a * x + b).")
+    parser.add_argument("--correction-b", type=float, default=0, help="The correction coefficient b (y = a * x + b).")
+    parser.add_argument("--in-place", "-i", action="store_true", help="Replace the results in the files instead of writing new files.")
+    parser.add_argument("--output-directory", "-o", default=None, help="Where to write the new files, by default next to the old ones.")
+    parser.add_argument("--workers", "-w", type=int, default=None, help="How many files to process at once, by default the number of cores.")
+    parser.add_argument("--chunk-size", type=int, default=2**20, help="How many raw values to read at once.")
+    args = parser.parse_args()
+
+    failed = False
+    with concurrent.futures.ProcessPoolExecutor(args.workers) as executor:
+        futures = {}
+        for filename in find_runs(args.paths):
+            if filename.endswith("-reprocessed.hdf5") and not args.in_place:
+                continue
+            output_filename = None if args.in_place else get_output_filename(filename, args.output_directory)
+            futures[executor.submit(reprocess_file, filename, output_filename, args.edge_detection_threshold,
+                args.average_count, args.correction_a, args.correction_b, args.chunk_size)] = filename
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                summary = future.result()
+            except Exception as e:
+                failed = True
+                print("Failed to reprocess \"" + futures[future] + "\": " + str(e), file=sys.stderr)
+                continue
+            print("\"" + summary['filename'] + "\" -> \"" + summary['output_filename'] + "\": " +
+                (str(summary['channels']) + " channels, " if summary['channels'] > 1 else "") + str(summary['peaks']) +
+                " peaks, " + str(summary['averaged_peaks']) + " averaged, " + str(summary['irregular_count']) +
+                " irregular, " + "{:.1f} s ({:.0f}x real time)".format(summary['duration'], summary['speedup']))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
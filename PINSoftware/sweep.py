@@ -0,0 +1,192 @@
+"""
+This file isn't a part of the server! It is a tool for tuning the processing parameters. It takes the raw
+data of a recorded run and a grid of processing parameters, processes the data with every combination
+of them (in parallel on all cores) and reports how many peak voltages were found, how many irregular data
+issues there were and how spread out the peak voltages are. The best combination is exported in the
+`key=value` config format which can be uploaded in the Control panel.
+
+The raw data is copied once into a temporary .npy file which all the worker processes memory map,
+so it is shared through the page cache instead of being copied into every worker.
+
+Run it with `python -m PINSoftware.sweep`, use `--help` for the options. The parameter values are given either
+as a comma separated list ("0.002,0.003,0.005") or as a range "start:stop:step" (the stop is included).
+"""
+import argparse
+import concurrent.futures
+import csv
+import itertools
+import os
+import sys
+import tempfile
+
+import h5py
+import numpy as np
+
+from PINSoftware.DataAnalyser import DataAnalyser, linear_correct_func, get_config_string
+from PINSoftware.Debugger import Debugger
+from PINSoftware.reprocess import trim_analyser, get_initial_skip
+
+
+parameter_names = ['edge_detection_threshold', 'average_count', 'correction_a', 'correction_b']
+"""The processing parameters which can be swept, in the order used in the results"""
+
+shared_ys = None
+"""The memory mapped raw data in a worker process, it is opened by `open_shared_ys`"""
+
+
+def parse_values(string : str, value_type=float) -> list:
+    """Parses a list of parameter values, either "a,b,c" or "start:stop:step" (including stop)"""
+    if ":" in string:
+        start, stop, step = map(float, string.split(":"))
+        values = np.arange(start, stop + step / 2, step).tolist()
+    else:
+        values = [float(value) for value in string.split(",")]
+    return [value_type(value) if value_type is int else round(value, 12) for value in values]
+
+
+def write_shared_ys(filename : str, npy_filename : str, chunk_size : int = 2**20) -> int:
+    """
+    Copies the raw data of the run `filename` into the .npy file `npy_filename` in chunks (without the zeros
+    the analyser starts with). Returns the frequency of the run.
+    """
+    with h5py.File(filename, 'r') as f:
+        ys = f['ys']
+        skip = get_initial_skip(ys)
+        shared = np.lib.format.open_memmap(npy_filename, mode='w+', dtype='f8', shape=(len(ys) - skip,))
+        for chunk_start in range(skip, len(ys), chunk_size):
+            chunk = ys[chunk_start:chunk_start + chunk_size]
+            shared[chunk_start - skip:chunk_start - skip + len(chunk)] = chunk
+        shared.flush()
+        del shared
+        return int(f.attrs.get('freq', 50000))
+
+
+def open_shared_ys(npy_filename : str):
+    """The initializer of the worker processes, it memory maps the raw data"""
+    global shared_ys
+    shared_ys = np.load(npy_filename, mmap_mode='r')
+
+
+def spread(values : np.ndarray) -> dict:
+    """Returns the statistics of the spread of `values`"""
+    if len(values) == 0:
+        return {'mean': None, 'std': None, 'relative_std': None, 'p5': None, 'p95': None}
+    mean = float(np.mean(values))
+    std = float(np.std(values))
+    return {
+        'mean': mean,
+        'std': std,
+        'relative_std': std / abs(mean) if mean else None,
+        'p5': float(np.percentile(values, 5)),
+        'p95': float(np.percentile(values, 95))
+    }
+
+
+def evaluate(freq : int, parameters : tuple, chunk_size : int = 2**18) -> dict:
+    """
+    Processes the shared raw data with `parameters` (values in the order of `parameter_names`) by streaming
+    it through a `PINSoftware.DataAnalyser.DataAnalyser` and returns the results.
+    """
+    edge_detection_threshold, average_count, correction_a, correction_b = parameters
+    data = DataAnalyser(freq, debugger=Debugger(exit_on_error=False), edge_detection_threshold=edge_detection_threshold,
+        average_count=average_count, correction_func=linear_correct_func(correction_a, correction_b), rolling_windows=None,
+        histogram_bins=None)
+    processed = []
+    averaged = []
+    for chunk_start in range(0, len(shared_ys), chunk_size):
+        for new_y in shared_ys[chunk_start:chunk_start + chunk_size].tolist():
+            data.append(new_y)
+        processed.append(np.array(data.processed_ys, dtype='f8'))
+        averaged.append(np.array(data.averaged_processed_ys, dtype='f8'))
+        for values in [data.processed_ys, data.processed_timestamps, data.averaged_processed_ys, data.averaged_processed_timestamps]:
+            values.clear()
+        trim_analyser(data)
+    processed = np.concatenate(processed)
+    averaged = np.concatenate(averaged)
+    found = len(processed) + data.irregular_count
+    return dict(zip(parameter_names, parameters),
+        peaks=len(processed),
+        peaks_per_s=len(processed) / (len(shared_ys) / freq) if len(shared_ys) else 0,
+        irregular_count=data.irregular_count,
+        irregular_fraction=data.irregular_count / found if found else 0,
+        peak_spread=spread(processed),
+        averaged_spread=spread(averaged))
+
+
+def rank_key(result : dict):
+    """
+    The sorting key of the results, the best comes first. The fewest irregular data, then the smallest relative
+    spread of the peak voltages (spurious or missed edges make it bigger) and then of the averaged ones.
+    """
+    def spread_key(value):
+        # A missing spread (no peak voltages) ranks last, a real zero spread is the best there is
+        return float('inf') if value is None else value
+    return (result['irregular_fraction'], spread_key(result['peak_spread']['relative_std']),
+        spread_key(result['averaged_spread']['relative_std']))
+
+
+def write_csv(filename : str, results : list):
+    """Writes the results as a csv table"""
+    with open(filename, 'w', newline='') as f:
+        writer = csv.writer(f)
+        spread_keys = list(results[0]['peak_spread'].keys())
+        writer.writerow(parameter_names + ['peaks', 'peaks_per_s', 'irregular_count', 'irregular_fraction'] +
+            ['peak_' + key for key in spread_keys] + ['averaged_' + key for key in spread_keys])
+        for result in results:
+            writer.writerow([result[name] for name in parameter_names] +
+                [result['peaks'], result['peaks_per_s'], result['irregular_count'], result['irregular_fraction']] +
+                [result['peak_spread'][key] for key in spread_keys] + [result['averaged_spread'][key] for key in spread_keys])
+
+
+def format_result(result : dict) -> str:
+    """Formats a result as a line of the report"""
+    peak_spread = result['peak_spread']
+    return "{:>10.5g} {:>7} {:>8.4g} {:>8.4g} {:>8} {:>9} {:>8.2%} {:>10.4g} {:>9.3%}".format(
+        result['edge_detection_threshold'], result['average_count'], result['correction_a'], result['correction_b'],
+        result['peaks'], result['irregular_count'], result['irregular_fraction'],
+        peak_spread['mean'] if peak_spread['mean'] is not None else float('nan'),
+        peak_spread['relative_std'] if peak_spread['relative_std'] is not None else float('nan'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sweeps the processing parameters over the raw data of a recorded run.")
+    parser.add_argument("filename", help="The hdf5 file of the run, it has to have the raw data (\"ys\") saved.")
+    parser.add_argument("--edge-detection-threshold", "-e", default="0.001:0.01:0.001", help="The edge detection thresholds [V] to try.")
+    parser.add_argument("--average-count", "-a", default="200", help="The average counts to try.")
+    parser.add_argument("--correction-a", default="1", help="The correction coefficients a to try.")
+    parser.add_argument("--correction-b", default="0", help="The correction coefficients b to try.")
+    parser.add_argument("--workers", "-w", type=int, default=None, help="How many processes to use, by default the number of cores.")
+    parser.add_argument("--output", "-o", default=None, help="Where to save the results as csv.")
+    parser.add_argument("--config", "-c", default=None, help="Where to save the best configuration, by default it is printed.")
+    args = parser.parse_args()
+
+    grid = list(itertools.product(parse_values(args.edge_detection_threshold), parse_values(args.average_count, int),
+        parse_values(args.correction_a), parse_values(args.correction_b)))
+
+    with tempfile.TemporaryDirectory() as directory:
+        npy_filename = os.path.join(directory, "ys.npy")
+        freq = write_shared_ys(args.filename, npy_filename)
+        print("Evaluating " + str(len(grid)) + " combinations", file=sys.stderr)
+        with concurrent.futures.ProcessPoolExecutor(args.workers, initializer=open_shared_ys, initargs=(npy_filename,)) as executor:
+            results = list(executor.map(evaluate, itertools.repeat(freq), grid))
+
+    results.sort(key=rank_key)
+    print("{:>10} {:>7} {:>8} {:>8} {:>8} {:>9} {:>8} {:>10} {:>9}".format(
+        "threshold", "avg cnt", "corr a", "corr b", "peaks", "irregular", "irr frac", "peak mean", "rel std"))
+    for result in results:
+        print(format_result(result))
+    if args.output:
+        write_csv(args.output, results)
+
+    best = results[0]
+    config = get_config_string(best['edge_detection_threshold'], best['correction_a'], best['correction_b'], best['average_count'])
+    if args.config:
+        with open(args.config, 'w') as f:
+            f.write(config)
+        print("The best configuration was saved to \"" + args.config + "\"")
+    else:
+        print("The best configuration:\n" + config, end="")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,33 +3,207 @@ This file isn't a part of the server! This is just useful functions for working
 For example after the data has been recorded in an hd5 file, some functions plot the data in a nice way
 and so on.
 
+All the functions read the datasets in chunks (using `PINSoftware.DataExporter.iter_chunks`) and work on
+them with numpy, so they use the same amount of memory no matter how long the run is. They can also be
+run from the command line with `python -m PINSoftware.util`, use `--help` for the commands.
 """
-
+import argparse
+import bisect
+import math
 
 import h5py
-import matplotlib.pyplot as plt
 import numpy as np
 
+from PINSoftware.DataExporter import iter_chunks
+
+
+default_chunk_size = 2**20
+"""How many values are read at once by default"""
+
+
 def avg(data):
     """Get the average of a list"""
     return sum(data) / len(data)
 
-def show_1(f, adjust_markers=True):
+def find_gaps(dataset, expected : float, tolerance : float = 1, chunk_size : int = default_chunk_size):
     """
-    Plots the files data. Moves the processed_ys to be at the same height as ys.
-    Also plots debug markers, assumes that they are the peak voltage spikes - very useful for debugging.
+    Yields tuples of (index, pre, post) for all the spots in `dataset` where the difference between two
+    successive values (`post - pre`) differs from `expected` by more than `tolerance`. `index` is the index of `post`.
+    The differences are calculated for whole chunks at once, the last value of a chunk is carried over
+    to the next one so the differences across the chunk edges are not missed.
     """
-    plt.plot(f['ys'], '+')
-    plt.plot(f['processed_timestamps'], np.array(f['processed_ys']) + avg(f['ys'][:25000]) - avg(f['processed_ys'][:500]), '-+')
-    plt.plot(np.array(f['marker_timestamps']) - (25 if adjust_markers else 0), f['markers'], 'r.')
-    plt.show()
+    carry = None
+    for chunk_start, chunk in iter_chunks(dataset, chunk_size=chunk_size):
+        if carry is not None:
+            chunk = np.concatenate(([carry], chunk))
+            offset = chunk_start
+        else:
+            offset = chunk_start + 1
+        diffs = np.diff(chunk)
+        for i in np.flatnonzero(np.abs(diffs - expected) > tolerance):
+            yield offset + int(i), chunk[i], chunk[i + 1]
+        if len(chunk):
+            carry = chunk[-1]
 
-def detect_gaps(f, series="processed_timestamps", t=1):
+def detect_gaps(f, series="processed_timestamps", t=1, tolerance=1, chunk_size=default_chunk_size):
     """
     This goes through the file and prints all the spots where the time between two successive data
-    isn't `t`.
+    isn't `t` (in milliseconds). Returns the number of such spots.
     """
     gap = f.attrs['freq'] * (t / 1000)
-    for pre, post in zip(f[series], f[series][1:]):
-        if abs(post - pre - gap) > 1:
-            print(post - pre, pre, post)
+    count = 0
+    for _, pre, post in find_gaps(f[series], gap, tolerance, chunk_size):
+        print(post - pre, pre, post)
+        count += 1
+    return count
+
+def summary_stats(dataset, chunk_size : int = default_chunk_size) -> dict:
+    """
+    Returns the count, mean, standard deviation, minimum and maximum of `dataset`, NaNs are skipped
+    and counted separately. The means and variances of the chunks are combined using the parallel
+    algorithm of Chan et al. so they stay precise for long runs.
+    """
+    count = 0
+    nans = 0
+    mean = 0.0
+    m2 = 0.0
+    minimum = math.inf
+    maximum = -math.inf
+    for _, chunk in iter_chunks(dataset, chunk_size=chunk_size):
+        chunk = chunk.astype('f8')
+        finite = chunk[~np.isnan(chunk)]
+        nans += len(chunk) - len(finite)
+        if len(finite) == 0:
+            continue
+        chunk_mean = finite.mean()
+        chunk_m2 = ((finite - chunk_mean) ** 2).sum()
+        total = count + len(finite)
+        delta = chunk_mean - mean
+        mean += delta * len(finite) / total
+        m2 += chunk_m2 + delta ** 2 * count * len(finite) / total
+        count = total
+        minimum = min(minimum, finite.min())
+        maximum = max(maximum, finite.max())
+    if count == 0:
+        return {'count': 0, 'nans': nans, 'mean': None, 'std': None, 'min': None, 'max': None}
+    return {'count': count, 'nans': nans, 'mean': mean, 'std': math.sqrt(m2 / count), 'min': float(minimum), 'max': float(maximum)}
+
+def is_numeric(dataset) -> bool:
+    """Returns whether `dataset` is a 1-D dataset of numbers, only those can be summarised"""
+    return isinstance(dataset, h5py.Dataset) and dataset.dtype.kind in 'iuf' and dataset.ndim == 1
+
+def summarise(f, chunk_size=default_chunk_size) -> dict:
+    """
+    Returns the `summary_stats` of all the numeric datasets (see `is_numeric`) in the file `f`, the others
+    (like the "parameter_changes" and "watchdog_events" strings) are skipped
+    """
+    return {name: summary_stats(dataset, chunk_size) for name, dataset in f.items() if is_numeric(dataset)}
+
+def decimate(dataset, max_points : int = 10000, x_dataset=None, chunk_size : int = default_chunk_size):
+    """
+    Splits `dataset` into at most `max_points` bins of consecutive values and returns numpy arrays of the
+    x value, the minimum and the maximum of each bin. The x values are the mean of `x_dataset` (which should
+    have the same length, for example the timestamps) in each bin, or the index of the first value of the bin
+    when it is None. The minimums and maximums keep the spikes visible, which a plain `dataset[::step]` loses.
+    """
+    length = len(dataset)
+    bin_size = max(1, math.ceil(length / max_points))
+    # The chunks are made of whole bins
+    chunk_size = max(bin_size, chunk_size // bin_size * bin_size)
+    xs, mins, maxs = [], [], []
+    for chunk_start, chunk in iter_chunks(dataset, chunk_size=chunk_size):
+        bins = math.ceil(len(chunk) / bin_size)
+        padded = np.full(bins * bin_size, np.nan)
+        padded[:len(chunk)] = chunk
+        padded = padded.reshape(bins, bin_size)
+        mins.append(np.nanmin(padded, axis=1))
+        maxs.append(np.nanmax(padded, axis=1))
+        if x_dataset is None:
+            xs.append(np.arange(chunk_start, chunk_start + len(chunk), bin_size, dtype='f8'))
+        else:
+            x_padded = np.full(bins * bin_size, np.nan)
+            x_padded[:len(chunk)] = x_dataset[chunk_start:chunk_start + len(chunk)]
+            xs.append(np.nanmean(x_padded.reshape(bins, bin_size), axis=1))
+    if not mins:
+        return np.empty(0), np.empty(0), np.empty(0)
+    return np.concatenate(xs), np.concatenate(mins), np.concatenate(maxs)
+
+def plot_decimated(ax, dataset, max_points : int = 10000, x_dataset=None, shift : float = 0, **kwargs):
+    """
+    Plots `dataset` decimated by `decimate` into the matplotlib axes `ax`, as a line between the minimums
+    and the maximums of the bins. `shift` is added to the values and `kwargs` are passed to `ax.fill_between`.
+    """
+    xs, mins, maxs = decimate(dataset, max_points, x_dataset)
+    return ax.fill_between(xs, mins + shift, maxs + shift, step='mid', linewidth=0.5, **kwargs)
+
+def show_1(f, adjust_markers=True, max_points=10000, output=None):
+    """
+    Plots the files data. Moves the processed_ys to be at the same height as ys.
+    Also plots debug markers, assumes that they are the peak voltage spikes - very useful for debugging.
+    All the data is decimated to at most `max_points` points, zoom in using `show_range` to see the details.
+    If `output` is given, the plot is saved into that image file instead of being shown.
+    """
+    import matplotlib.pyplot as plt
+    ax = plt.gca()
+    plot_decimated(ax, f['ys'], max_points, alpha=0.5, label="ys")
+    if 'processed_ys' in f and len(f['processed_ys']):
+        shift = avg(f['ys'][:25000]) - avg(f['processed_ys'][:500])
+        plot_decimated(ax, f['processed_ys'], max_points, f['processed_timestamps'], shift, alpha=0.8, label="processed_ys")
+    if 'markers' in f and len(f['markers']):
+        xs, mins, maxs = decimate(f['markers'], max_points, f['marker_timestamps'])
+        ax.plot(xs - (25 if adjust_markers else 0), maxs, 'r.', label="markers")
+    ax.legend()
+    if output:
+        plt.savefig(output)
+    else:
+        plt.show()
+
+def show_range(f, start, stop):
+    """Plots the files data like `show_1` but only the raw data between `start` and `stop` and without decimation"""
+    import matplotlib.pyplot as plt
+    plt.plot(np.arange(start, min(stop, len(f['ys']))), f['ys'][start:stop], '+')
+    if 'processed_timestamps' in f:
+        timestamps = f['processed_timestamps']
+        # bisect only reads the values it looks at, unlike np.searchsorted which would read the whole dataset
+        first, last = bisect.bisect_left(timestamps, start), bisect.bisect_left(timestamps, stop)
+        shift = avg(f['ys'][:25000]) - avg(f['processed_ys'][:500])
+        plt.plot(timestamps[first:last], f['processed_ys'][first:last] + shift, '-+')
+    plt.show()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Helpers for working with saved hdf5 runs.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    gaps_parser = subparsers.add_parser("gaps", help="Print the spots where the time between successive values isn't as expected.")
+    gaps_parser.add_argument("filename")
+    gaps_parser.add_argument("--series", "-s", default="processed_timestamps", help="The timestamps dataset to check.")
+    gaps_parser.add_argument("-t", type=float, default=1, help="The expected time between the values in milliseconds.")
+    gaps_parser.add_argument("--tolerance", type=float, default=1, help="The allowed difference in samples.")
+    summary_parser = subparsers.add_parser("summary", help="Print summary statistics of all the datasets.")
+    summary_parser.add_argument("filename")
+    plot_parser = subparsers.add_parser("plot", help="Plot the data decimated.")
+    plot_parser.add_argument("filename")
+    plot_parser.add_argument("--max-points", "-m", type=int, default=10000, help="How many points to decimate the data to.")
+    plot_parser.add_argument("--output", "-o", default=None, help="Save the plot into this image file instead of showing it.")
+    args = parser.parse_args()
+
+    with h5py.File(args.filename, 'r') as f:
+        if args.command == "gaps":
+            print(str(detect_gaps(f, args.series, args.t, args.tolerance)) + " gaps found")
+        elif args.command == "summary":
+            print("{:<32} {:>12} {:>6} {:>12} {:>12} {:>12} {:>12}".format("dataset", "count", "nans", "mean", "std", "min", "max"))
+            for name, stats in summarise(f).items():
+                if stats['count']:
+                    print("{:<32} {:>12} {:>6} {:>12.6g} {:>12.6g} {:>12.6g} {:>12.6g}".format(name, stats['count'], stats['nans'],
+                        stats['mean'], stats['std'], stats['min'], stats['max']))
+                else:
+                    print("{:<32} {:>12} {:>6}".format(name, stats['count'], stats['nans']))
+        elif args.command == "plot":
+            if args.output:
+                import matplotlib
+                matplotlib.use("Agg")
+            show_1(f, max_points=args.max_points, output=args.output)
+
+
+if __name__ == "__main__":
+    main()
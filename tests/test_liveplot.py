@@ -0,0 +1,56 @@
+"""Tests of `PINSoftware.LivePlot`"""
+import types
+
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+import numpy as np
+
+from PINSoftware.LivePlot import LivePlot
+
+
+def make_plot(data):
+    """Returns a `LivePlot` of `data` which counts how many times the whole figure is drawn"""
+    plot = LivePlot(plt, lambda: data, window=1000, max_points=100)
+    plot.timer = types.SimpleNamespace(interval=plot.min_interval)
+    plot.fig.canvas.mpl_connect('draw_event', plot.on_draw)
+    plot.full_draws = 0
+    draw = plot.fig.canvas.draw
+    def counted_draw():
+        plot.full_draws += 1
+        draw()
+    plot.fig.canvas.draw = counted_draw
+    return plot
+
+
+def test_flat_signal_is_not_redrawn_every_frame():
+    data = types.SimpleNamespace(ys=[])
+    plot = make_plot(data)
+    rng = np.random.default_rng(0)
+    # The first frame draws the figure and the second one fits the axis to the data
+    for _ in range(2):
+        data.ys.extend((1 + rng.normal(0, 1e-4, 100)).tolist())
+        plot.frame()
+    draws = plot.full_draws
+    for _ in range(50):
+        data.ys.extend((1 + rng.normal(0, 1e-4, 100)).tolist())
+        plot.frame()
+    assert plot.full_draws == draws
+    assert plot.ylim[0] < 1 < plot.ylim[1]
+    plt.close(plot.fig)
+
+
+def test_axis_follows_the_signal():
+    data = types.SimpleNamespace(ys=[])
+    plot = make_plot(data)
+    plot.frame()
+    data.ys.extend([0.0] * 1000)
+    plot.frame()
+    assert plot.ylim[0] < 0 < plot.ylim[1]
+    draws = plot.full_draws
+    data.ys.extend([5.0] * 1000)
+    plot.frame()
+    assert plot.full_draws == draws + 1
+    assert plot.ylim[0] < 5 < plot.ylim[1]
+    assert plot.ylim[1] - plot.ylim[0] < 1
+    plt.close(plot.fig)
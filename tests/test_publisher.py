@@ -0,0 +1,98 @@
+"""Tests of `PINSoftware.Publisher` with local subscribers"""
+import socket
+import time
+import types
+
+import numpy as np
+import pytest
+
+from PINSoftware.Debugger import Debugger
+from PINSoftware.Publisher import Publisher, Subscriber, parse_address
+
+
+def make_data():
+    """A stand-in for a `PINSoftware.DataAnalyser.DataAnalyser` with only the parts the publisher reads"""
+    return types.SimpleNamespace(freq=50000, time_anchor_indices=[], processed_timestamps=[], processed_ys=[],
+        averaged_processed_timestamps=[], averaged_processed_ys=[])
+
+
+def wait_for(condition, timeout : float = 5):
+    """Waits until `condition()` is true, fails the test after `timeout` seconds"""
+    end = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < end, "timed out"
+        time.sleep(0.01)
+
+
+def test_subscriber_gets_the_peaks(tmp_path):
+    data = make_data()
+    current = [None]
+    address = "unix:" + str(tmp_path / "publisher.sock")
+    publisher = Publisher(lambda: current[0], address, interval=0.01, debugger=Debugger(exit_on_error=False))
+    publisher.start()
+    try:
+        subscriber = Subscriber(address, timeout=5)
+        wait_for(lambda: len(publisher.subscribers) == 1)
+        current[0] = data
+        data.processed_timestamps.extend([10, 25, 40])
+        data.processed_ys.extend([0.5, 0.25, 0.75])
+        # With an odd average count the averaged timestamps are halfway between two samples
+        data.averaged_processed_timestamps.append(32.5)
+        data.averaged_processed_ys.append(0.5)
+        wait_for(lambda: publisher.frames_sent >= 2)
+        data.processed_timestamps.append(60)
+        data.processed_ys.append(1.5)
+
+        run = subscriber.read_frame()
+        assert run['kind'] == 'run'
+        assert run['run'] == 1
+        assert run['freq'] == 50000
+        assert run['channels'] == 1
+
+        frames = []
+        while sum(len(frame['processed_ys']) for frame in frames) < 4:
+            frames.append(subscriber.read_frame())
+        assert all(frame['kind'] == 'peaks' and frame['channel'] == 0 and frame['run'] == 1 for frame in frames)
+        assert np.concatenate([frame['processed_indices'] for frame in frames]).tolist() == [10, 25, 40, 60]
+        assert np.concatenate([frame['processed_ys'] for frame in frames]).tolist() == [0.5, 0.25, 0.75, 1.5]
+        assert np.concatenate([frame['averaged_indices'] for frame in frames]).tolist() == [32.5]
+        assert np.concatenate([frame['averaged_ys'] for frame in frames]).tolist() == [0.5]
+        subscriber.close()
+    finally:
+        publisher.stop()
+        publisher.join(5)
+    assert not publisher.is_alive()
+
+
+def test_slow_subscriber_is_disconnected():
+    data = make_data()
+    publisher = Publisher(lambda: data, "127.0.0.1:0", interval=0.01, max_buffer=2**16,
+        debugger=Debugger(exit_on_error=False))
+    assert not publisher.is_unix
+    port = publisher.server.getsockname()[1]
+    publisher.start()
+    try:
+        slow = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        slow.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        slow.connect(("127.0.0.1", port))
+        wait_for(lambda: len(publisher.subscribers) == 1)
+        total = 0
+        end = time.monotonic() + 10
+        while publisher.disconnected_slow == 0 and time.monotonic() < end:
+            data.processed_timestamps.extend(range(total, total + 10000))
+            data.processed_ys.extend([0.5] * 10000)
+            total += 10000
+            time.sleep(0.01)
+        assert publisher.disconnected_slow == 1
+        wait_for(lambda: len(publisher.subscribers) == 0)
+        slow.close()
+    finally:
+        publisher.stop()
+        publisher.join(5)
+
+
+def test_unix_address_without_unix_sockets(monkeypatch):
+    monkeypatch.delattr(socket, 'AF_UNIX', raising=False)
+    with pytest.raises(ValueError):
+        parse_address("unix:/tmp/publisher.sock")
+    assert parse_address("5555") == (socket.AF_INET, ("127.0.0.1", 5555))